@@ -1,28 +1,46 @@
-import configparser
-import csv
 import io
-import json
 import os
+import queue
 import random
 import sqlite3
 import sys
-import cv2 as cv
-import folium
-import numpy as np
-import paho.mqtt.client as mqtt
-import polyline
-import requests
+import threading
+import time
+from collections import deque
 from datetime import datetime
+from startup import lazy_import, startup_timer
+# Timed here so the startup report shows what the eager dependencies cost;
+# polyline, requests, numpy and QtWebEngine are imported on first use instead
+startup_timer.import_module("PyQt5.QtWidgets")
+startup_timer.import_module("paho.mqtt.client")
 from PyQt5 import QtGui
-from PyQt5.QtCore import QObject, Qt, QUrl, pyqtSignal
+from PyQt5.QtCore import (QAbstractTableModel, QCoreApplication, QDateTime,
+                          QEvent, QModelIndex, QObject, QSortFilterProxyModel,
+                          Qt, QTimer, pyqtSignal)
 from PyQt5.QtGui import QImage, QTextCursor
-from PyQt5.QtWebEngineWidgets import QWebEngineView
 from PyQt5.QtWidgets import (QAction, QApplication, QCheckBox, QComboBox,
-                             QFileDialog, QFormLayout, QHBoxLayout, QLabel,
-                             QLineEdit, QMainWindow, QMenu, QMessageBox,
-                             QPushButton, QSizePolicy, QTableWidget,
+                             QDateTimeEdit, QFileDialog, QFormLayout,
+                             QHBoxLayout, QLabel, QLineEdit, QMainWindow,
+                             QMenu, QMessageBox, QProgressBar, QPushButton,
+                             QSizePolicy, QSpinBox, QTableView, QTableWidget,
                              QTableWidgetItem, QTabWidget, QTextEdit,
                              QVBoxLayout, QWidget)
+import export
+import payloads
+import simplify
+from config_store import CONFIG_PATH, ConfigStore
+from connections import ConnectionManager
+from devices import DeviceRegistry
+from mapview import MapBridge
+from metrics import MetricsServer, registry
+from pipeline import IngestPipeline
+from publisher import DEFAULT_PAYLOAD, DEFAULT_TOPIC, TEMPLATE_FIELDS, PublishEngine
+from routing import RouteService
+from storage import (DB_PATH, PagedQuery, TelemetryWriter,
+                     initialize_database, load_devices)
+from subscriptions import (UNSUBSCRIBED, configured_topics, format_topic_entry,
+                           parse_topic_entry)
+from tracks import LiveTrails, TrackCache
 
 
 def resource_path(relative_path):
@@ -33,48 +51,6 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
-def initialize_database():
-    conn = sqlite3.connect('newDatabase26.db')
-    cursor = conn.cursor()
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS data (
-        id INTEGER PRIMARY KEY,
-        topic TEXT,
-        message TEXT,
-        timestamp TEXT,                   
-        imei TEXT
-    )
-    ''')    
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS commands (
-        id INTEGER PRIMARY KEY,
-        topic TEXT,
-        message TEXT,
-        timestamp TEXT,                   
-        imei TEXT
-    )
-    ''')
-    # TODO change to match previous tables
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS devices (
-        id INTEGER PRIMARY KEY,
-        imei TEXT,
-        read_topic TEXT,                   
-        comments TEXT,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_topic ON data(topic)')
-
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_imei ON data(imei)')
-
-    conn.commit()
-    conn.close()
-
-
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -95,6 +71,7 @@ class MainWindow(QMainWindow):
         self.page2 = Page2()
         self.page3 = Page3()
         self.page4 = Page4()
+        self.page5 = Page5()
 
         self.page2.device_change.connect(self.page4.populate_combo_box)
 
@@ -102,8 +79,16 @@ class MainWindow(QMainWindow):
         self.tab_widget.addTab(self.page2, "Devices")
         self.tab_widget.addTab(self.page3, "SQLite Database")
         self.tab_widget.addTab(self.page4, "GPS Data")
+        self.tab_widget.addTab(self.page5, "Statistics")
+        self.tab_widget.currentChanged.connect(self.on_tab_changed)
         self.showMaximized()
 
+    def on_tab_changed(self, index):
+        if self.tab_widget.widget(index) is self.page4:
+            self.page4.ensure_map()
+        if self.tab_widget.widget(index) is self.page5:
+            self.page5.refresh()
+
 class Pages(QWidget):
     device_change = pyqtSignal(int)
     def __init__(self):
@@ -118,10 +103,8 @@ class Page1(Pages):
         connectTab = SubTab1()
         publishTab = SubTab2()
         subscribeTab = SubTab3()
-        connectTab.clientReady.connect(subscribeTab.onClientReady)
-        connectTab.clientReady.connect(publishTab.onClientReady)
-        connectTab.signals.connected.connect(subscribeTab.showButton)
-        connectTab.signals.connected.connect(publishTab.showButton)
+        connectTab.signals.broker_state.connect(subscribeTab.on_broker_state)
+        connectTab.signals.broker_state.connect(publishTab.on_broker_state)
         
         sub_tab_widget.addTab(connectTab, "Connect")
         sub_tab_widget.addTab(publishTab, "Publish")
@@ -130,10 +113,28 @@ class Page1(Pages):
         self.layout.addWidget(sub_tab_widget)
 
 class Subs(QWidget):
-    clientReady = pyqtSignal(mqtt.Client)
     def __init__(self):
         super().__init__()  
-        self.sharedClientID = None
+
+class BrokerTab(Subs):
+    # Publish and Subscribe tabs work on one of the connected brokers at a time
+    def __init__(self):
+        super().__init__()
+        self.broker_combo = QComboBox()
+
+    def update_broker_combo(self, name, connected):
+        # A session that lost its connection stays listed while it reconnects;
+        # publishes to it are queued and its subscriptions are restored
+        index = self.broker_combo.findText(name)
+        listed = connected or connectionManager.get(name) is not None
+        if listed and index == -1:
+            self.broker_combo.addItem(name)
+        elif not listed and index != -1:
+            self.broker_combo.removeItem(index)
+        return self.broker_combo.count() > 0
+
+    def current_session(self):
+        return connectionManager.get(self.broker_combo.currentText())
 
 class SubTab1(Subs):
     def __init__(self):
@@ -142,13 +143,12 @@ class SubTab1(Subs):
         self.signals = WorkerSignals()
 
         form_layout = QFormLayout()
-        self.client = None  # Initialize client as None
         
         subscribedTopics = QLabel("Brokers:")
         form_layout.addWidget(subscribedTopics)
         self.tableWidget = QTableWidget(self)
-        self.tableWidget.setColumnCount(1)  # Two columns: Topic and Subscription Status
-        self.tableWidget.setHorizontalHeaderLabels(['Name'])
+        self.tableWidget.setColumnCount(4)  # Broker name, connection status, message rate and outbox size
+        self.tableWidget.setHorizontalHeaderLabels(['Name', 'Status', 'Msg/s', 'Queued'])
         form_layout.addWidget(self.tableWidget)
         self.tableWidget.setContextMenuPolicy(3)  # 3 is for Qt.CustomContextMenu
         button_layout = QHBoxLayout()
@@ -199,9 +199,18 @@ class SubTab1(Subs):
         self.disconnect_button.hide()
 
         self.tableWidget.itemClicked.connect(self.load_mqtt_parameters)
-        self.signals.connected.connect(self.show_success_message)
+        self.tableWidget.itemClicked.connect(self.update_buttons)
+        self.signals.broker_state.connect(self.show_success_message)
+        self.signals.connection_error.connect(self.show_connection_error)
+        connectionManager.set_state_callback(self.signals.broker_state.emit)
+        connectionManager.set_error_callback(self.signals.connection_error.emit)
         self.layout.addLayout(form_layout)
         self.load_brokers()
+        configStore.add_listener(self.reload_brokers)
+
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_broker_stats)
+        self.stats_timer.start(1000)
 
     def add_broker(self):
         row_position = self.tableWidget.rowCount()
@@ -209,83 +218,119 @@ class SubTab1(Subs):
         self.tableWidget.setItem(row_position, 0, QTableWidgetItem(""))
         
     def remove_broker(self):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
         selected_rows = set(index.row() for index in self.tableWidget.selectionModel().selectedRows())
-        for row in reversed(sorted(selected_rows)):
-            broker_item = self.tableWidget.item(row, 0)
-            broker = broker_item.text() if broker_item else ""
-            brokerNames_config = config["Brokers"]
-            for key, value in brokerNames_config.items():
-                if value == broker:
-                    del brokerNames_config[key]
-            
-            if f"{broker}" in config:
-                config.remove_section(f"{broker}")
+        with configStore.edit() as config:
+            for row in reversed(sorted(selected_rows)):
+                broker_item = self.tableWidget.item(row, 0)
+                broker = broker_item.text() if broker_item else ""
+                if "Brokers" in config:
+                    brokerNames_config = config["Brokers"]
+                    for key, value in list(brokerNames_config.items()):
+                        if value == broker:
+                            del brokerNames_config[key]
 
-            self.tableWidget.removeRow(row)
-        with open("config.ini", "w") as configfile:
-            config.write(configfile)        
+                if f"{broker}" in config:
+                    config.remove_section(f"{broker}")
+
+                self.tableWidget.removeRow(row)
 
     def save_mqtt_parameters(self):
         selected_rows = set(index.row() for index in self.tableWidget.selectionModel().selectedRows())
-        for row in (sorted(selected_rows)):
-            broker_item = self.tableWidget.item(row, 0)
-            broker = broker_item.text() if broker_item else ""
+        with configStore.edit() as config:
+            for row in (sorted(selected_rows)):
+                broker_item = self.tableWidget.item(row, 0)
+                broker = broker_item.text() if broker_item else ""
 
-            config = configparser.ConfigParser()
-            config.read("config.ini")
+                if "Brokers" not in config:
+                    config["Brokers"] = {}
 
-            if "Brokers" not in config:
-                config["Brokers"] = {}
+                brokerName_config = config["Brokers"]
+                topic_key = broker
+                brokerName_config[topic_key] = broker
 
-            brokerName_config = config["Brokers"]
-            topic_key = broker
-            brokerName_config[topic_key] = broker
-            
-            if f"{broker}" not in config:
-                config[f"{broker}"] = {}
+                if f"{broker}" not in config:
+                    config[f"{broker}"] = {}
 
-            brokers_config = config[f"{broker}"]
-            
-            brokers_config["broker"] = self.ip_edit.text()
-            brokers_config["port"] = self.port_edit.text()
-            brokers_config["username"] = self.username_edit.text()
-            brokers_config["password"] = self.password_edit.text()
-            brokers_config["client_id"] = self.client_edit.text()
-            with open("config.ini", "w") as configfile:
-                config.write(configfile)
+                brokers_config = config[f"{broker}"]
+
+                brokers_config["broker"] = self.ip_edit.text()
+                brokers_config["port"] = self.port_edit.text()
+                brokers_config["username"] = self.username_edit.text()
+                brokers_config["password"] = self.password_edit.text()
+                brokers_config["client_id"] = self.client_edit.text()
 
     def load_brokers(self):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
-        if "Brokers" in config:
-            brokerNames_config = config["Brokers"]
-            for key in brokerNames_config: 
-                broker = brokerNames_config[key]
-                row_position = self.tableWidget.rowCount()
-                self.tableWidget.insertRow(row_position)
-                self.tableWidget.setItem(row_position, 0, QTableWidgetItem(broker))                
-                #self.topic_edit.clear()
+        with configStore.read() as config:
+            brokers = list(config["Brokers"].values()) if "Brokers" in config else []
+        for broker in brokers:
+            row_position = self.tableWidget.rowCount()
+            self.tableWidget.insertRow(row_position)
+            self.tableWidget.setItem(row_position, 0, QTableWidgetItem(broker))                
+            #self.topic_edit.clear()
+
+    def reload_brokers(self):
+        # config.ini was edited outside the application
+        self.tableWidget.setRowCount(0)
+        self.load_brokers()
+        self.update_broker_stats()
 
     def load_mqtt_parameters(self):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
         selected_rows = set(index.row() for index in self.tableWidget.selectionModel().selectedRows())       
         for row in (sorted(selected_rows)):
             broker_item = self.tableWidget.item(row, 0)
             broker = broker_item.text() if broker_item else ""
         
-            if f"{broker}" in config:
-                mqtt_config = config[f"{broker}"]
+            with configStore.read() as config:
+                mqtt_config = dict(config[f"{broker}"]) if f"{broker}" in config else None
+            if mqtt_config is not None:
                 self.ip_edit.setText(mqtt_config.get("broker", ""))
                 self.port_edit.setText(mqtt_config.get("port", ""))
                 self.username_edit.setText(mqtt_config.get("username", ""))
                 self.password_edit.setText(mqtt_config.get("password", ""))
                 self.client_edit.setText(mqtt_config.get("client_id", ""))
         
+    def session_name(self):
+        # Sessions are named after the selected broker row, or the address if the row has no name
+        row = self.tableWidget.currentRow()
+        broker_item = self.tableWidget.item(row, 0) if row != -1 else None
+        if broker_item and broker_item.text():
+            return broker_item.text()
+        return self.ip_edit.text()
+
+    def update_buttons(self):
+        if connectionManager.get(self.session_name()) is None:
+            self.connect_button.show()
+            self.disconnect_button.hide()
+        else:
+            self.connect_button.hide()
+            self.disconnect_button.show()
+
+    def update_broker_stats(self):
+        stats = connectionManager.stats()
+        for row in range(self.tableWidget.rowCount()):
+            broker_item = self.tableWidget.item(row, 0)
+            broker_stats = stats.get(broker_item.text()) if broker_item else None
+            if broker_stats is None:
+                status, rate, queued = "", "", ""
+            else:
+                if broker_stats["connected"]:
+                    status = "Connected"
+                elif broker_stats["reconnect_in"] is not None:
+                    status = f"Reconnecting in {broker_stats['reconnect_in']:.0f} s (attempt {broker_stats['attempts']})"
+                else:
+                    status = "Connecting"
+                rate = str(broker_stats["rate"])
+                queued = str(broker_stats["queued"])
+            for column, text in ((1, status), (2, rate), (3, queued)):
+                item = self.tableWidget.item(row, column)
+                if item is None:
+                    item = QTableWidgetItem()
+                    item.setFlags(item.flags() & ~Qt.ItemIsEditable)
+                    self.tableWidget.setItem(row, column, item)
+                item.setText(text)
+
     def disconnect_from_broker(self):
-        self.client.disconnect()
+        connectionManager.disconnect(self.session_name())
 
     def connect_to_broker(self):
         broker = self.ip_edit.text()
@@ -301,46 +346,36 @@ class SubTab1(Subs):
         self.connect_mqtt_broker(broker=broker, port=port, username=username, password=password, client_id=client_id)
 
     def connect_mqtt_broker(self, broker, port, username, password, client_id):
+        settings = {"broker": broker, "port": port, "username": username, "password": password, "client_id": client_id}
         try:
-            self.client = mqtt.Client(client_id=client_id)
-            if username:
-                self.client.username_pw_set(username, password)
-
-            self.client.connect(broker, port)
-            self.sharedClientID = self.client
-            self.clientReady.emit(self.sharedClientID)  # Emit a signal when the client is ready
-            self.client.on_disconnect = self.on_disconnect  # Set the on_disconnect event handler
-            self.client.on_connect = self.on_connect
-            self.client.loop_start()
-
+            connectionManager.connect(self.session_name(), settings)
         except Exception as e:
             QMessageBox.critical(self, "Connection Error", f"Failed to connect to MQTT broker. Error: {str(e)}", QMessageBox.Ok)
 
-    def show_success_message(self, connected):
+    # Connection changes go to the status bar and the Status column rather
+    # than dialogs, so a flaky link doesn't need clicking through
+    def show_connection_error(self, name, message):
+        self.update_buttons()
+        self.window().statusBar().showMessage(f"MQTT broker '{name}': {message}")
+
+    def show_success_message(self, name, connected):
+        self.update_buttons()
+        self.update_broker_stats()
         if connected==1:
-            #self.paintEvent(1)
-            self.connect_button.hide()
-            self.disconnect_button.show()
-            QMessageBox.information(self, "Connection Status", "Connected to MQTT broker successfully.", QMessageBox.Ok)
+            self.window().statusBar().showMessage(f"Connected to MQTT broker '{name}'.", 10000)
+        elif connectionManager.get(name) is not None:
+            self.window().statusBar().showMessage(f"Lost the connection to MQTT broker '{name}', reconnecting.")
         else:
-            #self.paintEvent(0)
-            self.connect_button.show()
-            self.disconnect_button.hide()
-            QMessageBox.information(self, "Connection Status", "Disconnected from MQTT broker successfully.", QMessageBox.Ok)
-    
-    def on_disconnect(self, client, userdata, rc):
-        self.signals.connected.emit(0)
-    
-    def on_connect(self, client, userdata, flags, rc):
-        self.signals.connected.emit(1)
+            self.window().statusBar().showMessage(f"Disconnected from MQTT broker '{name}'.", 10000)
 
-class SubTab2(QWidget):
+class SubTab2(BrokerTab):
     def __init__(self):
         super().__init__()
         self.layout = QVBoxLayout(self)
-        self.signals = WorkerSignals()
         form_layout = QFormLayout()
 
+        form_layout.addRow(QLabel("Broker:"), self.broker_combo)
+
         topic_label = QLabel("Topic:")
         self.topic_edit = QLineEdit()
         self.topic_edit.setPlaceholderText("Enter a topic")
@@ -357,39 +392,135 @@ class SubTab2(QWidget):
         self.publish_button = QPushButton("Publish")
         self.publish_button.clicked.connect(self.publish_message)
         form_layout.addRow(self.publish_button)
-        self.signals.connected.connect(self.showButton)
         self.publish_button.hide()
+
+        # Simulator: templated messages for many devices at a target rate,
+        # published from a PublishEngine thread
+        form_layout.addRow(QLabel("Simulator:"))
+        self.sim_topic_edit = QLineEdit(DEFAULT_TOPIC)
+        form_layout.addRow(QLabel("Topic template:"), self.sim_topic_edit)
+        self.sim_payload_edit = QTextEdit()
+        self.sim_payload_edit.setPlainText(DEFAULT_PAYLOAD)
+        self.sim_payload_edit.setMaximumHeight(80)
+        self.sim_payload_edit.setToolTip("Variables: " + ", ".join("{" + name + "}" for name in TEMPLATE_FIELDS))
+        form_layout.addRow(QLabel("Payload template:"), self.sim_payload_edit)
+        self.sim_devices = QSpinBox()
+        self.sim_devices.setRange(1, 1000000)
+        self.sim_devices.setValue(10)
+        form_layout.addRow(QLabel("Devices:"), self.sim_devices)
+        self.sim_rate = QSpinBox()
+        self.sim_rate.setRange(1, 1000000)
+        self.sim_rate.setValue(100)
+        self.sim_rate.setSuffix(" msg/s")
+        form_layout.addRow(QLabel("Rate:"), self.sim_rate)
+        self.sim_qos = QComboBox()
+        self.sim_qos.addItems(["0", "1", "2"])
+        form_layout.addRow(QLabel("QoS:"), self.sim_qos)
+        self.sim_in_flight = QSpinBox()
+        self.sim_in_flight.setRange(1, 65535)
+        self.sim_in_flight.setValue(100)
+        form_layout.addRow(QLabel("Max in flight:"), self.sim_in_flight)
+        self.sim_count = QSpinBox()
+        self.sim_count.setRange(0, 1000000000)
+        self.sim_count.setSpecialValueText("Unlimited")
+        form_layout.addRow(QLabel("Messages:"), self.sim_count)
+        self.sim_button = QPushButton("Start Simulator")
+        self.sim_button.clicked.connect(self.toggle_simulator)
+        form_layout.addRow(self.sim_button)
+        self.sim_button.hide()
+        self.sim_stats = QLabel()
+        self.sim_stats.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        form_layout.addRow(self.sim_stats)
         self.layout.addLayout(form_layout)
 
+        self.engine = None
+        self.sim_timer = QTimer(self)
+        self.sim_timer.timeout.connect(self.update_simulator_stats)
+
     def publish_message(self):
         topic = self.topic_edit.text()
         message = self.message_edit.toPlainText()
         retain = self.retain_checkbox.isChecked()
 
-        if topic and message:
-            self.sharedClientID.publish(topic, message, retain=retain)
+        session = self.current_session()
+        if session is not None and topic and message:
+            session.publish(topic, message, retain=retain)
+            if not session.connected and session.outbox is not None:
+                self.window().statusBar().showMessage(
+                    f"'{session.name}' is offline, message queued ({session.stats()['queued']} waiting).", 10000)
+            elif not session.connected:
+                self.window().statusBar().showMessage(f"'{session.name}' is offline, message dropped.", 10000)
             """
             QMessageBox.information(
                 self, "Publish Status", f"Published to topic '{topic}' with retain={retain}.", QMessageBox.Ok
             )
             """
 
-    def onClientReady(self, client):
-        self.sharedClientID = client
-    
-    def showButton(self, show):
-        if show == 0:
-            self.publish_button.hide()
-        else:
+    def toggle_simulator(self):
+        if self.engine is not None and self.engine.running:
+            self.stop_simulator()
+            return
+        session = self.current_session()
+        if session is None:
+            return
+        try:
+            self.engine = PublishEngine(session, self.sim_topic_edit.text(), self.sim_payload_edit.toPlainText(),
+                                        rate=self.sim_rate.value(), qos=int(self.sim_qos.currentText()),
+                                        retain=self.retain_checkbox.isChecked(), devices=self.sim_devices.value(),
+                                        max_in_flight=self.sim_in_flight.value(), count=self.sim_count.value())
+        except ValueError as e:
+            QMessageBox.warning(self, "Simulator", str(e), QMessageBox.Ok)
+            return
+        self.engine.start()
+        self.sim_button.setText("Stop Simulator")
+        self.sim_timer.start(1000)
+
+    def stop_simulator(self):
+        self.engine.stop()
+        self.update_simulator_stats()
+
+    def update_simulator_stats(self):
+        stats = self.engine.stats()
+        lines = [f"Sent {stats['sent']} in {stats['elapsed']:.0f} s: {stats['rate']} msg/s now, "
+                 f"{stats['average_rate']:.0f} msg/s average"]
+        if self.engine.qos:
+            lines.append(f"Acked {stats['acked']}, in flight {stats['in_flight']}, latency p50 <= {stats['p50_ms']:g} ms, "
+                         f"p95 <= {stats['p95_ms']:g} ms, p99 <= {stats['p99_ms']:g} ms")
+            counts, total_sum, total = self.engine.latency.snapshot()
+            bounds = self.engine.latency.buckets
+            rows = [(f"<= {bound * 1000:g} ms", count) for bound, count in zip(bounds, counts)]
+            rows.append((f"> {bounds[-1] * 1000:g} ms", counts[-1]))
+            largest = max(counts) or 1
+            lines.extend(f"{label:>12} {'#' * round(40 * count / largest):<40} {count}" for label, count in rows if count)
+        if stats["error"]:
+            lines.append(f"Stopped: {stats['error']}")
+        self.sim_stats.setText("\n".join(lines))
+        if not stats["running"]:
+            self.sim_timer.stop()
+            self.sim_button.setText("Start Simulator")
+
+    def on_broker_state(self, name, connected):
+        if self.update_broker_combo(name, connected):
             self.publish_button.show()
+            self.sim_button.show()
+        else:
+            self.publish_button.hide()
+            self.sim_button.hide()
+        if self.engine is not None and self.engine.session.name == name and connectionManager.get(name) is None:
+            self.stop_simulator()
 
-class SubTab3(Subs):
+class SubTab3(BrokerTab):
     def __init__(self):
         super().__init__()
         self.layout = QVBoxLayout(self)
         self.signals = WorkerSignals()
         form_layout = QVBoxLayout()
-        self.messageCounter = 0
+
+        broker_layout = QHBoxLayout()
+        broker_layout.addWidget(QLabel("Broker:"))
+        broker_layout.addWidget(self.broker_combo)
+        self.broker_combo.currentTextChanged.connect(self.refresh_subscription_status)
+        form_layout.addLayout(broker_layout)
 
         topics_label = QLabel("Enter a topic:")
         form_layout.addWidget(topics_label)
@@ -399,23 +530,52 @@ class SubTab3(Subs):
         self.topic_edit.setMaximumHeight(100)
         form_layout.addWidget(self.topic_edit)
 
+        add_layout = QHBoxLayout()
+        add_layout.addWidget(QLabel("QoS:"))
+        self.qos_combo = QComboBox()
+        self.qos_combo.addItems(["0", "1", "2"])
+        add_layout.addWidget(self.qos_combo)
         add_topic_button = QPushButton("Add Topic")
         add_topic_button.clicked.connect(self.add_topic)
-        form_layout.addWidget(add_topic_button)
+        add_layout.addWidget(add_topic_button)
+        form_layout.addLayout(add_layout)
 
         subscribedTopics = QLabel("Topics:")
         form_layout.addWidget(subscribedTopics)
         self.topic_table_widget = QTableWidget()
-        self.topic_table_widget.setColumnCount(2)  # Two columns: Topic and Subscription Status
-        self.topic_table_widget.setHorizontalHeaderLabels(['Topic', 'Subscribed'])
+        self.topic_table_widget.setColumnCount(3)  # Topic, requested QoS and subscription state on the broker
+        self.topic_table_widget.setHorizontalHeaderLabels(['Topic', 'QoS', 'Subscribed'])
+        self.topic_table_widget.setSelectionBehavior(QTableWidget.SelectRows)
+        self.topic_table_widget.setEditTriggers(QTableWidget.NoEditTriggers)
         self.topic_table_widget.setMaximumHeight(200)
         form_layout.addWidget(self.topic_table_widget)
-        self.subscribe_button = QPushButton("Subscribe/Unsubscribe")
-        self.subscribe_button.clicked.connect(self.subscribe_to_topic)
-        form_layout.addWidget(self.subscribe_button)
-        self.subscribe_button.hide()
+        # Each button sends one SUBSCRIBE/UNSUBSCRIBE per batch of topics
+        self.subscribe_buttons = QWidget()
+        subscribe_layout = QHBoxLayout(self.subscribe_buttons)
+        subscribe_layout.setContentsMargins(0, 0, 0, 0)
+        for text, handler in (("Subscribe", self.subscribe_selected), ("Unsubscribe", self.unsubscribe_selected),
+                              ("Subscribe All", self.subscribe_all), ("Unsubscribe All", self.unsubscribe_all)):
+            button = QPushButton(text)
+            button.clicked.connect(handler)
+            subscribe_layout.addWidget(button)
+        form_layout.addWidget(self.subscribe_buttons)
+        self.subscribe_buttons.hide()
         subscribedTopics = QLabel("Messages:")
         form_layout.addWidget(subscribedTopics)
+
+        log_controls = QHBoxLayout()
+        self.pause_button = QPushButton("Pause")
+        self.pause_button.setCheckable(True)
+        self.pause_button.toggled.connect(self.pause_messages)
+        log_controls.addWidget(self.pause_button)
+        clear_button = QPushButton("Clear")
+        clear_button.clicked.connect(self.clear_messages)
+        log_controls.addWidget(clear_button)
+        self.topic_filter_edit = QLineEdit()
+        self.topic_filter_edit.setPlaceholderText("Filter by topic")
+        self.topic_filter_edit.textChanged.connect(self.filter_messages)
+        log_controls.addWidget(self.topic_filter_edit)
+        form_layout.addLayout(log_controls)
         
         self.layout.addLayout(form_layout)
 
@@ -423,206 +583,348 @@ class SubTab3(Subs):
         delete_action = QAction("Delete", self)
         delete_action.triggered.connect(self.delete_topic)
         self.context_menu.addAction(delete_action)
+        qos_menu = self.context_menu.addMenu("QoS")
+        for qos in (0, 1, 2):
+            qos_action = QAction(str(qos), self)
+            qos_action.triggered.connect(lambda checked, qos=qos: self.set_topic_qos(qos))
+            qos_menu.addAction(qos_action)
 
         self.topic_table_widget.setContextMenuPolicy(3)  # 3 is for Qt.CustomContextMenu
         self.topic_table_widget.customContextMenuRequested.connect(self.show_context_menu)
         
-        self.message_display = QTextEdit()
-        self.message_display.setReadOnly(True)  # Make it read-only
-        self.message_display.setMinimumSize(300, 550)
-        self.layout.addWidget(self.message_display)
-
-        self.signals.connected.connect(self.showButton)
+        log_section = config["MessageLog"] if "MessageLog" in config else {}
+        self.message_model = MessageLogModel(max_messages=int(log_section.get("max_messages", 5000)),
+                                             frame_rate=int(log_section.get("frame_rate", 30)))
+        self.thumbnails = config.getboolean("MessageLog", "thumbnails", fallback=True)
+        self.message_proxy = QSortFilterProxyModel(self)
+        self.message_proxy.setSourceModel(self.message_model)
+        self.message_proxy.setFilterKeyColumn(3)  # Topic column
+        self.message_proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.message_view = QTableView()
+        self.message_view.setModel(self.message_proxy)
+        self.message_view.setSelectionBehavior(QTableView.SelectRows)
+        self.message_view.setWordWrap(False)
+        self.message_view.verticalHeader().hide()
+        self.message_view.horizontalHeader().setStretchLastSection(True)
+        self.message_view.setMinimumSize(300, 400)
+        self.message_view.clicked.connect(self.show_message_details)
+        self.message_model.rowsAboutToBeInserted.connect(self.check_following)
+        self.message_model.rowsInserted.connect(self.follow_messages)
+        self.following = True
+        self.layout.addWidget(self.message_view)
+
+        self.message_details = QTextEdit()
+        self.message_details.setReadOnly(True)  # Make it read-only
+        self.message_details.setMaximumHeight(200)
+        self.layout.addWidget(self.message_details)
+
+        self.ingest_status = QLabel()
+        self.layout.addWidget(self.ingest_status)
+        self.status_timer = QTimer(self)
+        self.status_timer.timeout.connect(self.update_ingest_status)
+        self.status_timer.start(1000)
+
+        self.signals.message_ready.connect(self.message_model.add_entry)
+        # The log shows messages matching the topics in the table; each topic
+        # is a render route in the pipeline's topic trie
         self.load_topicConfig()
+        configStore.add_listener(self.reload_topicConfig)
+        self.signals.subscriptions_changed.connect(self.on_subscriptions_changed)
+        connectionManager.set_subscription_callback(self.signals.subscriptions_changed.emit)
 
     def show_context_menu(self, pos):
         self.context_menu.exec_(self.topic_table_widget.mapToGlobal(pos))
 
     def delete_topic(self):
-        selected_items = self.topic_table_widget.selectedItems()
-        if selected_items:
-            row = selected_items[0].row()
-            deleted_topic_item = self.topic_table_widget.item(row, 0)  # Get the topic item in the first column
-            deleted_topic = deleted_topic_item.text()
-            #print(deleted_topic)
-            self.delete_topicConfig(deleted_topic)
-            self.topic_table_widget.removeRow(row)           
+        rows = sorted(set(index.row() for index in self.topic_table_widget.selectionModel().selectedRows()), reverse=True)
+        with configStore.edit():
+            for row in rows:
+                deleted_topic = self.topic_table_widget.item(row, 0).text()
+                self.delete_topicConfig(deleted_topic)
+                ingestPipeline.remove_route(deleted_topic, self.render_message, "render")
+                self.topic_table_widget.removeRow(row)
+
+    def add_topic_row(self, topic, qos):
+        row_position = self.topic_table_widget.rowCount()
+        self.topic_table_widget.insertRow(row_position)
+        self.topic_table_widget.setItem(row_position, 0, QTableWidgetItem(topic))
+        self.topic_table_widget.setItem(row_position, 1, QTableWidgetItem(str(qos)))
+        self.topic_table_widget.setItem(row_position, 2, QTableWidgetItem(UNSUBSCRIBED))
+        ingestPipeline.add_route(topic, self.render_message, "render")
 
     def add_topic(self):
         topic = self.topic_edit.toPlainText().strip()
         if topic:
-            row_position = self.topic_table_widget.rowCount()
-            self.topic_table_widget.insertRow(row_position)
-            self.topic_table_widget.setItem(row_position, 0, QTableWidgetItem(topic))
-            self.topic_table_widget.setItem(row_position, 1, QTableWidgetItem("No"))
+            qos = int(self.qos_combo.currentText())
+            self.add_topic_row(topic, qos)
             self.topic_edit.clear()
 
-            self.save_topicConfig(topic)
-
-    def save_topicConfig(self, topic):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
-        if "Topics" not in config:
-            config["Topics"] = {}
-        topics_config = config["Topics"]    
-        topic_key = topic
-        topics_config[topic_key] = topic
+            self.save_topicConfig(topic, qos)
 
-        with open("config.ini", "w") as configfile:
-            config.write(configfile)
+    def save_topicConfig(self, topic, qos=0):
+        with configStore.edit() as config:
+            if "Topics" not in config:
+                config["Topics"] = {}
+            topics_config = config["Topics"]    
+            topic_key = topic
+            topics_config[topic_key] = format_topic_entry(topic, qos)
 
     def delete_topicConfig(self, topic):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
-        topics_config = config["Topics"]
-        for key, value in topics_config.items():
-            if value == topic:
-                del topics_config[key]
-        with open("config.ini", "w") as configfile:
-            config.write(configfile)
+        with configStore.edit() as config:
+            if "Topics" not in config:
+                return
+            topics_config = config["Topics"]
+            for key, value in list(topics_config.items()):
+                if parse_topic_entry(value)[0] == topic:
+                    del topics_config[key]
 
     def load_topicConfig(self):
-        config = configparser.ConfigParser()
-        config.read("config.ini")
-        #topics = []
-        if "Topics" in config:
-            topics_config = config["Topics"]
-            for key in topics_config: 
-                topic = topics_config[key]
-                row_position = self.topic_table_widget.rowCount()
-                self.topic_table_widget.insertRow(row_position)
-                self.topic_table_widget.setItem(row_position, 0, QTableWidgetItem(topic))
-                self.topic_table_widget.setItem(row_position, 1, QTableWidgetItem("No"))
-                self.topic_edit.clear()
-
-    def subscribe_to_topic(self):
-        selected_row = self.topic_table_widget.currentRow()
-        if selected_row != -1:
-            topic_item = self.topic_table_widget.item(selected_row, 0)
-            self.status_item = self.topic_table_widget.item(selected_row, 1)
-
-            if self.status_item.text() == "No":
-                # Subscribe to the MQTT topic
-                topic = topic_item.text()
-                self.sharedClientID.subscribe(topic)
-                self.status_item.setText("Yes")
-                """
-                QMessageBox.information(
-                    self, "Subscription Status", f"Subscribed to topic '{topic}'.", QMessageBox.Ok
-                )
-                """
-            else:
-                # Unsubscribe from the MQTT topic
-                topic = topic_item.text()
-                self.sharedClientID.unsubscribe(topic)
-                self.status_item.setText("No")
-                """
-                QMessageBox.information(
-                    self, "Subscription Status", f"Unsubscribed from topic '{topic}'.", QMessageBox.Ok
-                )
-                """
-
-    def onClientReady(self, client):
-        self.sharedClientID = client
-        self.sharedClientID.on_message = self.on_message_received  # Set the message handler
-
-    def showButton(self, show):
-        if show == 0:
-            num_rows = self.topic_table_widget.rowCount()
-            for row in range(num_rows):
-                item = self.topic_table_widget.item(row, 1)
-                item.setText("No")
-            
-            self.subscribe_button.hide()
-        else:
-            self.subscribe_button.show()
+        with configStore.read() as config:
+            topics = configured_topics(config)
+        for topic, qos in topics:
+            self.add_topic_row(topic, qos)
+        self.refresh_subscription_status()
+
+    def reload_topicConfig(self):
+        # config.ini was edited outside the application
+        for row in range(self.topic_table_widget.rowCount()):
+            ingestPipeline.remove_route(self.topic_table_widget.item(row, 0).text(), self.render_message, "render")
+        self.topic_table_widget.setRowCount(0)
+        self.load_topicConfig()
 
-    def on_message_received(self, client, userdata, message):
-        #client_id = client._client_id
-        
-        self.messageCounter += 1
-        topic = message.topic
-        # Silly way to make out if the message contains an image
-        if len(message.payload)>2000:
-            payload = message.payload.hex()
-            print(payload)
+    def topic_rows(self, selected_only):
+        # [(topic, qos)] of the selected rows, or of every row
+        if selected_only:
+            rows = sorted(set(index.row() for index in self.topic_table_widget.selectionModel().selectedRows()))
         else:
-            try:
-                payload = message.payload.decode("utf-8")
-            except ValueError as e:
-                print(f"Error: {e}")
-                return
-        message_text = f"#{self.messageCounter}\nTopic: {topic}\nMessage:\n{payload}\n\n"
-        if len(message.payload)>2000:
-            self.handle_image(payload, topic)
+            rows = range(self.topic_table_widget.rowCount())
+        return [(self.topic_table_widget.item(row, 0).text(), int(self.topic_table_widget.item(row, 1).text()))
+                for row in rows]
+
+    def subscribe_selected(self):
+        session = self.current_session()
+        if session is not None:
+            session.subscribe_many(self.topic_rows(True))
+
+    def unsubscribe_selected(self):
+        session = self.current_session()
+        if session is not None:
+            session.unsubscribe_many([topic for topic, qos in self.topic_rows(True)])
+
+    def subscribe_all(self):
+        session = self.current_session()
+        if session is not None:
+            session.subscribe_many(self.topic_rows(False))
+
+    def unsubscribe_all(self):
+        session = self.current_session()
+        if session is not None:
+            session.unsubscribe_many([topic for topic, qos in self.topic_rows(False)])
+
+    def set_topic_qos(self, qos):
+        # Subscribed topics are subscribed again, which replaces their QoS on the broker
+        rows = sorted(set(index.row() for index in self.topic_table_widget.selectionModel().selectedRows()))
+        session = self.current_session()
+        resubscribe = []
+        with configStore.edit():
+            for row in rows:
+                topic = self.topic_table_widget.item(row, 0).text()
+                self.topic_table_widget.item(row, 1).setText(str(qos))
+                self.save_topicConfig(topic, qos)
+                if session is not None and topic in session.subscriptions:
+                    resubscribe.append((topic, qos))
+        if resubscribe:
+            session.subscribe_many(resubscribe)
+
+    def on_broker_state(self, name, connected):
+        if self.update_broker_combo(name, connected):
+            self.subscribe_buttons.show()
         else:
-            self.message_display.append(message_text)
-
-        cursor = self.message_display.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        self.message_display.setTextCursor(cursor)       
-        self.insert_telemetry_data(payload, topic)     
-    
-    def handle_image(self, payload, topic):
-        print(payload)
-        try:
-            image_bytes = bytes.fromhex(payload)
-        except ValueError as e:
-            print(f"Error: {e}")
+            self.subscribe_buttons.hide()
+        self.refresh_subscription_status()
+
+    def on_subscriptions_changed(self, name, topics):
+        if name == self.broker_combo.currentText():
+            self.refresh_subscription_status()
+
+    def refresh_subscription_status(self):
+        # The Subscribed column shows the state on the broker selected above
+        # the table: pending until the SUBACK arrives, then the granted QoS
+        session = self.current_session()
+        for row in range(self.topic_table_widget.rowCount()):
+            topic_item = self.topic_table_widget.item(row, 0)
+            item = self.topic_table_widget.item(row, 2)
+            if session is None or not session.connected:
+                item.setText(UNSUBSCRIBED)
+            else:
+                item.setText(session.subscriptions.state(topic_item.text()))
+
+    def render_message(self, message):
+        # Runs on the pipeline's render thread; widgets are only touched on the GUI thread
+        image = None
+        if message.kind == payloads.IMAGE and self.thumbnails:
+            image = self.handle_image(message.payload)
+        self.signals.message_ready.emit(LogEntry(message.seq, message.recv_ts, message.broker, message.topic, message.kind,
+                                                 message.text, message.payload, image))
+
+    def pause_messages(self, paused):
+        self.message_model.set_paused(paused)
+        self.pause_button.setText("Resume" if paused else "Pause")
+
+    def clear_messages(self):
+        self.message_model.clear()
+        self.message_details.clear()
+
+    def filter_messages(self, text):
+        self.message_proxy.setFilterFixedString(text)
+
+    def check_following(self):
+        # Only keep scrolling with new messages if the user hasn't scrolled up
+        scroll_bar = self.message_view.verticalScrollBar()
+        self.following = scroll_bar.value() >= scroll_bar.maximum()
+
+    def follow_messages(self):
+        if self.following:
+            self.message_view.scrollToBottom()
+
+    def show_message_details(self, index):
+        entry = self.message_model.entry(self.message_proxy.mapToSource(index).row())
+        self.message_details.clear()
+        header = f"#{entry.seq}\nBroker: {entry.broker}\nTopic: {entry.topic}\n"
+        if entry.kind == payloads.TEXT:
+            self.message_details.setPlainText(f"{header}Message:\n{entry.text}")
             return
+        image = entry.image
+        if image is None and entry.kind == payloads.IMAGE:
+            image = self.handle_image(entry.payload)
+        if image is None:
+            self.message_details.setPlainText(f"{header}{payloads.describe(entry.payload)}:\n{entry.payload.hex(' ')}")
+        else:
+            cursor = QTextCursor(self.message_details.document())
+            cursor.insertText(f"{header}Image: \n\n")
+            cursor.insertImage(image)
+
+    def handle_image(self, payload):
+        # Decodes the image once; QImage is safe to use off the GUI thread
         image = QImage()
-        image.loadFromData(image_bytes)             
-        image_size = cv.imdecode(np.frombuffer(image_bytes, np.uint8), cv.IMREAD_COLOR)
-        desired_height, desired_width, channels = image_size.shape
-        if desired_height > 350:
-            desired_height = 350
-        if desired_width > 400:
-            desired_width = 400
-        scaled_image = image.scaled(desired_width, desired_height, aspectRatioMode=Qt.KeepAspectRatio)
-        cursor = QTextCursor(self.message_display.document())
-        cursor.movePosition(QTextCursor.End)
-        self.message_display.setTextCursor(cursor)
-        
-        cursor.insertText(f"#{self.messageCounter}\nTopic: {topic}\nImage: \n\n")
-        cursor.insertImage(scaled_image)
-
-    def insert_telemetry_data(self, payload, topic):  
-        data_lines = payload.strip().split('\n')
-        imei = data_lines[0].strip()
-        save = 0
-
-        for sublist in devicesRAM:
-            if sublist[0]==imei or sublist[1]==topic:
-                save = 1
-                conn = sqlite3.connect('newDatabase26.db')
-                cursor = conn.cursor()  
-                current_timestamp = datetime.now()            
-                formatted_timestamp = current_timestamp.strftime("%Y-%m-%d %H:%M:%S")                            
-
-        for sublist in devicesRAM:
-            if sublist[0]==imei:                                            
-                for line in data_lines[1:]:
-                    line = line.strip()
-                    parts = line.strip().split(',')
-                    timestamp = parts[0]
-                    
-                    cursor.execute('''
-                        INSERT INTO data (imei, timestamp, message, topic)
-                        VALUES (?, ?, ?, ?)
-                    ''', (imei, timestamp, line, topic))        
-
-        # Check if topic is a read topic for the registered devices
-        for sublist in devicesRAM:
-            if sublist[1]==topic:                
-                cursor.execute('''
-                    INSERT INTO commands (imei, timestamp, message, topic)
-                    VALUES (?, ?, ?, ?)
-                ''', (sublist[0], formatted_timestamp, payload.strip(), topic))
-        if save==1:            
-            conn.commit()
-            conn.close()    
-        
-        
+        if not image.loadFromData(payload):
+            print("Error: could not decode image payload")
+            return None
+        desired_height = min(image.height(), 350)
+        desired_width = min(image.width(), 400)
+        return image.scaled(desired_width, desired_height, aspectRatioMode=Qt.KeepAspectRatio)
+
+    def update_ingest_status(self):
+        stats = telemetryWriter.stats()
+        pipeline_stats = ingestPipeline.stats()
+        dropped = sum(stage["dropped"] for stage in pipeline_stats.values())
+        self.ingest_status.setText(
+            f"Parse queue: {pipeline_stats['parse']['queue_depth']}  "
+            f"Persist queue: {pipeline_stats['persist']['queue_depth']}  "
+            f"Render queue: {pipeline_stats['render']['queue_depth']}  "
+            f"Dropped: {dropped}\n"
+            f"Writer queue: {stats['queue_depth']}/{stats['queue_size']}  "
+            f"Rows written: {stats['rows_written']}  "
+            f"Flush: last {stats['last_flush_ms']:.1f} ms, avg {stats['avg_flush_ms']:.1f} ms, max {stats['max_flush_ms']:.1f} ms")
+
+
+class LogEntry:
+    __slots__ = ("seq", "recv_ts", "broker", "topic", "kind", "text", "payload", "image", "preview")
+
+    def __init__(self, seq, recv_ts, broker, topic, kind, text, payload, image):
+        self.seq = seq
+        self.recv_ts = recv_ts
+        self.broker = broker
+        self.topic = topic
+        self.kind = kind
+        self.text = text
+        self.payload = payload
+        self.image = image
+        if text is not None:
+            self.preview = text[:200].replace('\n', ' | ')
+        elif image is not None:
+            self.preview = f"[image {image.width()}x{image.height()}]"
+        else:
+            self.preview = payloads.describe(payload)
+
+
+class MessageLogModel(QAbstractTableModel):
+    # Keeps only the last max_messages entries. Incoming entries are buffered
+    # and handed to the view at most frame_rate times per second.
+    headers = ['#', 'Received', 'Broker', 'Topic', 'Message']
+
+    def __init__(self, max_messages=5000, frame_rate=30, parent=None):
+        super().__init__(parent)
+        self.max_messages = max_messages
+        self.entries = []
+        self.pending = deque(maxlen=max_messages)
+        self.paused = False
+        self.frame_timer = QTimer(self)
+        self.frame_timer.timeout.connect(self.flush_pending)
+        self.frame_timer.start(max(1, 1000 // frame_rate))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        column = index.column()
+        if column == 0:
+            return entry.seq
+        if column == 1:
+            return time.strftime("%H:%M:%S", time.localtime(entry.recv_ts))
+        if column == 2:
+            return entry.broker
+        if column == 3:
+            return entry.topic
+        return entry.preview
+
+    def entry(self, row):
+        return self.entries[row]
+
+    def add_entry(self, entry):
+        self.pending.append(entry)
+
+    def set_paused(self, paused):
+        self.paused = paused
+        if not paused:
+            self.flush_pending()
+
+    def clear(self):
+        self.pending.clear()
+        self.beginResetModel()
+        self.entries = []
+        self.endResetModel()
+
+    def flush_pending(self):
+        if self.paused or not self.pending:
+            return
+        started = time.perf_counter()
+        batch = list(self.pending)
+        self.pending.clear()
+        overflow = min(len(self.entries), len(self.entries) + len(batch) - self.max_messages)
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            del self.entries[:overflow]
+            self.endRemoveRows()
+        first = len(self.entries)
+        self.beginInsertRows(QModelIndex(), first, first + len(batch) - 1)
+        self.entries.extend(batch)
+        self.endInsertRows()
+        LOG_FRAME_SECONDS.observe(time.perf_counter() - started)
+        LOG_FRAME_ROWS.inc(len(batch))
+
+
 class Page2(Pages):
     def __init__(self):
         super().__init__()        
@@ -664,23 +966,16 @@ class Page2(Pages):
             self.tableWidget.removeRow(row)
 
     def load_devicesSQL(self):
-        global devicesRAM
-        conn = sqlite3.connect('newDatabase26.db')
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT imei, read_topic, comments FROM devices')
-        devices = cursor.fetchall()
-
-        conn.close()
+        devices = load_devices()
         self.tableWidget.setRowCount(len(devices))
         for row, (imei, read_topic, comments) in enumerate(devices):
             self.tableWidget.setItem(row, 0, QTableWidgetItem(imei))
             self.tableWidget.setItem(row, 1, QTableWidgetItem(read_topic))
             self.tableWidget.setItem(row, 2, QTableWidgetItem(comments))
-            devicesRAM.append([imei, read_topic, comments])
+        deviceRegistry.load(devices)
             
     def insert_deviceSQL(self):        
-        conn = sqlite3.connect('newDatabase26.db')
+        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
         current_timestamp = datetime.now()            
         formatted_timestamp = current_timestamp.strftime("%Y-%m-%d %H:%M:%S")
@@ -694,27 +989,27 @@ class Page2(Pages):
             imei = imei_item.text() if imei_item else ""
             read_topic = read_topic_item.text() if read_topic_item else ""
             comments = comments_item.text() if comments_item else ""
-            duplicate = 0
-            for device in devicesRAM:
-                if device[0]==imei:
-                    duplicate = 1
-            if duplicate:
+            if imei in deviceRegistry:
                 QMessageBox.warning(self, "Database error", "Device already exists in database.", QMessageBox.Ok)
-            else:
-                # Insert the device information into the SQLite database
-                cursor.execute('''
-                    INSERT INTO devices (imei, read_topic, comments, timestamp) VALUES (?, ?, ?, ?)
-                ''', (imei, read_topic, comments, formatted_timestamp))
-                devicesRAM.append([imei, read_topic, comments]) 
+                continue
+            # Insert the device information into the SQLite database; ingest
+            # only routes it once the row is committed
+            try:
+                with conn:
+                    cursor.execute('''
+                        INSERT INTO devices (imei, read_topic, comments, timestamp) VALUES (?, ?, ?, ?)
+                    ''', (imei, read_topic, comments, formatted_timestamp))
+            except sqlite3.Error as e:
+                QMessageBox.warning(self, "Database error", f"Device {imei} not added: {e}", QMessageBox.Ok)
+                continue
+            deviceRegistry.add(imei, read_topic, comments)
 
-        conn.commit()
         conn.close()
                
         self.device_change.emit(1)
         
     def delete_deviceSQL(self):
-        global devicesRAM
-        conn = sqlite3.connect('newDatabase26.db')
+        conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
 
         selected_rows = set(index.row() for index in self.tableWidget.selectionModel().selectedRows())
@@ -723,10 +1018,14 @@ class Page2(Pages):
             imei_item = self.tableWidget.item(row, 0)
             imei = imei_item.text() if imei_item else ""
 
-            cursor.execute('DELETE FROM devices WHERE imei = ?', (imei,))
-            devicesRAM = [sub_list for sub_list in devicesRAM if sub_list[0] != imei]
+            try:
+                with conn:
+                    cursor.execute('DELETE FROM devices WHERE imei = ?', (imei,))
+            except sqlite3.Error as e:
+                QMessageBox.warning(self, "Database error", f"Device {imei} not deleted: {e}", QMessageBox.Ok)
+                continue
+            deviceRegistry.remove(imei)
             self.tableWidget.removeRow(row)
-        conn.commit()
         conn.close()        
        
         self.device_change.emit(1)
@@ -751,79 +1050,346 @@ class Page3(Pages):
         self.search_input_edit = QLineEdit()
         self.query_button = QPushButton("Query Database")        
         self.layout.addWidget(self.search_input_edit)
+        self.time_range = TimeRangeFilter()
+        self.layout.addWidget(self.time_range)
         self.layout.addWidget(self.query_button)
         
-        self.table_widget = QTableWidget()
-        self.table_widget.setColumnCount(5)  # Adjust the number of columns as needed
+        self.query_model = LazyQueryModel(self)
+        self.query_model.progress.connect(self.update_query_status)
+        self.query_model.query_failed.connect(self.show_query_error)
+        self.table_widget = QTableView()
+        self.table_widget.setModel(self.query_model)
+        self.table_widget.setWordWrap(False)
+        self.table_widget.horizontalHeader().setStretchLastSection(True)
         self.layout.addWidget(self.table_widget)
 
+        query_status_layout = QHBoxLayout()
+        self.query_status = QLabel()
+        query_status_layout.addWidget(self.query_status)
+        self.cancel_query_button = QPushButton("Cancel Query")
+        self.cancel_query_button.clicked.connect(self.query_model.cancel)
+        self.cancel_query_button.hide()
+        query_status_layout.addWidget(self.cancel_query_button)
+        self.layout.addLayout(query_status_layout)
+
+        download_layout = QHBoxLayout()
         self.download_button = QPushButton("Download Data")  # Add this button
-        self.layout.addWidget(self.download_button)
+        download_layout.addWidget(self.download_button)
+        self.export_progress = QProgressBar()
+        self.export_progress.hide()
+        download_layout.addWidget(self.export_progress)
+        self.cancel_export_button = QPushButton("Cancel Download")
+        self.cancel_export_button.hide()
+        download_layout.addWidget(self.cancel_export_button)
+        self.layout.addLayout(download_layout)
+        self.export_worker = None
 
         table_size_policy = QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.table_widget.setSizePolicy(table_size_policy)
 
         self.query_button.clicked.connect(self.query_database)
         self.download_button.clicked.connect(self.download_data)
+        self.cancel_export_button.clicked.connect(self.cancel_export)
 
     def query_database(self):
         search_criteria = self.search_criteria_combo.currentText()
 
         search_input = self.search_input_edit.text()
 
-        self.table_widget.clear()
-        self.table_widget.setRowCount(0)
-        self.table_widget.setColumnCount(4)  # Adjust the number of columns as needed
-        self.table_widget.setHorizontalHeaderLabels(['IMEI', 'Timestamp', 'Message', 'Topic'])
-
-        conn = sqlite3.connect('newDatabase26.db')
-        cursor = conn.cursor()
+        chunk_size = config.getint("Database", "page_size", fallback=500)
+        start, end = self.time_range.range()
+        self.query_model.start_query(PagedQuery('data', search_criteria.lower(), search_input, chunk_size, start=start, end=end))
+        self.cancel_query_button.show()
 
-        cursor.execute(f'SELECT imei, timestamp, message, topic FROM data WHERE {search_criteria} = ?', (search_input,))
-
-        data = cursor.fetchall()
-        if len(data)==0 and search_criteria=='Topic':            
-            cursor.execute(f'SELECT imei, timestamp, message, topic FROM commands WHERE topic = ?', (search_input,))
-            data = cursor.fetchall()
-        conn.close()
+    def update_query_status(self, loaded, total, running):
+        if total is None:
+            self.query_status.setText(f"Loaded {loaded} rows")
+        else:
+            self.query_status.setText(f"Loaded {loaded} of {total} rows")
+        self.cancel_query_button.setVisible(running)
 
-        self.table_widget.setRowCount(len(data))
-        for row, (imei, timestamp, message, topic) in enumerate(data):
-            self.table_widget.setItem(row, 0, QTableWidgetItem(imei))
-            self.table_widget.setItem(row, 1, QTableWidgetItem(timestamp))
-            self.table_widget.setItem(row, 2, QTableWidgetItem(message))
-            self.table_widget.setItem(row, 3, QTableWidgetItem(topic))        
+    def show_query_error(self, message):
+        QMessageBox.warning(self, "Query", f"Query stopped: {message}", QMessageBox.Ok)
 
     def download_data(self):
         search_criteria = self.search_criteria_combo.currentText()
 
         search_input = self.search_input_edit.text()
 
-        if search_input:
+        # Export what is on screen when there is a query, including the
+        # commands-table fallback for topics
+        source = self.query_model.source
+        if source is None and search_input:
+            start, end = self.time_range.range()
+            source = PagedQuery('data', search_criteria.lower(), search_input, start=start, end=end)
+
+        if source:
             options = QFileDialog.Options()
             options |= QFileDialog.ReadOnly
-            file_path, _ = QFileDialog.getSaveFileName(self, "Save Data", "", "CSV Files (*.csv);;All Files (*)", options=options)
+            file_path, selected_filter = QFileDialog.getSaveFileName(
+                self, "Save Data", "", "CSV Files (*.csv);;Parquet Files (*.parquet);;All Files (*)", options=options)
 
             if file_path:
-                conn = sqlite3.connect('newDatabase26.db')
-                cursor = conn.cursor()
+                export_format = 'parquet' if selected_filter.startswith("Parquet") else export.format_for(file_path)
+                if export_format == 'parquet':
+                    try:
+                        lazy_import("pyarrow.parquet")
+                    except ImportError:
+                        QMessageBox.warning(self, "Download Status", "Parquet export needs pyarrow (pip install pyarrow).", QMessageBox.Ok)
+                        return
+                chunk_size = config.getint("Database", "export_chunk_size", fallback=5000)
+                self.export_worker = ExportWorker(source.copy(chunk_size=chunk_size), file_path, export_format)
+                self.export_worker.signals.progress.connect(self.update_export_progress)
+                self.export_worker.signals.finished.connect(self.export_finished)
+                self.download_button.setEnabled(False)
+                self.export_progress.setRange(0, 0)
+                self.export_progress.show()
+                self.cancel_export_button.show()
+                self.export_worker.start()
+            else:
+                QMessageBox.warning(self, "File Not Selected", "Please choose a file location to save the data.", QMessageBox.Ok)
 
-                cursor.execute(f'SELECT imei, timestamp, message, topic FROM data WHERE {search_criteria} = ?', (search_input,))
-                data = cursor.fetchall()
+    def cancel_export(self):
+        if self.export_worker is not None:
+            self.export_worker.cancel()
+
+    def update_export_progress(self, written, total):
+        if total:
+            self.export_progress.setRange(0, total)
+            self.export_progress.setValue(min(written, total))
+
+    def export_finished(self, written, error):
+        worker = self.export_worker
+        self.export_worker = None
+        self.download_button.setEnabled(True)
+        self.export_progress.hide()
+        self.cancel_export_button.hide()
+        if error:
+            QMessageBox.warning(self, "Download Status", f"Download failed: {error}", QMessageBox.Ok)
+        elif worker.cancelled:
+            QMessageBox.information(self, "Download Status", f"Download cancelled after {written} rows.", QMessageBox.Ok)
+        elif written:
+            QMessageBox.information(self, "Download Status", f"Data downloaded successfully ({written} rows).", QMessageBox.Ok)
+        else:
+            QMessageBox.warning(self, "No Data", f"No data found for the specified {worker.query.column}.", QMessageBox.Ok)
 
-                conn.close()
 
-                if data:
-                    with open(file_path, 'w', newline='') as csv_file:
-                        csv_writer = csv.writer(csv_file)
-                        csv_writer.writerow(["IMEI", "Timestamp", "Message", "Topic"])  # CSV header
-                        csv_writer.writerows(data)
+class ExportSignals(QObject):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int, str)
 
-                    QMessageBox.information(self, "Download Status", "Data downloaded successfully.", QMessageBox.Ok)
-                else:
-                    QMessageBox.warning(self, "No Data", f"No data found for the specified {search_criteria}.", QMessageBox.Ok)
-            else:
-                QMessageBox.warning(self, "File Not Selected", "Please choose a file location to save the data.", QMessageBox.Ok)
+
+class ExportWorker(threading.Thread):
+    # Streams a PagedQuery to CSV or Parquet a chunk at a time, so exporting a
+    # long device history needs memory for one chunk, not the whole result
+    def __init__(self, query, path, export_format='csv'):
+        super().__init__(name="ExportWorker", daemon=True)
+        self.query = query
+        self.path = path
+        self.export_format = export_format
+        self.signals = ExportSignals()
+        self.cancelled = False
+        self.total = 0
+
+    def cancel(self):
+        self.cancelled = True
+        self.query.interrupt()
+
+    def report(self, written):
+        self.signals.progress.emit(written, self.total)
+
+    def run(self):
+        written = 0
+        error = ""
+        try:
+            self.query.open()
+            self.total = self.query.count()
+            self.report(0)
+            written = export.EXPORTERS[self.export_format](self.query, self.path, self.report, lambda: self.cancelled)
+        except sqlite3.Error as e:
+            if not self.cancelled:
+                error = str(e)
+        except Exception as e:
+            error = str(e)
+        finally:
+            self.query.close()
+        if self.cancelled or error:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self.signals.finished.emit(written, error)
+
+
+class TimeRangeFilter(QWidget):
+    # Optional from/to bounds, formatted like the stored timestamps so the
+    # comparison can use the (imei, timestamp) indexes
+    FORMAT = "yyyy-MM-dd HH:mm:ss"
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.enabled_check = QCheckBox("Between")
+        layout.addWidget(self.enabled_check)
+        now = QDateTime.currentDateTime()
+        self.start_edit = QDateTimeEdit(now.addDays(-1))
+        self.end_edit = QDateTimeEdit(now)
+        for edit in (self.start_edit, self.end_edit):
+            edit.setDisplayFormat(self.FORMAT)
+            edit.setCalendarPopup(True)
+            edit.setEnabled(False)
+            self.enabled_check.toggled.connect(edit.setEnabled)
+        layout.addWidget(self.start_edit)
+        layout.addWidget(QLabel("and"))
+        layout.addWidget(self.end_edit)
+        layout.addStretch()
+
+    def range(self):
+        if not self.enabled_check.isChecked():
+            return None, None
+        return self.start_edit.dateTime().toString(self.FORMAT), self.end_edit.dateTime().toString(self.FORMAT)
+
+
+class QueryWorker(threading.Thread):
+    # Runs one PagedQuery on its own connection; the model asks for chunks as
+    # the view scrolls and gets them back through its signals
+    def __init__(self, query, model, generation):
+        super().__init__(name="QueryWorker", daemon=True)
+        self.query = query
+        self.model = model
+        self.generation = generation
+        self.requests = queue.Queue()
+        self.cancelled = False
+
+    def fetch(self):
+        self.requests.put("fetch")
+
+    def cancel(self):
+        self.cancelled = True
+        self.query.interrupt()
+        self.requests.put(None)
+
+    def run(self):
+        try:
+            self.query.open()
+            estimate = self.query.estimate()
+            if estimate is not None:
+                self.model.count_ready.emit(self.generation, f"~{estimate}")
+            first = True
+            while not self.cancelled:
+                request = self.requests.get()
+                if request is None:
+                    break
+                rows = self.query.next_chunk()
+                if first and not rows and self.query.table == 'data' and self.query.column == 'topic':
+                    # Topics that only carry commands are looked up in the commands table
+                    self.query.close()
+                    self.query = self.query.copy(table='commands')
+                    self.query.open()
+                    rows = self.query.next_chunk()
+                self.model.rows_ready.emit(self.generation, rows, self.query.exhausted)
+                if first and not self.cancelled:
+                    # Counted once the first page is on screen, so the total
+                    # shows long before the user has scrolled to the end
+                    self.model.count_ready.emit(self.generation, str(self.query.count()))
+                first = False
+                if self.query.exhausted:
+                    break
+        except sqlite3.Error as e:
+            if not self.cancelled:
+                self.model.query_failed.emit(str(e))
+        finally:
+            self.query.close()
+
+
+class LazyQueryModel(QAbstractTableModel):
+    # Rows are fetched chunk by chunk off the GUI thread as the view scrolls
+    # down, so a query never holds more rows than the user has looked at
+    rows_ready = pyqtSignal(int, list, bool)
+    count_ready = pyqtSignal(int, str)
+    query_failed = pyqtSignal(str)
+    progress = pyqtSignal(int, object, bool)
+    headers = ['IMEI', 'Timestamp', 'Message', 'Topic']
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.worker = None
+        self.generation = 0
+        self.pending = False
+        self.exhausted = True
+        self.total = None
+        self.source = None
+        self.rows_ready.connect(self.add_rows)
+        self.count_ready.connect(self.set_total)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return payloads.describe(self.rows[index.row()][index.column()])
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted and not self.pending
+
+    def fetchMore(self, parent=QModelIndex()):
+        if self.worker is not None and not self.pending:
+            self.pending = True
+            self.worker.fetch()
+
+    def start_query(self, query):
+        self.cancel()
+        self.generation += 1
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = False
+        self.total = None
+        self.source = query.copy()
+        self.endResetModel()
+        self.worker = QueryWorker(query, self, self.generation)
+        self.worker.start()
+        self.fetchMore()
+        self.progress.emit(0, None, True)
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        self.pending = False
+        self.exhausted = True
+        self.progress.emit(len(self.rows), self.total, False)
+
+    def add_rows(self, generation, rows, exhausted):
+        if generation != self.generation:
+            return
+        self.pending = False
+        self.exhausted = exhausted
+        if self.worker is not None:
+            # The worker may have fallen back from data to commands
+            self.source = self.worker.query.copy()
+        if rows:
+            first = len(self.rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+        self.progress.emit(len(self.rows), self.total, self.worker is not None and not exhausted)
+
+    def set_total(self, generation, total):
+        if generation != self.generation:
+            return
+        self.total = total
+        self.progress.emit(len(self.rows), self.total, self.worker is not None and not self.exhausted)
 
 
 class Page4(Pages):
@@ -831,15 +1397,8 @@ class Page4(Pages):
         super().__init__()
         self.layout = QVBoxLayout(self)
         
-        self.map = QWebEngineView()
-        self.layout.addWidget(self.map)
-        min_lat, max_lat = 40.4774, 45.01585  # Latitude boundaries
-        min_lon, max_lon = -74.2591, -73.7004  # Longitude boundaries
-
-        initial_latitude = random.uniform(min_lat, max_lat)
-        initial_longitude = random.uniform(min_lon, max_lon)
-        map_url = QUrl(f"https://www.openstreetmap.org/?mlat={initial_latitude}&mlon={initial_longitude}#map=13/{initial_latitude}/{initial_longitude}")
-        self.map.setUrl(map_url)
+        self.map = None  # Created on first use, see ensure_map
+        self.rendered = None  # (device, time range, points) of the map on screen
         
         search_criteria_layout = QHBoxLayout()
         self.label = QLabel("Retrieve GPS data for device with IMEI:", self)
@@ -851,124 +1410,220 @@ class Page4(Pages):
         self.layout.addLayout(search_criteria_layout)
         self.populate_combo_box()
 
+        self.time_range = TimeRangeFilter()
+        self.layout.addWidget(self.time_range)
+
         self.map_button = QPushButton("Map GPS data")
         self.layout.addWidget(self.map_button)
         self.map_button.clicked.connect(self.map_data)
 
+        # Follow mode: fixes come straight from the ingest pipeline through
+        # liveTrails and are pushed to the map once per frame
+        self.follow_check = QCheckBox("Follow live (all devices, centred on the selected one)")
+        self.follow_check.toggled.connect(self.set_following)
+        self.layout.addWidget(self.follow_check)
+        self.follow_timer = QTimer(self)
+        self.follow_timer.timeout.connect(self.update_trails)
+
+    def ensure_map(self):
+        if self.map is not None:
+            return self.map
+        QWebEngineView = lazy_import("PyQt5.QtWebEngineWidgets").QWebEngineView
+        self.map = QWebEngineView()
+        self.layout.insertWidget(0, self.map)
+        min_lat, max_lat = 40.4774, 45.01585  # Latitude boundaries
+        min_lon, max_lon = -74.2591, -73.7004  # Longitude boundaries
+
+        initial_latitude = random.uniform(min_lat, max_lat)
+        initial_longitude = random.uniform(min_lon, max_lon)
+        # The Leaflet page is loaded once; tracks are pushed into it over the bridge
+        self.bridge = MapBridge(self.map)
+        self.bridge.load(initial_latitude, initial_longitude)
+        return self.map
+
     def populate_combo_box(self):
         self.search_criteria_combo.clear()        
-        for device in devicesRAM:            
-            self.search_criteria_combo.addItem(f'{device[0]} ({device[2]})')
+        for device in deviceRegistry:            
+            self.search_criteria_combo.addItem(f'{device.imei} ({device.comments})')
+
+    def set_following(self, following):
+        self.ensure_map()
+        if following:
+            self.rendered = None  # the pulled track is cleared from the page
+            self.bridge.call("clearTrack")
+            self.bridge.call("setTrails", liveTrails.snapshot(), liveTrails.trail_length, self.followed_device())
+            self.follow_timer.start(max(1, 1000 // config.getint("Map", "follow_fps", fallback=5)))
+        else:
+            self.follow_timer.stop()
+            self.bridge.call("clearTrails")
+
+    def followed_device(self):
+        return self.search_criteria_combo.currentText().split(' ')[0]
+
+    def update_trails(self):
+        batch = liveTrails.drain()
+        if batch:
+            self.bridge.call("appendTrails", batch, liveTrails.trail_length, self.followed_device())
         
     def map_data(self):
         device = self.search_criteria_combo.currentText().split(' ')[0]        
-        conn = sqlite3.connect('newDatabase26.db')
-        cursor = conn.cursor()                 
-        cursor.execute(f'SELECT imei, timestamp, message, topic FROM commands WHERE imei= ?', (device,))
-        data = cursor.fetchall()
-        conn.close()
-        coordinates = []
-        gpsData = 0        
-        for line in data:            
-            if (',+' in line[2] or ',-' in line[2]) and ',-,-' not in line[2]:
-                fix, lat, lon = line[2].split(',')
-                coordinates.append((float(lat), float(lon)))  
-                gpsData = 1
-
-        if gpsData==1:
-            self.map_route(coordinates, device)
+        start, end = self.time_range.range()
+        # Fixes are parsed once at ingest into gps_fixes; the cached track
+        # only reads the rows stored since the last click
+        track = trackCache.get(device)
+        track.update()
+        first, last = track.span(start, end)
+
+        if last > first:
+            rendered = 0
+            if self.rendered is not None and self.rendered[:2] == (device, (start, end)):
+                rendered = self.rendered[2]  # only the points after these are new
+            if rendered == last - first:
+                self.ensure_map().show()
+                return
+            if self.map_route(track.points(start, end), device, rendered):
+                self.rendered = (device, (start, end), last - first)
         else:
             QMessageBox.critical(self, "GPS Map", "No GPS data available for this device.", QMessageBox.Ok)
                 
-    def map_route(self, coordinates, device):
-        map = folium.Map(location=coordinates[0], zoom_start=13)
-        
+    def map_route(self, coordinates, device, first=0):
+        # Updates the page in place: the route is sent as a few zoom-dependent
+        # simplifications and the fixes as clustered markers. With first > 0
+        # the previous render is kept and only markers from first on are added.
+        route = None
         if len(coordinates)>1:
-            route = self.get_route(coordinates)[0]
-            result = self.get_route(coordinates)[1]
-        
-            folium.PolyLine(route, color="red", weight=2.5, opacity=1, dash_array='10').add_to(map)
-            coordCounter = 0
-            for index, coord in enumerate(coordinates):                    
-                color = 'blue'
-                if (index==0):
-                    color = 'green'
-                elif (index==len(coordinates)-1):
-                    color = 'black'
-                d2d = result['routes'][0]['legs'][index-1]['distance']
-                coordCounter += 1
-                if (index==0):
-                    d2d = 0
-                    folium.Marker(location = coord, popup="Start\n<i>%s</i>\nd2d: %.1fm" %(coord, d2d),  icon=folium.Icon(color=color)).add_to(map)
-                else:            
-                    folium.Marker(location = coord, popup="%d\n<i>%s</i>\nd2d: %.1fm" %(coordCounter-1, coord, d2d),  icon=folium.Icon(color=color)).add_to(map)
-                #custom_icon = folium.DivIcon(
-                #    html=f'<div style="font-weight: bold; font-size: 16px;"><i class="fa fa-map-marker fa-2x" style="color: {color};"></i><br>{counter}</div>',
-                #    icon_size=(60, 60)  # Adjust the icon size as needed
-                #)
-
-            # folium.Marker(
-            #     location=coord,
-            #     popup="<i>%s</i>\nd2d: %.1fm" %(coord, d2d),
-            #     icon=custom_icon
-            # ).add_to(map)                
-                if (index==len(coordinates)-1):
-                    folium.Marker(location = coord, popup="End\n<i>%s</i>\nd2d: %.1fm\nTotal: %.1fm" %(coord, d2d, result['routes'][0]['distance']),  icon=folium.Icon(color=color)).add_to(map)                    
-        else:            
-            folium.Marker(location=coordinates[0], popup="Start\n<i>%s</i>\nd2d: 0m" % (coordinates[0],), icon=folium.Icon(color='blue')).add_to(map)
-
-        map.save(f"{device}_map.html")       
-        self.map.setHtml(open(f'{device}_map.html').read())
+            route = self.get_route(coordinates)
+            if route is None:
+                return False
+        geometry = route.geometry if route else coordinates
+        legs = route.legs if route else []
+
+        self.ensure_map()
+        if first == 0:
+            self.bridge.call("clearTrack")
+        self.bridge.call("setRoute", simplify.zoom_levels(geometry))
+        self.bridge.call("addMarkers", [
+            [lat, lon, "Start" if index == 0 else str(index), legs[index-1] if index else 0]
+            for index, (lat, lon) in enumerate(coordinates[first:], first)])
+        self.bridge.call("setEndpoints", coordinates[0], coordinates[-1] if len(coordinates) > 1 else None,
+                         route.distance if route else 0)
+        if first == 0:
+            self.bridge.call("fitTrack")
         self.map.show()
-        return map 
-        
+        return True
+
     def get_route(self, coordinates):
-        coords = ";".join(f"{coord[1]},{coord[0]}" for coord in coordinates)
-        url = f"https://router.project-osrm.org/route/v1/driving/{coords}"
-        response = requests.get(url)
-        res = response.json()
-        poly = polyline.decode(res['routes'][0]['geometry'])
-        
-        if response.status_code == 200:
-            data = json.loads(response.text)
+        # Cached, chunked and fetched concurrently, see routing.RouteService
+        try:
+            return routeService.route(coordinates)
+        except Exception as e:
+            print(f"Error: {e}")
+            QMessageBox.critical(self, "GPS Map", f"Could not route the GPS data: {e}", QMessageBox.Ok)
+            return None
+
+
+class Page5(Pages):
+    # Every metric of the registry, the same data the HTTP endpoint serves,
+    # refreshed once a second while the tab is visible
+    def __init__(self):
+        super().__init__()
+        self.layout = QVBoxLayout(self)
+        self.endpoint_label = QLabel()
+        self.layout.addWidget(self.endpoint_label)
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("Filter by metric name or label")
+        self.filter_edit.textChanged.connect(self.refresh)
+        self.layout.addWidget(self.filter_edit)
+        self.table = QTableWidget()
+        self.table.setColumnCount(3)
+        self.table.setHorizontalHeaderLabels(['Metric', 'Labels', 'Value'])
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.layout.addWidget(self.table)
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(1000)
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        if metricsServer is not None:
+            self.endpoint_label.setText(f"Prometheus endpoint: http://{metricsServer.server.server_address[0]}:{metricsServer.port}/metrics")
         else:
-            print(f"Request failed with status code: {response.status_code}")
-            return []
-        
-        """ This calculates the total trigonometric distance and not driving distance, driving distance is inside the url responce
-        total_distance = 0
-        for i in range(len(poly) - 1):
-            coord1 = poly[i]
-            coord2 = poly[i + 1]
-            total_distance += geopy.distance.distance(coord1, coord2).km
-        """
-        return poly, res
+            self.endpoint_label.setText("Prometheus endpoint disabled ([Metrics] port = 0, or the port is taken)")
+        text = self.filter_edit.text().lower()
+        rows = [row for row in registry.rows() if text in row[0].lower() or text in row[1].lower()]
+        self.table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                item = self.table.item(row, column)
+                if item is None:
+                    self.table.setItem(row, column, QTableWidgetItem(value))
+                elif item.text() != value:
+                    item.setText(value)
+
+
+class FirstPaintFilter(QObject):
+    # Application-wide filter that removes itself after the first paint event
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint:
+            QApplication.instance().removeEventFilter(self)
+            startup_timer.mark("first paint")
+            startup_timer.report()
+        return False
+
 
+LOG_FRAME_SECONDS = registry.histogram("gui_log_frame_seconds", "Time to add one frame of messages to the Subscribe tab's log")
+LOG_FRAME_ROWS = registry.counter("gui_log_rows_total", "Messages added to the Subscribe tab's log")
 
 
 class WorkerSignals(QObject):
-    connected = pyqtSignal(int)
+    broker_state = pyqtSignal(str, int)
+    connection_error = pyqtSignal(str, str)
+    subscriptions_changed = pyqtSignal(str, object)
+    message_ready = pyqtSignal(object)
 
 
 if __name__ == "__main__":
+    # Lets QtWebEngineWidgets be imported after the QApplication exists
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
-    config = configparser.ConfigParser()
-
-    if not os.path.exists("config.ini"):
-        """
-        config["Brokers"] = {
-            "broker": "",
-            "port": "",
-            "username": "",
-            "password": "",
-            "client_id": ""
-        }
-        """
-        with open("config.ini", "w") as configfile:
-            config.write(configfile)
-    devicesRAM = []           
+    startup_timer.mark("QApplication created")
+    first_paint_filter = FirstPaintFilter()
+    app.installEventFilter(first_paint_filter)
+    # One copy of config.ini for the whole application, see config_store
+    configStore = ConfigStore(CONFIG_PATH)
+    config = configStore.config
+    if not os.path.exists(CONFIG_PATH):
+        with configStore.edit():
+            pass
+        configStore.flush()
+    config_timer = QTimer()
+    config_timer.timeout.connect(configStore.check)
+    config_timer.start(1000)
+    deviceRegistry = DeviceRegistry()           
     initialize_database()
+    trackCache = TrackCache()
+    liveTrails = LiveTrails(config.getint("Map", "trail_length", fallback=500))
+    routeService = RouteService.from_config(config)
+    telemetryWriter = TelemetryWriter.from_config(config)
+    telemetryWriter.start()
+    ingestPipeline = IngestPipeline.from_config(config, telemetryWriter, deviceRegistry)
+    ingestPipeline.set_fix_listener(liveTrails.add)
+    ingestPipeline.start()
+    connectionManager = ConnectionManager.from_config(config, ingestPipeline)
+    app.aboutToQuit.connect(connectionManager.disconnect_all)
+    app.aboutToQuit.connect(ingestPipeline.stop)
+    app.aboutToQuit.connect(telemetryWriter.stop)
+    app.aboutToQuit.connect(routeService.close)
+    app.aboutToQuit.connect(configStore.close)
+    metricsServer = MetricsServer.from_config(config)
+    if metricsServer is not None:
+        metricsServer.start()
+        app.aboutToQuit.connect(metricsServer.stop)
     window = MainWindow()
     window.show()
+    startup_timer.mark("main window shown")
     
     sys.exit(app.exec_())
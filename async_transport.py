@@ -0,0 +1,335 @@
+import asyncio
+import itertools
+import struct
+import threading
+import time
+
+from connections import SessionBase
+
+# MQTT 3.1.1 control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+CONNACK_RESULTS = {
+    1: "unacceptable protocol version",
+    2: "identifier rejected",
+    3: "server unavailable",
+    4: "bad user name or password",
+    5: "not authorised",
+}
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    data = value.encode("utf-8") if isinstance(value, str) else value
+    return struct.pack("!H", len(data)) + data
+
+
+def packet(packet_type, flags, body=b""):
+    return bytes(((packet_type << 4) | flags,)) + encode_length(len(body)) + body
+
+
+def ack_packet(packet_type, packet_id):
+    # PUBREL, SUBSCRIBE and UNSUBSCRIBE must have the reserved flags set to 0b0010
+    return packet(packet_type, 2 if packet_type == PUBREL else 0, struct.pack("!H", packet_id))
+
+
+def connect_packet(client_id, username="", password="", keepalive=60, clean_session=True):
+    flags = 0x02 if clean_session else 0
+    payload = encode_string(client_id)
+    if username:
+        flags |= 0x80
+        payload += encode_string(username)
+        if password:
+            flags |= 0x40
+            payload += encode_string(password)
+    body = encode_string("MQTT") + bytes((4, flags)) + struct.pack("!H", keepalive) + payload
+    return packet(CONNECT, 0, body)
+
+
+def publish_packet(topic, payload, qos=0, retain=False, packet_id=0):
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return packet(PUBLISH, (qos << 1) | int(retain), body + payload)
+
+
+def subscribe_packet(packet_id, topics):
+    body = struct.pack("!H", packet_id) + b"".join(encode_string(topic) + bytes((qos,)) for topic, qos in topics)
+    return packet(SUBSCRIBE, 2, body)
+
+
+def unsubscribe_packet(packet_id, topics):
+    body = struct.pack("!H", packet_id) + b"".join(encode_string(topic) for topic in topics)
+    return packet(UNSUBSCRIBE, 2, body)
+
+
+def parse_publish(flags, body):
+    qos = (flags >> 1) & 0x03
+    topic_length = struct.unpack_from("!H", body)[0]
+    position = 2 + topic_length
+    topic = body[2:position].decode("utf-8")
+    packet_id = None
+    if qos:
+        packet_id = struct.unpack_from("!H", body, position)[0]
+        position += 2
+    return topic, body[position:], qos, packet_id
+
+
+async def read_packet(reader):
+    header = (await reader.readexactly(1))[0]
+    multiplier = 1
+    length = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b""
+    return header >> 4, header & 0x0F, body
+
+
+class EventLoopThread(threading.Thread):
+    # One asyncio loop shared by every asyncio broker session
+    def __init__(self):
+        super().__init__(name="asyncio-transport", daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+class AsyncBrokerSession(SessionBase):
+    # MQTT 3.1.1 client on asyncio streams. connect() only schedules the
+    # session on the shared loop, so it never blocks the caller. The sync
+    # subscribe/unsubscribe/publish methods are safe to call from any thread.
+    # Once connected, a lost connection is retried with backoff until
+    # disconnect() is called.
+    def __init__(self, name, settings, pipeline, on_state_change=None, on_error=None,
+                 loop_thread=None, keepalive=60, connect_timeout=10):
+        super().__init__(name, settings, pipeline, on_state_change, on_error)
+        self.loop_thread = loop_thread
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._packet_id = 0
+        self._write_ids = itertools.count(1)  # QoS 0 publishes, see _publish
+        self._packet_lock = threading.Lock()
+        self._last_inbound = 0.0  # time.monotonic() of the last packet from the broker
+        self._received_qos2 = {}  # packet id -> (topic, payload, recv_ts), delivered on PUBREL
+
+    def connect(self):
+        self._task = self.loop_thread.submit(self.run())
+
+    def disconnect(self):
+        self.stopping = True
+        if self._task is None:
+            return
+        if threading.current_thread() is self.loop_thread:
+            self._close(True)
+            return
+        if self.connected:
+            self.loop_thread.call(self._close, True)
+        else:
+            self._task.cancel()
+        try:
+            self._task.result(timeout=self.connect_timeout)
+        except Exception:
+            pass
+
+    def _send_subscribe(self, batch):
+        packet_id = self._next_packet_id()
+        self.subscriptions.sent(packet_id, "subscribe", batch)
+        self.loop_thread.call(self._write, subscribe_packet(packet_id, batch))
+
+    def _send_unsubscribe(self, batch):
+        packet_id = self._next_packet_id()
+        self.subscriptions.sent(packet_id, "unsubscribe", batch)
+        self.loop_thread.call(self._write, unsubscribe_packet(packet_id, batch))
+
+    def _publish(self, topic, payload, qos=0, retain=False):
+        # QoS 1/2 are done once PUBACK/PUBCOMP arrives. QoS 0 gets a negative
+        # id of its own, reported through _published once the packet has been
+        # written, as paho does; a drop before that leaves an outbox row for
+        # the next connection. None when the connection is already closed.
+        writer = self._writer
+        if writer is None or writer.is_closing():
+            return None
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        packet_id = self._next_packet_id() if qos else 0
+        with self._packet_lock:
+            message_id = packet_id or -next(self._write_ids)
+        self.loop_thread.call(self._write_publish, publish_packet(topic, payload, qos, retain, packet_id), message_id)
+        return message_id
+
+    def _write_publish(self, data, message_id):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(data)
+            if message_id < 0:
+                self._published(message_id)
+
+    def _next_packet_id(self):
+        with self._packet_lock:
+            self._packet_id = self._packet_id % 65535 + 1
+            return self._packet_id
+
+    def _write(self, data):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(data)
+
+    def _abort(self):
+        # Drops the connection without waiting for unsent data to drain,
+        # which never happens on a half-open link
+        if self._writer is not None:
+            self._writer.transport.abort()
+
+    def _close(self, send_disconnect=False):
+        if self._writer is None:
+            return
+        if send_disconnect and not self._writer.is_closing():
+            self._writer.write(packet(DISCONNECT, 0))
+        self._writer.close()
+
+    async def open(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.settings["broker"], int(self.settings["port"])), self.connect_timeout)
+        self._writer.write(connect_packet(self.settings.get("client_id", ""), self.settings.get("username", ""),
+                                          self.settings.get("password", ""), self.keepalive))
+        packet_type, flags, body = await asyncio.wait_for(read_packet(self._reader), self.connect_timeout)
+        if packet_type != CONNACK:
+            raise ConnectionError(f"expected CONNACK, got packet type {packet_type}")
+        if body[1] != 0:
+            raise ConnectionError(f"connection refused: {CONNACK_RESULTS.get(body[1], body[1])}")
+        self._last_inbound = time.monotonic()
+        self._received_qos2.clear()  # clean session: the broker resends nothing
+        self.connected = True
+        self.connected_once = True
+        self.backoff.reset()
+        self.restore_subscriptions()
+        self.resume_outbox()
+
+    async def incoming(self):
+        # Async iterator of (topic, payload, recv_ts); ends when the connection closes
+        while True:
+            try:
+                packet_type, flags, body = await read_packet(self._reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            self._last_inbound = time.monotonic()
+            if packet_type == PUBLISH:
+                recv_ts = time.time()
+                topic, payload, qos, packet_id = parse_publish(flags, body)
+                if qos == 2:
+                    # Delivered on PUBREL, so a PUBLISH resent before our
+                    # PUBREC arrived is stored once
+                    self._received_qos2.setdefault(packet_id, (topic, payload, recv_ts))
+                    self._write(ack_packet(PUBREC, packet_id))
+                    continue
+                if qos == 1:
+                    self._write(ack_packet(PUBACK, packet_id))
+                yield topic, payload, recv_ts
+            elif packet_type == SUBACK:
+                self._acknowledged(struct.unpack_from("!H", body)[0], list(body[2:]))
+            elif packet_type == UNSUBACK:
+                self._acknowledged(struct.unpack_from("!H", body)[0])
+            elif packet_type in (PUBACK, PUBCOMP):
+                self._published(struct.unpack("!H", body)[0])
+            elif packet_type == PUBREC:
+                self._write(ack_packet(PUBREL, struct.unpack("!H", body)[0]))
+            elif packet_type == PUBREL:
+                packet_id = struct.unpack("!H", body)[0]
+                self._write(ack_packet(PUBCOMP, packet_id))
+                message = self._received_qos2.pop(packet_id, None)
+                if message is not None:
+                    yield message
+
+    async def _keepalive(self):
+        # PINGREQ every keepalive/2. Like paho, a connection that has brought
+        # no packet (PINGRESP included) for 1.5 x keepalive is dropped, so a
+        # half-open link is reconnected instead of waiting for TCP to give up.
+        timeout = self.keepalive * 1.5
+        next_ping = time.monotonic() + self.keepalive / 2
+        while True:
+            await asyncio.sleep(max(0.0, min(next_ping, self._last_inbound + timeout) - time.monotonic()))
+            now = time.monotonic()
+            if now >= self._last_inbound + timeout:
+                print(f"Error on {self.name}: nothing received for {timeout:g} s, dropping the connection")
+                self._abort()
+                return
+            if now >= next_ping:
+                self._write(packet(PINGREQ, 0))
+                next_ping = now + self.keepalive / 2
+
+    async def run(self):
+        while True:
+            try:
+                await self.open()
+            except Exception as e:
+                self._close()
+                if not self.connected_once:
+                    self._error(f"failed to connect: {e}")
+                    return
+                print(f"Error on {self.name}: reconnect failed: {e}")
+            else:
+                try:
+                    await self.serve()
+                except Exception as e:
+                    # A malformed packet or a failing handler: serve() has
+                    # closed the connection, and it is reconnected below
+                    print(f"Error on {self.name}: connection dropped: {e!r}")
+            if self.stopping:
+                return
+            await asyncio.sleep(self._next_reconnect())
+            self.reconnect_at = None
+
+    async def serve(self):
+        self._notify()
+        keepalive = asyncio.ensure_future(self._keepalive()) if self.keepalive else None
+        try:
+            async for topic, payload, recv_ts in self.incoming():
+                self.deliver(topic, payload, recv_ts)
+        finally:
+            if keepalive is not None:
+                keepalive.cancel()
+            self._close()
+            self.connected = False
+            self._notify()
+            self._subscriptions_changed([topic for topic, qos in self.subscriptions.items()])
@@ -0,0 +1,138 @@
+import argparse
+import configparser
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.fake_broker import FakeBroker
+from connections import TRANSPORTS, ConnectionManager, mqtt
+from devices import DeviceRegistry
+from pipeline import IngestPipeline
+from storage import TelemetryWriter, initialize_database
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+
+def device_imeis(count):
+    return [str(356000000000000 + index) for index in range(count)]
+
+
+def device_traffic(imeis, messages, lines):
+    # IMEI on the first line, then CSV lines with the timestamp first, the
+    # format insert_telemetry_data parses. The send time is used as the CSV
+    # timestamp so the writer can compute end-to-end latency per row.
+    for counter in range(messages):
+        imei = imeis[counter % len(imeis)]
+        sent = time.time()
+        rows = "\n".join(f"{sent:.6f},{counter},{line},+45.00000,-73.00000,3.91" for line in range(lines))
+        yield f"devices/{imei}/telemetry", f"{imei}\n{rows}".encode()
+
+
+class LatencyWriter(TelemetryWriter):
+    # Records send-to-commit latency for every data row written
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.last_commit = None
+
+    def _flush(self, conn, pending, count):
+        if not super()._flush(conn, pending, count):
+            return False
+        committed = time.time()
+        self.last_commit = committed
+        self.latencies.extend(committed - float(row[1]) for row in pending.get('data', ()))
+        return True
+
+
+def percentile(values, fraction):
+    return values[int(fraction * (len(values) - 1))] if values else 0.0
+
+
+def run(args):
+    config = configparser.ConfigParser()
+    if args.config:
+        config.read(args.config)
+    database = os.path.join(tempfile.mkdtemp(prefix="bench_ingest_"), "bench.db")
+    initialize_database(database)
+
+    imeis = device_imeis(args.devices)
+    registry = DeviceRegistry()
+    registry.load((imei, f"devices/{imei}/read", "") for imei in imeis)
+    writer = LatencyWriter.from_config(config, database)
+    pipeline = IngestPipeline.from_config(config, writer, registry)
+    writer.start()
+    pipeline.start()
+
+    broker = FakeBroker().start()
+    manager = ConnectionManager(pipeline, transport=args.transport)
+    rss_before = max_rss_kb()
+    expected_rows = args.messages * args.lines
+    try:
+        manager.connect("bench", broker.settings(), topics=["devices/+/telemetry"])
+        if not broker.wait_for_subscriptions():
+            raise RuntimeError("client did not subscribe")
+        started = time.time()
+        broker.flood(device_traffic(imeis, args.messages, args.lines), args.rate).result()
+        deadline = time.monotonic() + args.timeout
+        while writer.stats()["rows_written"] < expected_rows and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        manager.disconnect_all()
+        broker.stop()
+        pipeline.stop()
+        writer.stop()
+
+    rows = writer.stats()["rows_written"]
+    elapsed = (writer.last_commit or time.time()) - started
+    latencies = sorted(writer.latencies)
+    return {
+        "transport": args.transport,
+        "devices": args.devices,
+        "messages": args.messages,
+        "lines": args.lines,
+        "target_rate": args.rate,
+        "rows_written": rows,
+        "rows_expected": expected_rows,
+        "dropped": sum(stage["dropped"] for stage in pipeline.stats().values()),
+        "messages_per_s": rows / args.lines / elapsed if elapsed > 0 else 0.0,
+        "rows_per_s": rows / elapsed if elapsed > 0 else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "latency_max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        "max_rss_growth_kb": max_rss_kb() - rss_before,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_ingest",
+                                     description="Replay synthetic device traffic through a local broker stand-in into the "
+                                                 "ingest pipeline and SQLite writer, and report throughput and latency.")
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--lines", type=int, default=1, help="CSV lines per message")
+    parser.add_argument("--rate", type=float, help="target messages/s (default: as fast as possible)")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="paho" if mqtt is not None else "asyncio")
+    parser.add_argument("--config", help="config.ini to take [Database] and [Pipeline] settings from")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the writer to catch up")
+    parser.add_argument("--json", help="append the result as one JSON line to this file")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    for key, value in result.items():
+        print(f"{key:>20}: {value:,.1f}" if isinstance(value, float) else f"{key:>20}: {value}")
+    if args.json:
+        result["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        with open(args.json, "a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
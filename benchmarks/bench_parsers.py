@@ -0,0 +1,78 @@
+import argparse
+import json
+import struct
+import time
+
+from parsers import CsvParser, JsonParser, RegexParser, StructParser, parse_fields
+
+TELEMETRY_FIELDS = "timestamp:str, counter:int, line:int, latitude:float, longitude:float, voltage:float"
+
+
+def csv_case(lines):
+    parser = CsvParser("telemetry", "#", parse_fields(TELEMETRY_FIELDS))
+    rows = "\n".join(f"1700000000.{line},{line},{line},+45.50000,-73.56000,3.91" for line in range(lines))
+    return parser, f"356000000000000\n{rows}"
+
+
+def json_case(lines):
+    parser = JsonParser("status", "#", parse_fields("imei:str, timestamp:float, temp__value:float, battery:int"))
+    document = [{"imei": "356000000000000", "timestamp": 1700000000 + line, "temp": {"value": 21.5}, "battery": 90}
+                for line in range(lines)]
+    return parser, json.dumps(document)
+
+
+def struct_case(lines):
+    parser = StructParser("beacon", "#", parse_fields("timestamp:int, latitude:float, longitude:float, battery:int"),
+                          layout="<IffH")
+    return parser, struct.pack("<IffH", 1700000000, 45.5, -73.56, 90) * lines
+
+
+def regex_case(lines):
+    parser = RegexParser("gps", "#", parse_fields("fix:str, latitude:float, longitude:float"),
+                         pattern=r"^(?P<fix>[^,]*),(?P<latitude>[+-][\d.]+),(?P<longitude>[+-][\d.]+)$")
+    rows = "\n".join("1,+45.50000,-73.56000" for line in range(lines))
+    return parser, f"356000000000000\n{rows}"
+
+
+def legacy_split(payload):
+    # What insert_telemetry_data and map_data did before the parsers
+    lines = payload.strip().split('\n')
+    return [line.strip().split(',') for line in lines[1:]]
+
+
+CASES = {"csv": csv_case, "json": json_case, "struct": struct_case, "regex": regex_case}
+
+
+def measure(function, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_parsers",
+                                     description="Per-parser decode throughput, one message at a time and as a columnar batch.")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--lines", type=int, default=1, help="records per message")
+    parser.add_argument("--batch", type=int, default=500, help="messages per decode_batch call")
+    parser.add_argument("--parser", choices=CASES, action="append")
+    args = parser.parse_args(argv)
+
+    for name in args.parser or CASES:
+        case_parser, payload = CASES[name](args.lines)
+        records = args.messages * args.lines
+        single = measure(lambda: case_parser.records("devices/356000000000000/x", payload, ""), args.messages)
+        batches = max(1, args.messages // args.batch)
+        batch = [payload] * args.batch
+        columnar = measure(lambda: case_parser.decode_batch(batch), batches)
+        print(f"{name:>6}: {args.messages / single:>10,.0f} msg/s  {records / single:>10,.0f} records/s (records)  "
+              f"{batches * args.batch * args.lines / columnar:>10,.0f} records/s (decode_batch)")
+    if not args.parser or "csv" in args.parser:
+        payload = csv_case(args.lines)[1]
+        legacy = measure(lambda: legacy_split(payload), args.messages)
+        print(f"{'split':>6}: {args.messages / legacy:>10,.0f} msg/s  (untyped str.split baseline)")
+
+
+if __name__ == "__main__":
+    main()
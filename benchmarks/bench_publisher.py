@@ -0,0 +1,59 @@
+import argparse
+import time
+
+from benchmarks.bench_transport import CountingPipeline
+from benchmarks.fake_broker import FakeBroker
+from connections import TRANSPORTS, ConnectionManager, mqtt
+from publisher import DEFAULT_PAYLOAD, DEFAULT_TOPIC, PublishEngine
+
+
+def run(transport, count, rate, qos, devices, max_in_flight):
+    broker = FakeBroker().start()
+    pipeline = CountingPipeline(count)
+    manager = ConnectionManager(pipeline, transport=transport)
+    try:
+        # A second session subscribes, so the messages make the whole round trip
+        manager.connect("sink", broker.settings(f"sink-{transport}"), topics=["devices/#"])
+        if not broker.wait_for_subscriptions():
+            raise RuntimeError("client did not subscribe")
+        session = manager.connect("bench", broker.settings(f"bench-{transport}"))
+        deadline = time.monotonic() + 10
+        while not session.connected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        engine = PublishEngine(session, DEFAULT_TOPIC, DEFAULT_PAYLOAD, rate=rate, qos=qos, devices=devices,
+                               max_in_flight=max_in_flight, count=count)
+        engine.start()
+        engine.thread.join()
+        pipeline.done.wait(30)
+        return engine, pipeline
+    finally:
+        manager.disconnect_all()
+        broker.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_publisher",
+                                     description="Run the Publish tab's simulator against a local broker stand-in.")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=5000, help="target messages/s")
+    parser.add_argument("--qos", type=int, choices=(0, 1, 2), action="append",
+                        help="repeat for several runs (default: 0 and 1)")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--max-in-flight", type=int, default=100)
+    parser.add_argument("--transport", choices=TRANSPORTS, action="append")
+    args = parser.parse_args(argv)
+
+    for transport in args.transport or TRANSPORTS:
+        if transport == "paho" and mqtt is None:
+            print("paho: skipped, paho-mqtt is not installed")
+            continue
+        for qos in args.qos or (0, 1):
+            engine, pipeline = run(transport, args.messages, args.rate, qos, args.devices, args.max_in_flight)
+            stats = engine.stats()
+            print(f"{transport} QoS {qos}: sent {stats['sent']} at {stats['average_rate']:,.0f}/s "
+                  f"(target {args.rate:,.0f}/s), acked {stats['acked']}, received {pipeline.received}, "
+                  f"ack latency p50 <= {stats['p50_ms']:g} ms, p99 <= {stats['p99_ms']:g} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import argparse
+import time
+
+from devices import DeviceRegistry
+from topics import topic_matches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_topics",
+                                     description="Read-topic lookups per second through the topic trie against a linear scan.")
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    rows = [(str(356000000000000 + index), f"fleet/{index}/reply", "") for index in range(args.devices)]
+    rows.append(("356999999999999", "fleet/+/reply", ""))  # one wildcard registration
+    registry = DeviceRegistry()
+    registry.load(rows)
+    topics = [f"fleet/{index % args.devices}/reply" for index in range(args.lookups)]
+
+    started = time.perf_counter()
+    for topic in topics:
+        registry.by_read_topic(topic)
+    trie = args.lookups / (time.perf_counter() - started)
+
+    linear_lookups = max(1, args.lookups // 100)
+    started = time.perf_counter()
+    for topic in topics[:linear_lookups]:
+        [imei for imei, read_topic, comments in rows if topic_matches(read_topic, topic)]
+    linear = linear_lookups / (time.perf_counter() - started)
+    print(f"{args.devices} devices: trie {trie:,.0f} lookups/s, linear scan {linear:,.0f} lookups/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import threading
+import time
+
+from benchmarks.fake_broker import FakeBroker
+from connections import TRANSPORTS, ConnectionManager, mqtt
+
+
+class CountingPipeline:
+    # Stands in for IngestPipeline so only the transport is measured
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.first = None
+        self.last = None
+        self.done = threading.Event()
+
+    def enqueue(self, topic, payload, recv_ts=None, broker=None):
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.received += 1
+        if self.received >= self.expected:
+            self.last = time.perf_counter()
+            self.done.set()
+
+
+def run(transport, count, size):
+    broker = FakeBroker().start()
+    pipeline = CountingPipeline(count)
+    manager = ConnectionManager(pipeline, transport=transport)
+    try:
+        manager.connect("bench", broker.settings(f"bench-{transport}"), topics=["bench/#"])
+        if not broker.wait_for_subscriptions():
+            raise RuntimeError("client did not subscribe")
+        payload = b"x" * size
+        broker.flood((f"bench/{i % 100}", payload) for i in range(count))
+        if not pipeline.done.wait(60):
+            raise RuntimeError(f"only {pipeline.received}/{count} messages arrived")
+        return count / (pipeline.last - pipeline.first)
+    finally:
+        manager.disconnect_all()
+        broker.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_transport",
+                                     description="Compare receive throughput of the paho and asyncio transports against a local broker stand-in.")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=100, help="payload size in bytes")
+    parser.add_argument("--transport", choices=TRANSPORTS, action="append")
+    args = parser.parse_args(argv)
+
+    for transport in args.transport or TRANSPORTS:
+        if transport == "paho" and mqtt is None:
+            print("paho: skipped, paho-mqtt is not installed")
+            continue
+        rate = run(transport, args.messages, args.size)
+        print(f"{transport}: {rate:,.0f} messages/s ({args.messages} x {args.size} bytes)")
+
+
+if __name__ == "__main__":
+    main()
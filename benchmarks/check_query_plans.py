@@ -0,0 +1,83 @@
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+
+from storage import (PagedQuery, PartitionStore, data_sources, explain,
+                     full_scans, gps_fixes_query, initialize_database,
+                     temp_sorts)
+
+RANGE = ('2024-01-01 00:00:00', '2024-01-31 23:59:59')
+
+
+def queries(path, partition=False):
+    # Every statement the GUI runs against the telemetry tables, with and
+    # without a time range. Partition files only hold data and commands.
+    for table in PagedQuery.TABLES:
+        for column in PagedQuery.COLUMNS:
+            for start, end in ((None, None), RANGE):
+                query = PagedQuery(table, column, 'x', path=path, start=start, end=end)
+                yield f"page {table}.{column}{' ranged' if start else ''}", query.chunk_sql()
+                query.last_timestamp = start
+                query.last_id = 1
+                yield f"next page {table}.{column}{' ranged' if start else ''}", query.chunk_sql()
+                yield f"count {table}.{column}{' ranged' if start else ''}", query.count_sql()
+    if partition:
+        return
+    yield "map track", gps_fixes_query('x')
+    yield "map track update", gps_fixes_query('x', 100)
+
+
+def check(path):
+    # Returns the queries whose plan reads a whole table or sorts every
+    # matching row, in the main file or any partition
+    failures = []
+    for source in data_sources(path):
+        partition = source != path
+        conn = sqlite3.connect(source)
+        try:
+            for name, (sql, params) in queries(path, partition):
+                name = f"{name}{f' ({os.path.basename(source)})' if partition else ''}"
+                plan = explain(conn, sql, params)
+                problems = full_scans(plan, ('data', 'commands', 'gps_fixes')) + temp_sorts(plan)
+                print(f"{'FAIL' if problems else 'ok  '} {name}: {'; '.join(plan)}")
+                if problems:
+                    failures.append(name)
+        finally:
+            conn.close()
+    return failures
+
+
+def build_database(path):
+    # A database with every migration applied and one partition, so the
+    # partition schema is checked too
+    initialize_database(path)
+    conn = sqlite3.connect(path)
+    try:
+        PartitionStore(path).attach(conn)
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.check_query_plans",
+                                     description="Fail if any GUI query against the telemetry tables falls back to a "
+                                                 "full table scan or a sort of every matching row.")
+    parser.add_argument("--database", help="database to check (default: a fresh one with every migration applied)")
+    args = parser.parse_args(argv)
+
+    path = args.database or os.path.join(tempfile.mkdtemp(prefix="query_plans_"), "plans.db")
+    if args.database:
+        initialize_database(path)
+    else:
+        build_database(path)
+    failures = check(path)
+    if failures:
+        print(f"{len(failures)} queries scan a whole table or sort all matches: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
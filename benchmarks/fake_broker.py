@@ -0,0 +1,138 @@
+import asyncio
+import struct
+import threading
+
+from async_transport import (CONNACK, CONNECT, DISCONNECT, PINGREQ, PINGRESP,
+                             PUBACK, PUBCOMP, PUBLISH, PUBREC, PUBREL, SUBACK,
+                             SUBSCRIBE, UNSUBACK, UNSUBSCRIBE, EventLoopThread,
+                             ack_packet, packet, parse_publish, publish_packet,
+                             read_packet)
+from topics import topic_matches
+
+
+def parse_topic_list(body, with_qos):
+    topics = []
+    position = 2
+    while position < len(body):
+        length = struct.unpack_from("!H", body, position)[0]
+        position += 2
+        topic = body[position:position + length].decode("utf-8")
+        position += length
+        if with_qos:
+            topics.append((topic, body[position]))
+            position += 1
+        else:
+            topics.append((topic, 0))
+    return topics
+
+
+class FakeClient:
+    def __init__(self, writer):
+        self.writer = writer
+        self.subscriptions = {}
+
+
+class FakeBroker:
+    # Minimal in-process MQTT 3.1.1 broker for benchmarks. Accepts any
+    # CONNECT, routes PUBLISH to matching subscribers at QoS 0 and can inject
+    # messages itself with publish()/flood() so load generation doesn't need
+    # a second client.
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.loop_thread = EventLoopThread()
+        self.clients = set()
+        self.server = None
+        self.subscribed = threading.Condition()
+
+    def start(self):
+        self.loop_thread.start()
+        self.server = self.loop_thread.submit(
+            asyncio.start_server(self._handle_client, self.host, self.port)).result()
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        async def close():
+            self.server.close()
+            for client in list(self.clients):
+                client.writer.close()
+        self.loop_thread.submit(close()).result()
+        self.loop_thread.stop()
+
+    def settings(self, client_id="bench"):
+        return {"broker": self.host, "port": self.port, "username": "", "password": "", "client_id": client_id}
+
+    def wait_for_subscriptions(self, count=1, timeout=10):
+        with self.subscribed:
+            return self.subscribed.wait_for(
+                lambda: sum(len(client.subscriptions) for client in list(self.clients)) >= count, timeout)
+
+    def publish(self, topic, payload):
+        self.loop_thread.call(self._route, topic, payload)
+
+    def flood(self, messages, rate=None):
+        # messages: iterable of (topic, payload); rate in messages/s, None for as fast as possible
+        return self.loop_thread.submit(self._flood(messages, rate))
+
+    async def _flood(self, messages, rate):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for sent, (topic, payload) in enumerate(messages, 1):
+            self._route(topic, payload)
+            if rate:
+                delay = start + sent / rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if sent % 256 == 0:
+                for client in list(self.clients):
+                    await client.writer.drain()
+        return loop.time() - start
+
+    def _route(self, topic, payload):
+        data = None
+        for client in self.clients:
+            for topic_filter in client.subscriptions:
+                if topic_matches(topic_filter, topic):
+                    if data is None:
+                        data = publish_packet(topic, payload)
+                    client.writer.write(data)
+                    break
+
+    async def _handle_client(self, reader, writer):
+        client = FakeClient(writer)
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == CONNECT:
+                    self.clients.add(client)
+                    writer.write(packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == SUBSCRIBE:
+                    topics = parse_topic_list(body, with_qos=True)
+                    with self.subscribed:
+                        client.subscriptions.update(topics)
+                        self.subscribed.notify_all()
+                    granted = bytes(qos for topic, qos in topics)
+                    writer.write(packet(SUBACK, 0, body[:2] + granted))
+                elif packet_type == UNSUBSCRIBE:
+                    for topic, qos in parse_topic_list(body, with_qos=False):
+                        client.subscriptions.pop(topic, None)
+                    writer.write(packet(UNSUBACK, 0, body[:2]))
+                elif packet_type == PUBLISH:
+                    topic, payload, qos, packet_id = parse_publish(flags, body)
+                    if qos == 1:
+                        writer.write(ack_packet(PUBACK, packet_id))
+                    elif qos == 2:
+                        writer.write(ack_packet(PUBREC, packet_id))
+                    self._route(topic, payload)
+                elif packet_type == PUBREL:
+                    writer.write(ack_packet(PUBCOMP, struct.unpack("!H", body)[0]))
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP, 0))
+                elif packet_type == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(client)
+            writer.close()
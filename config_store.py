@@ -0,0 +1,112 @@
+import configparser
+import os
+import threading
+from contextlib import contextmanager
+
+CONFIG_PATH = "config.ini"
+
+
+class ConfigStore:
+    # config.ini read once and shared by every tab. Edits go through edit(),
+    # which marks the store dirty and schedules a save; saves made within
+    # delay seconds of each other are written once. The file is replaced
+    # atomically (temp file + os.replace), so a crash mid-write leaves the
+    # old file intact. check() reloads the file if something else changed it.
+    # The save runs on a timer thread: edit(), read(), flush() and check()
+    # all hold the store's lock.
+    def __init__(self, path=CONFIG_PATH, delay=0.5):
+        self.path = path
+        self.delay = delay
+        self.config = configparser.ConfigParser()
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.timer = None
+        self.listeners = []
+        self.writes = 0
+        self.stamp = None
+        self.load()
+
+    def file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        # Reloads in place so anything holding self.config sees the new values
+        with self.lock:
+            for section in self.config.sections():
+                self.config.remove_section(section)
+            self.config.defaults().clear()
+            self.config.read(self.path)
+            self.stamp = self.file_stamp()
+            self.dirty = False
+
+    @contextmanager
+    def edit(self):
+        # with configStore.edit() as config: ... changes are saved shortly after
+        with self.lock:
+            yield self.config
+            self.dirty = True
+            self.schedule()
+
+    @contextmanager
+    def read(self):
+        # with configStore.read() as config: ... for lookups that walk several
+        # keys or sections, so a reload or an edit never shows half done
+        with self.lock:
+            yield self.config
+
+    def schedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(self.delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty:
+                return
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, "w") as configfile:
+                    self.config.write(configfile)
+                    configfile.flush()
+                    os.fsync(configfile.fileno())
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print(f"Error: could not save {self.path}: {e}")
+                return
+            self.dirty = False
+            self.writes += 1
+            self.stamp = self.file_stamp()
+
+    def add_listener(self, callback):
+        # callback() runs after the file was reloaded by check()
+        self.listeners.append(callback)
+
+    def check(self):
+        # Reloads the file if it was changed outside the application. Edits
+        # not saved yet win over the external change and are written first.
+        # The stamp is compared under the lock, so a save in progress on the
+        # timer thread is not mistaken for an outside change.
+        with self.lock:
+            stamp = self.file_stamp()
+            if stamp == self.stamp or stamp is None:
+                return False
+            if self.dirty:
+                print(f"Error: {self.path} changed on disk while edits were pending, keeping the edits")
+                self.flush()
+                return False
+            self.load()
+        for callback in list(self.listeners):
+            callback()
+        return True
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,2 @@
+# Lets tests import the top-level modules and the benchmarks package
+# when pytest is run from the repository root
@@ -0,0 +1,473 @@
+import random
+import threading
+import time
+
+from metrics import registry
+from outbox import OUTBOX_PATH, Outbox
+from subscriptions import SubscriptionManager
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:  # only the asyncio transport is available without paho
+    mqtt = None
+
+
+TRANSPORTS = ("paho", "asyncio")
+
+PUBLISHED = registry.counter("mqtt_published_total", "Messages published or queued, per broker", ("broker",))
+RECONNECTS = registry.counter("mqtt_reconnect_attempts_total", "Reconnect attempts, per broker", ("broker",))
+
+
+class Backoff:
+    # Exponential backoff with jitter: attempt n waits between half and all
+    # of min(maximum, initial * 2 ** n) seconds, so clients cut off together
+    # do not all come back at the same moment
+    def __init__(self, initial=1.0, maximum=60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.attempts = 0
+
+    def next_delay(self):
+        ceiling = min(self.maximum, self.initial * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class SessionBase:
+    # State and statistics shared by the paho and asyncio sessions. Received
+    # messages are tagged with the session name and handed to the shared
+    # ingest pipeline.
+    def __init__(self, name, settings, pipeline, on_state_change=None, on_error=None):
+        self.name = name
+        self.settings = settings
+        self.pipeline = pipeline
+        self.on_state_change = on_state_change
+        self.on_error = on_error
+        self.on_subscription_change = None
+        self.on_published = None  # on_published(message_id), see publisher.PublishEngine
+        self.connected = False
+        self.stopping = False  # set by disconnect(), nothing is reconnected after it
+        self.connected_once = False  # failures before the first connect are reported, later ones retried
+        self.backoff = Backoff()
+        self.reconnect_at = None
+        self.subscriptions = SubscriptionManager()  # restored on every (re)connect
+        # Publishes made while offline wait in the outbox and are sent once
+        # reconnected, with at most window of them unacknowledged at a time
+        self.outbox = None
+        self.window = 20
+        self.in_flight = {}  # message id -> outbox row id
+        self.acked_early = set()
+        self.last_queued = 0
+        self._draining = False
+        self._drain_again = False
+        self._drain_lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.published_total = PUBLISHED.labels(name)
+        self._second = 0
+        self._second_count = 0
+        self._last_second_count = 0
+
+    def rate(self):
+        # Messages received during the last complete second
+        if int(time.monotonic()) > self._second + 1:
+            return 0
+        return self._last_second_count
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "rate": self.rate(),
+            "subscriptions": len(self.subscriptions),
+            "queued": self.outbox.count(self.name) if self.outbox is not None else 0,
+            "in_flight": len(self.in_flight),
+            "reconnect_in": max(0.0, self.reconnect_at - time.monotonic()) if self.reconnect_at is not None else None,
+            "attempts": self.backoff.attempts,
+        }
+
+    def _notify(self):
+        if self.on_state_change is not None:
+            self.on_state_change(self.name, self.connected)
+
+    def _error(self, message):
+        print(f"Error on {self.name}: {message}")
+        if self.on_error is not None:
+            self.on_error(self.name, message)
+
+    def subscribe(self, topic, qos=0):
+        self.subscribe_many([(topic, qos)])
+
+    def unsubscribe(self, topic):
+        self.unsubscribe_many([topic])
+
+    def subscribe_many(self, pairs):
+        # One SUBSCRIBE packet per batch of (topic, qos)
+        for batch in self.subscriptions.add(pairs):
+            if self.connected:
+                self._send_subscribe(batch)
+        self._subscriptions_changed([topic for topic, qos in pairs])
+
+    def unsubscribe_many(self, topics):
+        for batch in self.subscriptions.remove(topics):
+            if self.connected:
+                self._send_unsubscribe(batch)
+        self._subscriptions_changed(list(topics))
+
+    def restore_subscriptions(self):
+        for batch in self.subscriptions.restore():
+            self._send_subscribe(batch)
+
+    def _acknowledged(self, packet_id, return_codes=()):
+        self._subscriptions_changed(self.subscriptions.acknowledged(packet_id, return_codes))
+
+    def _subscriptions_changed(self, topics):
+        if topics and self.on_subscription_change is not None:
+            self.on_subscription_change(self.name, topics)
+
+    def publish(self, topic, payload, qos=0, retain=False, queue=True):
+        # Offline, or while older messages are still queued, the message goes
+        # to the outbox so everything reaches the broker in order. With
+        # queue=False it is sent now or not at all (None is returned).
+        if queue and self.outbox is not None and (not self.connected or self.outbox.count(self.name)):
+            self.published_total.inc()
+            self.outbox.put(self.name, topic, payload, qos, retain)
+            self._drain()
+            return None
+        if not self.connected:
+            if queue:
+                print(f"Error on {self.name}: not connected, message to {topic} dropped")
+            return None
+        message_id = self._publish(topic, payload, qos, retain)
+        if message_id is not None:
+            self.published_total.inc()
+        return message_id
+
+    def resume_outbox(self):
+        # After a (re)connect unacknowledged messages are sent again
+        with self._drain_lock:
+            self.in_flight.clear()
+            self.acked_early.clear()
+            self.last_queued = 0
+        self._drain()
+
+    def _drain(self):
+        # One thread drains at a time; a _drain() call made meanwhile makes
+        # it go round again. Rows are reserved under _drain_lock and sent
+        # outside it: paho calls on_publish -> _published with its own
+        # message lock held, and its publish() takes that lock too.
+        if self.outbox is None:
+            return
+        with self._drain_lock:
+            if self._draining:
+                self._drain_again = True
+                return
+            self._draining = True
+        try:
+            while True:
+                with self._drain_lock:
+                    room = self.window - len(self.in_flight)
+                    rows = self.outbox.peek(self.name, self.last_queued, room) if self.connected and room > 0 else []
+                    if not rows and not self._drain_again:
+                        self._stop_draining()
+                        return
+                    self._drain_again = False
+                    if rows:
+                        self.last_queued = rows[-1][0]
+                if not self._send_rows(rows):
+                    with self._drain_lock:
+                        self._stop_draining()
+                    return
+        except BaseException:
+            with self._drain_lock:
+                self._stop_draining()
+            raise
+
+    def _send_rows(self, rows):
+        for index, (row_id, topic, payload, qos, retain) in enumerate(rows):
+            # _publish returns the id to wait for, 0 when there is nothing
+            # to wait for, None when it could not send
+            message_id = self._publish(topic, payload, qos, retain)
+            with self._drain_lock:
+                if message_id is None:
+                    # This row and the ones after it are sent on the next drain
+                    self.last_queued = rows[index - 1][0] if index else row_id - 1
+                    return False
+                if message_id and message_id not in self.acked_early:
+                    self.in_flight[message_id] = row_id
+                else:
+                    self.acked_early.discard(message_id)
+                    self.outbox.remove(self.name, row_id)
+        return True
+
+    def _stop_draining(self):
+        # Called with _drain_lock held. Every id acknowledged early has been
+        # matched by now; what is left belongs to other publishes.
+        self._draining = False
+        self._drain_again = False
+        self.acked_early.clear()
+
+    def _published(self, message_id):
+        # The broker acknowledged a message (paho at QoS 0: the message was sent)
+        if self.on_published is not None:
+            self.on_published(message_id)
+        with self._drain_lock:
+            row_id = self.in_flight.pop(message_id, None)
+            if row_id is None:
+                if self._draining:
+                    self.acked_early.add(message_id)  # acknowledged before _drain recorded it
+                return
+            self.outbox.remove(self.name, row_id)
+        self._drain()
+
+    def _next_reconnect(self):
+        # Seconds to wait before the next attempt; stats() counts them down
+        delay = self.backoff.next_delay()
+        RECONNECTS.labels(self.name).inc()
+        print(f"{self.name}: reconnecting in {delay:.1f} s (attempt {self.backoff.attempts})")
+        self.reconnect_at = time.monotonic() + delay
+        return delay
+
+    def deliver(self, topic, payload, recv_ts=None):
+        second = int(time.monotonic())
+        if second != self._second:
+            self._last_second_count = self._second_count if second == self._second + 1 else 0
+            self._second = second
+            self._second_count = 0
+        self._second_count += 1
+        self.messages += 1
+        self.bytes += len(payload)
+        self.pipeline.enqueue(topic, payload, recv_ts, broker=self.name)
+
+
+class BrokerSession(SessionBase):
+    # One paho client and its network thread (loop_start). A lost connection
+    # is retried with backoff until disconnect() is called.
+    def __init__(self, name, settings, pipeline, on_state_change=None, on_error=None):
+        super().__init__(name, settings, pipeline, on_state_change, on_error)
+        self.client = mqtt.Client(client_id=settings.get("client_id", ""))
+        if settings.get("username"):
+            self.client.username_pw_set(settings["username"], settings.get("password", ""))
+        self.client.on_connect = self._on_connect
+        self.client.on_connect_fail = self._on_connect_fail
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_unsubscribe = self._on_unsubscribe
+        self.client.on_publish = self._on_publish
+        # Held while a packet is sent and its mid recorded, so an acknowledgement
+        # handled on the network thread never arrives before the record
+        self._send_lock = threading.Lock()
+
+    def connect(self):
+        self.client.connect(self.settings["broker"], int(self.settings["port"]))
+        self.client.loop_start()
+
+    def disconnect(self):
+        self.stopping = True
+        self.client.disconnect()
+        self.client.loop_stop()
+        if self.connected:
+            self.connected = False
+            self._notify()
+
+    def _schedule_reconnect(self):
+        # paho's loop thread reconnects by itself, doubling an unjittered
+        # delay; setting min = max to our next delay before it waits gives
+        # the reconnects the Backoff's jitter
+        if not self.stopping:
+            delay = self._next_reconnect()
+            self.client.reconnect_delay_set(delay, delay)
+
+    def _send_subscribe(self, batch):
+        with self._send_lock:
+            rc, mid = self.client.subscribe(batch)
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                self.subscriptions.sent(mid, "subscribe", batch)
+
+    def _send_unsubscribe(self, batch):
+        with self._send_lock:
+            rc, mid = self.client.unsubscribe(batch)
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                self.subscriptions.sent(mid, "unsubscribe", batch)
+
+    def _publish(self, topic, payload, qos=0, retain=False):
+        # paho reports every QoS through on_publish
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        return info.mid if info.rc == mqtt.MQTT_ERR_SUCCESS else None
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            if self.connected_once:
+                print(f"Error on {self.name}: connection refused: {mqtt.connack_string(rc)}")
+            else:
+                self._error(f"connection refused: {mqtt.connack_string(rc)}")
+            return
+        self.connected = True
+        self.connected_once = True
+        self.reconnect_at = None
+        self.backoff.reset()
+        self.restore_subscriptions()
+        self.resume_outbox()
+        self._notify()
+
+    def _on_connect_fail(self, client, userdata):
+        print(f"Error on {self.name}: reconnect failed")
+        self._schedule_reconnect()
+
+    def _on_publish(self, client, userdata, mid):
+        self._published(mid)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        with self._send_lock:
+            self._acknowledged(mid, granted_qos)
+
+    def _on_unsubscribe(self, client, userdata, mid):
+        with self._send_lock:
+            self._acknowledged(mid)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._schedule_reconnect()
+        if not self.connected:
+            return
+        self.connected = False
+        self._notify()
+        self._subscriptions_changed([topic for topic, qos in self.subscriptions.items()])
+
+    def _on_message(self, client, userdata, message):
+        self.deliver(message.topic, message.payload)
+
+
+class ConnectionManager:
+    # Keeps any number of concurrent broker sessions, keyed by broker name.
+    # With the asyncio transport all sessions share one event loop thread and
+    # connect() returns immediately; failures arrive through on_error.
+    def __init__(self, pipeline, on_state_change=None, transport="paho", on_error=None, outbox=None,
+                 window=20, reconnect_min=1.0, reconnect_max=60.0):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        self.pipeline = pipeline
+        self.outbox = outbox
+        self.window = window
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.on_state_change = on_state_change
+        self.on_error = on_error
+        self.on_subscription_change = None
+        self.transport = transport
+        self.loop_thread = None
+        self._lock = threading.Lock()
+        self.sessions = {}
+        # The sessions count received messages already; read when scraped
+        registry.counter("mqtt_received_total", "Messages received, per broker", ("broker",),
+                         function=lambda: {name: stats["messages"] for name, stats in self.stats().items()})
+        registry.counter("mqtt_received_bytes_total", "Payload bytes received, per broker", ("broker",),
+                         function=lambda: {name: stats["bytes"] for name, stats in self.stats().items()})
+        registry.gauge("mqtt_broker_connected", "1 while the broker session is connected", ("broker",),
+                       function=lambda: {name: int(stats["connected"]) for name, stats in self.stats().items()})
+        registry.gauge("mqtt_broker_subscriptions", "Topics the session wants subscribed", ("broker",),
+                       function=lambda: {name: stats["subscriptions"] for name, stats in self.stats().items()})
+        registry.gauge("mqtt_outbox_queued", "Messages waiting in the outbox", ("broker",),
+                       function=lambda: {name: stats["queued"] for name, stats in self.stats().items()})
+        registry.gauge("mqtt_outbox_in_flight", "Outbox messages waiting for their acknowledgement", ("broker",),
+                       function=lambda: {name: stats["in_flight"] for name, stats in self.stats().items()})
+        self.restored = {}  # name -> subscriptions of the last session, resubscribed on the next connect
+
+    @classmethod
+    def from_config(cls, config, pipeline, on_state_change=None, transport=None):
+        section = config["Connection"] if "Connection" in config else {}
+        outbox_path = section.get("outbox", OUTBOX_PATH)
+        return cls(pipeline, on_state_change, transport=transport or section.get("transport", "paho"),
+                   outbox=Outbox(outbox_path) if outbox_path else None,
+                   window=int(section.get("max_in_flight", 20)),
+                   reconnect_min=float(section.get("reconnect_min", 1)),
+                   reconnect_max=float(section.get("reconnect_max", 60)))
+
+    def set_state_callback(self, callback):
+        self.on_state_change = callback
+
+    def set_error_callback(self, callback):
+        self.on_error = callback
+
+    def set_subscription_callback(self, callback):
+        # callback(name, topics) when topics were (un)subscribed or acknowledged
+        self.on_subscription_change = callback
+
+    def _subscription_change(self, name, topics):
+        if self.on_subscription_change is not None:
+            self.on_subscription_change(name, topics)
+
+    def _session_error(self, name, message):
+        # A session that never got connected is dropped so it can be retried
+        with self._lock:
+            session = self.sessions.get(name)
+            if session is not None and not session.connected:
+                del self.sessions[name]
+                self.restored[name] = session.subscriptions.items()
+            else:
+                session = None
+        if session is not None:
+            session.disconnect()
+        if self.on_error is not None:
+            self.on_error(name, message)
+
+    def _create_session(self, name, settings):
+        if self.transport == "asyncio":
+            from async_transport import AsyncBrokerSession, EventLoopThread
+            if self.loop_thread is None:
+                self.loop_thread = EventLoopThread()
+                self.loop_thread.start()
+            return AsyncBrokerSession(name, settings, self.pipeline, self.on_state_change,
+                                      self._session_error, loop_thread=self.loop_thread)
+        return BrokerSession(name, settings, self.pipeline, self.on_state_change, self._session_error)
+
+    def connect(self, name, settings, topics=()):
+        # topics: names (QoS 0) or (topic, qos) pairs, subscribed once connected
+        self.disconnect(name)
+        session = self._create_session(name, settings)
+        session.on_subscription_change = self._subscription_change
+        session.outbox = self.outbox
+        session.window = self.window
+        session.backoff = Backoff(self.reconnect_min, self.reconnect_max)
+        wanted = dict(self.restored.pop(name, ()))
+        wanted.update((topic, 0) if isinstance(topic, str) else topic for topic in topics)
+        session.subscriptions.add(wanted.items())
+        with self._lock:
+            self.sessions[name] = session
+        try:
+            session.connect()
+        except Exception:
+            with self._lock:
+                self.sessions.pop(name, None)
+            raise
+        return session
+
+    def disconnect(self, name):
+        with self._lock:
+            session = self.sessions.pop(name, None)
+        if session is not None:
+            self.restored[name] = session.subscriptions.items()
+            session.disconnect()
+
+    def disconnect_all(self):
+        for name in self.names():
+            self.disconnect(name)
+        if self.loop_thread is not None:
+            self.loop_thread.stop()
+            self.loop_thread = None
+
+    def get(self, name):
+        return self.sessions.get(name)
+
+    def names(self):
+        with self._lock:
+            return list(self.sessions)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self.sessions.values())
+        return {session.name: session.stats() for session in sessions}
@@ -0,0 +1,68 @@
+import threading
+
+from topics import TopicTrie
+
+
+class Device:
+    __slots__ = ("imei", "read_topic", "comments")
+
+    def __init__(self, imei, read_topic, comments):
+        self.imei = imei
+        self.read_topic = read_topic
+        self.comments = comments
+
+
+class DeviceRegistry:
+    # Registered devices indexed by IMEI and by read topic. Shared between the
+    # Qt thread (Devices tab) and the MQTT thread (ingest), so every mutation
+    # and lookup that touches both indexes happens under the lock. Read topics
+    # may use MQTT wildcards ("fleet/+/reply").
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_imei = {}
+        self._by_topic = TopicTrie()
+
+    def load(self, rows):
+        with self._lock:
+            self._by_imei.clear()
+            self._by_topic.clear()
+            for imei, read_topic, comments in rows:
+                self._add(imei, read_topic, comments)
+
+    def add(self, imei, read_topic, comments):
+        with self._lock:
+            if imei in self._by_imei:
+                return None
+            return self._add(imei, read_topic, comments)
+
+    def _add(self, imei, read_topic, comments):
+        if imei in self._by_imei:
+            return None
+        device = Device(imei, read_topic, comments)
+        self._by_imei[imei] = device
+        if read_topic:
+            self._by_topic.insert(read_topic, device)
+        return device
+
+    def remove(self, imei):
+        with self._lock:
+            device = self._by_imei.pop(imei, None)
+            if device is not None and device.read_topic:
+                self._by_topic.remove(device.read_topic, device)
+            return device
+
+    def get(self, imei):
+        return self._by_imei.get(imei)
+
+    def by_read_topic(self, topic):
+        return tuple(self._by_topic.match(topic))
+
+    def __contains__(self, imei):
+        return imei in self._by_imei
+
+    def __len__(self):
+        return len(self._by_imei)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_imei.values()))
@@ -0,0 +1,91 @@
+import csv
+import importlib
+from datetime import datetime
+
+FORMATS = ('csv', 'parquet')
+HEADER = ["IMEI", "Timestamp", "Message", "Topic"]
+TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%d/%m/%Y %H:%M:%S")
+
+
+def format_for(path):
+    return 'parquet' if path.lower().endswith(('.parquet', '.pq')) else 'csv'
+
+
+def parse_timestamp(value):
+    # Device timestamps are free-form: epoch seconds, or one of the usual
+    # date formats. Anything else becomes null and the raw text is kept.
+    # Every result is naive local time, like the timestamps the client
+    # writes, so one column never mixes time zones.
+    if value is None:
+        return None
+    text = str(value).strip()
+    try:
+        return datetime.fromtimestamp(float(text))
+    except (ValueError, OverflowError, OSError):
+        pass
+    for pattern in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(text, pattern)
+        except ValueError:
+            pass
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    return parsed.astimezone().replace(tzinfo=None) if parsed.tzinfo is not None else parsed
+
+
+def export_csv(query, path, on_progress=None, cancelled=None):
+    # query is an opened storage.PagedQuery; rows are written chunk by chunk,
+    # so memory stays at one chunk whatever the size of the result
+    written = 0
+    with open(path, 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(HEADER)
+        while not query.exhausted and not (cancelled and cancelled()):
+            rows = query.next_chunk()
+            # BLOB payloads are written as hex so the CSV stays text
+            csv_writer.writerows(
+                (imei, timestamp, message.hex() if isinstance(message, bytes) else message, topic)
+                for imei, timestamp, message, topic in rows)
+            written += len(rows)
+            if on_progress:
+                on_progress(written)
+    return written
+
+
+def export_parquet(query, path, on_progress=None, cancelled=None):
+    # One row group per chunk. Text payloads go to 'message', BLOBs to
+    # 'payload'; 'timestamp' is parsed, 'raw_timestamp' keeps the stored text.
+    pa = importlib.import_module("pyarrow")
+    pq = importlib.import_module("pyarrow.parquet")
+    schema = pa.schema([
+        ("imei", pa.string()),
+        ("timestamp", pa.timestamp("us")),
+        ("raw_timestamp", pa.string()),
+        ("message", pa.string()),
+        ("payload", pa.binary()),
+        ("topic", pa.string()),
+    ])
+    written = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as parquet_writer:
+        while not query.exhausted and not (cancelled and cancelled()):
+            rows = query.next_chunk()
+            if not rows:
+                continue
+            columns = {
+                "imei": [row[0] for row in rows],
+                "timestamp": [parse_timestamp(row[1]) for row in rows],
+                "raw_timestamp": [row[1] for row in rows],
+                "message": [None if isinstance(row[2], bytes) else row[2] for row in rows],
+                "payload": [row[2] if isinstance(row[2], bytes) else None for row in rows],
+                "topic": [row[3] for row in rows],
+            }
+            parquet_writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            written += len(rows)
+            if on_progress:
+                on_progress(written)
+    return written
+
+
+EXPORTERS = {'csv': export_csv, 'parquet': export_parquet}
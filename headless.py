@@ -0,0 +1,115 @@
+import argparse
+import configparser
+import signal
+import sys
+import threading
+
+from connections import TRANSPORTS, ConnectionManager
+from devices import DeviceRegistry
+from metrics import MetricsServer
+from pipeline import IngestPipeline
+from storage import DB_PATH, TelemetryWriter, initialize_database, load_devices
+from subscriptions import configured_topics
+
+CONFIG_PATH = "config.ini"
+
+
+def broker_settings(config, name):
+    if name not in config:
+        raise SystemExit(f"Broker '{name}' has no section in the config file")
+    section = config[name]
+    port = section.get("port", "")
+    if not port.isdigit():
+        raise SystemExit(f"Broker '{name}' has an invalid port: '{port}'")
+    return {
+        "broker": section.get("broker", ""),
+        "port": int(port),
+        "username": section.get("username", ""),
+        "password": section.get("password", ""),
+        "client_id": section.get("client_id", ""),
+    }
+
+
+def configured_brokers(config):
+    return list(config["Brokers"].values()) if "Brokers" in config else []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m headless",
+                                     description="Subscribe to the configured topics and store telemetry without the GUI.")
+    parser.add_argument("--config", default=CONFIG_PATH, help="config file with [Brokers] and [Topics] (default: %(default)s)")
+    parser.add_argument("--broker", action="append", help="broker name from [Brokers], may be repeated (default: all of them)")
+    parser.add_argument("--transport", choices=TRANSPORTS, help="MQTT transport (default: [Connection] transport, else paho)")
+    parser.add_argument("--database", default=DB_PATH, help="SQLite database file (default: %(default)s)")
+    parser.add_argument("--stats-interval", type=float, default=60, help="seconds between stats lines, 0 to disable")
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        raise SystemExit(f"Could not read {args.config}")
+    names = args.broker or configured_brokers(config)
+    if not names:
+        raise SystemExit(f"No brokers configured in {args.config}")
+    settings = {name: broker_settings(config, name) for name in names}
+    topics = configured_topics(config)
+
+    initialize_database(args.database)
+    registry = DeviceRegistry()
+    registry.load(load_devices(args.database))
+    writer = TelemetryWriter.from_config(config, args.database)
+    pipeline = IngestPipeline.from_config(config, writer, registry)
+    writer.start()
+    pipeline.start()
+
+    def on_state_change(name, connected):
+        if connected:
+            print(f"Connected to {name}, subscribed to {len(topics)} topics", flush=True)
+        else:
+            print(f"Disconnected from {name}", flush=True)
+
+    manager = ConnectionManager.from_config(config, pipeline, on_state_change, transport=args.transport)
+    metrics_server = MetricsServer.from_config(config)
+    if metrics_server is not None:
+        metrics_server.start()
+        print(f"Metrics at http://{metrics_server.server.server_address[0]}:{metrics_server.port}/metrics", flush=True)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    if hasattr(signal, "SIGHUP"):
+        # systemctl reload: pick up devices added from the GUI
+        signal.signal(signal.SIGHUP, lambda signum, frame: registry.load(load_devices(args.database)))
+
+    for name in names:
+        try:
+            manager.connect(name, settings[name], topics)
+        except Exception as e:
+            print(f"Failed to connect to MQTT broker {name}. Error: {str(e)}", flush=True)
+    if not manager.names():
+        if metrics_server is not None:
+            metrics_server.stop()
+        pipeline.stop()
+        writer.stop()
+        raise SystemExit("Could not connect to any broker")
+
+    while not stop.wait(args.stats_interval or None):
+        writer_stats = writer.stats()
+        pipeline_stats = pipeline.stats()
+        brokers = " ".join(f"{name}={broker_stats['rate']}/s" for name, broker_stats in manager.stats().items())
+        print(f"received={pipeline.counter} {brokers} "
+              f"parse_queue={pipeline_stats['parse']['queue_depth']} "
+              f"persist_queue={pipeline_stats['persist']['queue_depth']} "
+              f"writer_queue={writer_stats['queue_depth']} "
+              f"rows_written={writer_stats['rows_written']} "
+              f"flush_ms={writer_stats['last_flush_ms']:.1f}", flush=True)
+
+    manager.disconnect_all()
+    if metrics_server is not None:
+        metrics_server.stop()
+    pipeline.stop()
+    writer.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import json
+
+# Static Leaflet page loaded once into the map view. Python never regenerates
+# it; tracks are pushed into it through the functions below with
+# runJavaScript, see MapBridge.
+MAP_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.css">
+<link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.Default.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<script src="https://unpkg.com/leaflet.markercluster@1.5.3/dist/leaflet.markercluster.js"></script>
+<style>html, body, #map { height: 100%%; margin: 0; }</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var map = L.map('map').setView([%(latitude)f, %(longitude)f], 13);
+L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+    maxZoom: 19, attribution: '&copy; OpenStreetMap contributors'
+}).addTo(map);
+
+var levels = null;
+var route = null;
+var endpoints = L.layerGroup().addTo(map);
+var clusters = L.markerClusterGroup({chunkedLoading: true}).addTo(map);
+
+function levelFor(zoom) {
+    // Highest simplification level not above the current zoom
+    var keys = Object.keys(levels).map(Number).sort(function (a, b) { return a - b; });
+    var chosen = keys[0];
+    keys.forEach(function (key) { if (key <= zoom) { chosen = key; } });
+    return levels[chosen];
+}
+
+function drawRoute() {
+    if (route) { map.removeLayer(route); route = null; }
+    if (!levels || Object.keys(levels).length === 0) { return; }
+    route = L.polyline(levelFor(map.getZoom()), {color: 'red', weight: 2.5, opacity: 1, dashArray: '10'}).addTo(map);
+}
+map.on('zoomend', drawRoute);
+
+function clearTrack() {
+    levels = null;
+    drawRoute();
+    clusters.clearLayers();
+    endpoints.clearLayers();
+}
+
+function setRoute(newLevels) {
+    levels = newLevels;
+    drawRoute();
+}
+
+function addMarkers(markers) {
+    // markers: [[lat, lon, label, d2d], ...]; popups are built on first open
+    var layers = markers.map(function (m) {
+        var marker = L.marker([m[0], m[1]]);
+        marker.bindPopup(function () {
+            return m[2] + '<br><i>(' + m[0] + ', ' + m[1] + ')</i><br>d2d: ' + m[3].toFixed(1) + 'm';
+        });
+        return marker;
+    });
+    clusters.addLayers(layers);
+}
+
+function setEndpoints(start, end, total) {
+    endpoints.clearLayers();
+    L.circleMarker(start, {color: 'green', radius: 8}).bindPopup('Start<br><i>(' + start + ')</i>').addTo(endpoints);
+    if (end) {
+        L.circleMarker(end, {color: 'black', radius: 8})
+            .bindPopup('End<br><i>(' + end + ')</i><br>Total: ' + total.toFixed(1) + 'm').addTo(endpoints);
+    }
+}
+
+// Live trails, one polyline and head marker per device
+var trails = {};
+var palette = ['#e6194b', '#3cb44b', '#4363d8', '#f58231', '#911eb4', '#42d4f4', '#f032e6', '#9a6324'];
+
+function clearTrails() {
+    Object.keys(trails).forEach(function (imei) {
+        map.removeLayer(trails[imei].line);
+        map.removeLayer(trails[imei].head);
+    });
+    trails = {};
+}
+
+function appendTrails(batch, maxLength, follow) {
+    // batch: {imei: [[lat, lon], ...]} of the fixes since the last frame
+    Object.keys(batch).forEach(function (imei) {
+        var trail = trails[imei];
+        var points = batch[imei];
+        var last = points[points.length - 1];
+        if (!trail) {
+            var color = palette[Object.keys(trails).length %% palette.length];
+            trail = trails[imei] = {
+                points: [],
+                line: L.polyline([], {color: color, weight: 3}).addTo(map),
+                head: L.circleMarker(last, {color: color, radius: 6}).bindTooltip(imei).addTo(map)
+            };
+        }
+        trail.points = trail.points.concat(points);
+        if (trail.points.length > maxLength) {
+            trail.points = trail.points.slice(trail.points.length - maxLength);
+        }
+        trail.line.setLatLngs(trail.points);
+        trail.head.setLatLng(last);
+        if (imei === follow) { map.panTo(last); }
+    });
+}
+
+function setTrails(all, maxLength, follow) {
+    clearTrails();
+    appendTrails(all, maxLength, follow);
+}
+
+function fitTrack() {
+    var bounds = clusters.getBounds();
+    if (route) { bounds.extend(route.getBounds()); }
+    if (bounds.isValid()) { map.fitBounds(bounds, {maxZoom: 16}); }
+}
+</script>
+</body>
+</html>
+"""
+
+
+def map_html(latitude, longitude):
+    return MAP_HTML % {"latitude": latitude, "longitude": longitude}
+
+
+class MapBridge:
+    # Calls the page's JavaScript functions with JSON arguments. Calls made
+    # before the page has finished loading are queued and run on load.
+    def __init__(self, view):
+        self.view = view
+        self.loaded = False
+        self.pending = []
+        view.loadFinished.connect(self.on_load_finished)
+
+    def load(self, latitude, longitude):
+        self.loaded = False
+        self.view.setHtml(map_html(latitude, longitude))
+
+    def call(self, function, *args):
+        script = f"{function}({', '.join(json.dumps(arg) for arg in args)});"
+        if self.loaded:
+            self.view.page().runJavaScript(script)
+        else:
+            self.pending.append(script)
+
+    def on_load_finished(self, ok):
+        if not ok:
+            print("Error: the map page did not load")
+            return
+        self.loaded = True
+        pending, self.pending = self.pending, []
+        for script in pending:
+            self.view.page().runJavaScript(script)
@@ -0,0 +1,256 @@
+import math
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from 100 us to 10 s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+# Label value used once a family has max_children label sets, so per-topic
+# metrics can't grow without bound
+OVERFLOW = "other"
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    # Cumulative buckets as in the Prometheus exposition format
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, inf for the open bucket
+        counts, total_sum, count = self.snapshot()
+        rank = math.ceil(fraction * count)
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            seen += bucket_count
+            if bucket_count and seen >= rank:
+                return bound
+        return 0.0
+
+
+METRIC_TYPES = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+
+class Family:
+    # One metric name and its children, one per set of label values. A
+    # family without labels can be used directly: family.inc(),
+    # family.observe(), family.set(). With function set, the values are read
+    # at collection time: function() returns a number, or {label values: number}.
+    def __init__(self, name, help_text, metric_type, labelnames=(), buckets=DEFAULT_BUCKETS, function=None,
+                 max_children=None):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.function = function
+        self.max_children = max_children
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)  # label values are nearly always strings already
+        if child is not None:
+            return child
+        key = tuple(str(value) for value in values)
+        with self.lock:
+            if self.max_children is not None and len(self.children) >= self.max_children and key not in self.children:
+                key = (OVERFLOW,) * len(self.labelnames)
+            child = self.children.get(key)
+            if child is None:
+                child = Histogram(self.buckets) if self.type == "histogram" else METRIC_TYPES[self.type]()
+                self.children[key] = child
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        # [(label values, child or number)]
+        if self.function is None:
+            with self.lock:
+                return list(self.children.items())
+        try:
+            values = self.function()
+        except Exception as e:
+            print(f"Error: metric {self.name}: {e}")
+            return []
+        if isinstance(values, dict):
+            return [((key,) if isinstance(key, str) else tuple(key), value) for key, value in values.items()]
+        return [((), values)]
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    # Every metric of the process. Modules declare theirs at import time with
+    # counter()/gauge()/histogram(); render() writes the Prometheus text format.
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _family(self, name, help_text, metric_type, **options):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(name, help_text, metric_type, **options)
+            elif options.get("function") is not None:
+                family.function = options["function"]  # a later owner, e.g. a new session manager
+            return family
+
+    def counter(self, name, help_text, labelnames=(), max_children=None, function=None):
+        return self._family(name, help_text, "counter", labelnames=labelnames, max_children=max_children,
+                            function=function)
+
+    def gauge(self, name, help_text, labelnames=(), function=None):
+        return self._family(name, help_text, "gauge", labelnames=labelnames, function=function)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS, max_children=None):
+        return self._family(name, help_text, "histogram", labelnames=labelnames, buckets=buckets,
+                            max_children=max_children)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            families = sorted(self.families.values(), key=lambda family: family.name)
+        for family in families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for values, sample in sorted(family.samples(), key=lambda item: item[0]):
+                if isinstance(sample, Histogram):
+                    counts, total_sum, count = sample.snapshot()
+                    cumulative = 0
+                    for bound, bucket_count in zip(sample.buckets + (math.inf,), counts):
+                        cumulative += bucket_count
+                        labels = format_labels(family.labelnames, values, [("le", format_value(bound))])
+                        lines.append(f"{family.name}_bucket{labels} {cumulative}")
+                    labels = format_labels(family.labelnames, values)
+                    lines.append(f"{family.name}_sum{labels} {format_value(total_sum)}")
+                    lines.append(f"{family.name}_count{labels} {count}")
+                else:
+                    value = sample.value if isinstance(sample, (Counter, Gauge)) else sample
+                    lines.append(f"{family.name}{format_labels(family.labelnames, values)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def rows(self):
+        # [(name, labels text, value text)] for the GUI's statistics table
+        rows = []
+        with self.lock:
+            families = sorted(self.families.values(), key=lambda family: family.name)
+        for family in families:
+            for values, sample in sorted(family.samples(), key=lambda item: item[0]):
+                labels = ", ".join(f"{name}={value}" for name, value in zip(family.labelnames, values))
+                if isinstance(sample, Histogram):
+                    counts, total_sum, count = sample.snapshot()
+                    average = total_sum / count * 1000 if count else 0.0
+                    text = (f"n={count} avg={average:.2f} ms p50<={sample.percentile(0.5) * 1000:g} ms "
+                            f"p99<={sample.percentile(0.99) * 1000:g} ms")
+                else:
+                    value = sample.value if isinstance(sample, (Counter, Gauge)) else sample
+                    text = f"{value:.3f}" if isinstance(value, float) else str(value)
+                rows.append((family.name, labels, text))
+        return rows
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scraped every few seconds, not worth a line each time
+
+
+class MetricsServer(threading.Thread):
+    # GET /metrics on a local port, for Prometheus or curl
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT, metrics_registry=registry):
+        super().__init__(name="metrics", daemon=True)
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.registry = metrics_registry
+        self.port = self.server.server_address[1]
+
+    @classmethod
+    def from_config(cls, config):
+        # [Metrics] port = 0 disables the endpoint; returns None then or when
+        # the port is taken
+        section = config["Metrics"] if "Metrics" in config else {}
+        port = int(section.get("port", METRICS_PORT))
+        if not port:
+            return None
+        try:
+            return cls(section.get("host", METRICS_HOST), port)
+        except OSError as e:
+            print(f"Error: metrics endpoint not started: {e}")
+            return None
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,51 @@
+import sqlite3
+import threading
+import time
+
+OUTBOX_PATH = 'outbox.db'
+
+
+class Outbox:
+    # Messages published while their broker was offline, kept on disk until
+    # they have been sent after the reconnect: acknowledged by the broker at
+    # QoS 1/2, written to the socket at QoS 0. A crash or restart keeps them;
+    # the next session of the same broker name sends them in order.
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            # AUTOINCREMENT: ids are never reused, so they give the sending order
+            self.conn.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, broker TEXT, '
+                              'topic TEXT, payload BLOB, qos INTEGER, retain INTEGER, queued REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_broker ON outbox(broker, id)')
+        self.counts = dict(self.conn.execute('SELECT broker, COUNT(*) FROM outbox GROUP BY broker'))
+
+    def put(self, broker, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self.lock, self.conn:
+            row_id = self.conn.execute('INSERT INTO outbox (broker, topic, payload, qos, retain, queued) VALUES (?, ?, ?, ?, ?, ?)',
+                                       (broker, topic, payload, qos, int(retain), time.time())).lastrowid
+            self.counts[broker] = self.counts.get(broker, 0) + 1
+        return row_id
+
+    def peek(self, broker, after_id=0, limit=100):
+        # [(id, topic, payload, qos, retain)] oldest first
+        with self.lock:
+            return [(row_id, topic, bytes(payload), qos, bool(retain)) for row_id, topic, payload, qos, retain in
+                    self.conn.execute('SELECT id, topic, payload, qos, retain FROM outbox WHERE broker = ? AND id > ? '
+                                      'ORDER BY id LIMIT ?', (broker, after_id, limit))]
+
+    def remove(self, broker, row_id):
+        with self.lock, self.conn:
+            if self.conn.execute('DELETE FROM outbox WHERE id = ?', (row_id,)).rowcount:
+                self.counts[broker] = max(0, self.counts.get(broker, 0) - 1)
+
+    def count(self, broker):
+        return self.counts.get(broker, 0)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
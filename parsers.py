@@ -0,0 +1,289 @@
+import json
+import re
+import struct
+from array import array
+from datetime import datetime
+
+from topics import TopicTrie
+
+FORMATS = ("csv", "json", "struct", "regex")
+# Field types: Python converter, SQLite column type and array typecode for
+# columnar batches (None keeps a plain list)
+FIELD_TYPES = {
+    "int": (int, "INTEGER", "q"),
+    "float": (float, "REAL", "d"),
+    "str": (str, "TEXT", None),
+    "bytes": (bytes, "BLOB", None),
+}
+RECORD_COLUMNS = ("imei", "timestamp", "topic")
+# Parser and field names become SQL table and column names unquoted, so they
+# must be plain ASCII identifiers and not SQLite keywords
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+SQLITE_KEYWORDS = frozenset("""
+    ABORT ACTION ADD AFTER ALL ALTER ALWAYS ANALYZE AND AS ASC ATTACH AUTOINCREMENT BEFORE BEGIN BETWEEN BY
+    CASCADE CASE CAST CHECK COLLATE COLUMN COMMIT CONFLICT CONSTRAINT CREATE CROSS CURRENT CURRENT_DATE
+    CURRENT_TIME CURRENT_TIMESTAMP DATABASE DEFAULT DEFERRABLE DEFERRED DELETE DESC DETACH DISTINCT DO DROP
+    EACH ELSE END ESCAPE EXCEPT EXCLUDE EXCLUSIVE EXISTS EXPLAIN FAIL FILTER FIRST FOLLOWING FOR FOREIGN FROM
+    FULL GENERATED GLOB GROUP GROUPS HAVING IF IGNORE IMMEDIATE IN INDEX INDEXED INITIALLY INNER INSERT
+    INSTEAD INTERSECT INTO IS ISNULL JOIN KEY LAST LEFT LIKE LIMIT MATCH MATERIALIZED NATURAL NO NOT NOTHING
+    NOTNULL NULL NULLS OF OFFSET ON OR ORDER OTHERS OUTER OVER PARTITION PLAN PRAGMA PRECEDING PRIMARY QUERY
+    RAISE RANGE RECURSIVE REFERENCES REGEXP REINDEX RELEASE RENAME REPLACE RESTRICT RETURNING RIGHT ROLLBACK
+    ROW ROWS SAVEPOINT SELECT SET TABLE TEMP TEMPORARY THEN TIES TO TRANSACTION TRIGGER UNBOUNDED UNION
+    UNIQUE UPDATE USING VACUUM VALUES VIEW VIRTUAL WHEN WHERE WINDOW WITH WITHOUT
+""".split())
+
+
+def check_identifier(kind, name):
+    if not IDENTIFIER.match(name) or name.upper() in SQLITE_KEYWORDS:
+        raise ValueError(f"Invalid {kind} name '{name}': use letters, digits and _, and no SQL keyword")
+    return name
+
+
+def parse_fields(spec):
+    # "timestamp:str, latitude:float" -> [("timestamp", "str"), ("latitude", "float")]
+    fields = []
+    for item in spec.split(","):
+        name, _, field_type = item.strip().partition(":")
+        field_type = field_type.strip() or "str"
+        if field_type not in FIELD_TYPES:
+            raise ValueError(f"Unknown field type '{field_type}' for field '{name}'")
+        name = check_identifier("field", name.strip())
+        if name in ("id", "topic"):
+            raise ValueError(f"Invalid field name '{name}': the table has a column of that name")
+        fields.append((name, field_type))
+    return fields
+
+
+class Parser:
+    # Decodes one payload into records, tuples in the order of fields.
+    # Subclasses compile whatever they can up front (struct layouts, regexes,
+    # converter lists) so parse() does no per-message setup. The IMEI comes
+    # from the first line of the payload, a topic level, or an "imei" field;
+    # a "timestamp" field replaces the receive time. Both are stored in the
+    # table's imei/timestamp columns, the other fields get a typed column each.
+    binary = False  # parse() wants the raw bytes even when they decode as text
+
+    def __init__(self, name, topic, fields, imei="first_line"):
+        self.name = check_identifier("parser", name)
+        self.topic = topic
+        self.fields = fields
+        self.names = [field for field, field_type in fields]
+        self.converters = [FIELD_TYPES[field_type][0] for field, field_type in fields]
+        self.imei = imei
+        self.imei_level = int(imei.split(":", 1)[1]) if imei.startswith("topic:") else None
+        self.imei_index = self.names.index("imei") if imei == "field" else None
+        self.timestamp_index = self.names.index("timestamp") if "timestamp" in self.names else None
+        self.columns = [(index, field, field_type) for index, (field, field_type) in enumerate(fields)
+                        if field not in RECORD_COLUMNS]
+
+    @property
+    def table(self):
+        return f"parsed_{self.name}"
+
+    def parse(self, payload):
+        raise NotImplementedError
+
+    def split_imei(self, payload):
+        # Returns (imei or None, rest of the payload)
+        if self.imei == "first_line":
+            text = payload.decode("utf-8") if isinstance(payload, (bytes, bytearray)) else payload
+            first, _, rest = text.strip().partition("\n")
+            return first.strip(), rest
+        return None, payload
+
+    def records(self, topic, payload, received):
+        # Full rows for the typed table: (imei, timestamp, topic, *fields)
+        imei, body = self.split_imei(payload)
+        if self.imei_level is not None:
+            levels = topic.split("/")
+            imei = levels[self.imei_level] if self.imei_level < len(levels) else None
+        rows = []
+        for record in self.parse(body):
+            if self.imei_index is not None:
+                imei = str(record[self.imei_index])
+            timestamp = str(record[self.timestamp_index]) if self.timestamp_index is not None else received
+            rows.append((imei, timestamp, topic) + tuple(record[index] for index, field, field_type in self.columns))
+        return rows
+
+    def decode_batch(self, payloads):
+        # Columnar decode of many payloads: {field: array or list}
+        columns = [array(FIELD_TYPES[field_type][2]) if FIELD_TYPES[field_type][2] else []
+                   for field, field_type in self.fields]
+        for payload in payloads:
+            for record in self.parse(self.split_imei(payload)[1]):
+                for column, value in zip(columns, record):
+                    column.append(value)
+        return dict(zip(self.names, columns))
+
+    def create_statements(self):
+        columns = "".join(f", {field} {FIELD_TYPES[field_type][1]}" for index, field, field_type in self.columns)
+        return [
+            f"CREATE TABLE IF NOT EXISTS {self.table} (id INTEGER PRIMARY KEY, imei TEXT, timestamp TEXT, topic TEXT{columns})",
+            f"CREATE INDEX IF NOT EXISTS idx_{self.table}_imei_timestamp ON {self.table}(imei, timestamp)",
+        ]
+
+    def insert_statement(self):
+        columns = list(RECORD_COLUMNS) + [field for index, field, field_type in self.columns]
+        return f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+
+class CsvParser(Parser):
+    # One record per non-empty line
+    def __init__(self, name, topic, fields, imei="first_line", delimiter=","):
+        super().__init__(name, topic, fields, imei)
+        self.delimiter = delimiter
+        self.pairs = list(enumerate(self.converters))
+
+    def parse(self, payload):
+        text = payload.decode("utf-8") if isinstance(payload, (bytes, bytearray)) else payload
+        records = []
+        count = len(self.converters)
+        for line in text.splitlines():
+            values = line.strip().split(self.delimiter)
+            if len(values) < count:
+                continue
+            try:
+                records.append(tuple(convert(values[index]) for index, convert in self.pairs))
+            except ValueError:
+                continue  # a malformed line is skipped, the raw message is still stored
+        return records
+
+
+class JsonParser(Parser):
+    # An object or a list of objects; a field "a__b" reads the nested key b of a
+    def __init__(self, name, topic, fields, imei="field"):
+        super().__init__(name, topic, fields, imei)
+        self.paths = [field.split("__") if "__" in field else [field] for field in self.names]
+
+    def parse(self, payload):
+        try:
+            document = json.loads(payload)
+        except ValueError:
+            return []
+        records = []
+        for item in document if isinstance(document, list) else [document]:
+            try:
+                record = []
+                for path, convert in zip(self.paths, self.converters):
+                    value = item
+                    for key in path:
+                        value = value[key]
+                    record.append(convert(value))
+                records.append(tuple(record))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return records
+
+
+class StructParser(Parser):
+    # Fixed-size binary records, as many as the payload holds
+    binary = True
+
+    def __init__(self, name, topic, fields, imei="topic:1", layout=""):
+        super().__init__(name, topic, fields, imei)
+        self.layout = struct.Struct(layout)
+        if len(self.layout.unpack(bytes(self.layout.size))) != len(fields):
+            raise ValueError(f"Layout '{layout}' does not have {len(fields)} fields")
+
+    def split_imei(self, payload):
+        return None, payload  # binary payloads never carry an IMEI line
+
+    def parse(self, payload):
+        usable = len(payload) - len(payload) % self.layout.size
+        return list(self.layout.iter_unpack(memoryview(payload)[:usable]))
+
+    def decode_batch(self, payloads):
+        # One iter_unpack over all payloads joined together
+        columns = [array(FIELD_TYPES[field_type][2]) if FIELD_TYPES[field_type][2] else []
+                   for field, field_type in self.fields]
+        data = b"".join(payload[:len(payload) - len(payload) % self.layout.size] for payload in payloads)
+        for record in self.layout.iter_unpack(data):
+            for column, value in zip(columns, record):
+                column.append(value)
+        return dict(zip(self.names, columns))
+
+
+class RegexParser(Parser):
+    # One record per match of a pattern with a named group per field
+    def __init__(self, name, topic, fields, imei="first_line", pattern=""):
+        super().__init__(name, topic, fields, imei)
+        self.pattern = re.compile(pattern, re.MULTILINE)
+        missing = set(self.names) - set(self.pattern.groupindex)
+        if missing:
+            raise ValueError(f"Pattern has no group for {', '.join(sorted(missing))}")
+        self.groups = [self.pattern.groupindex[field] for field in self.names]
+
+    def parse(self, payload):
+        text = payload.decode("utf-8") if isinstance(payload, (bytes, bytearray)) else payload
+        records = []
+        for match in self.pattern.finditer(text):
+            try:
+                records.append(tuple(convert(match.group(group)) for group, convert in zip(self.groups, self.converters)))
+            except ValueError:
+                continue
+        return records
+
+
+PARSER_CLASSES = {"csv": CsvParser, "json": JsonParser, "struct": StructParser, "regex": RegexParser}
+
+
+def parser_from_section(name, section):
+    parser_format = section.get("format", "csv")
+    if parser_format not in PARSER_CLASSES:
+        raise ValueError(f"Parser '{name}': unknown format '{parser_format}'")
+    options = {"imei": section["imei"]} if "imei" in section else {}
+    if parser_format == "csv" and "delimiter" in section:
+        options["delimiter"] = section["delimiter"]
+    if parser_format == "struct":
+        options["layout"] = section["layout"]
+    if parser_format == "regex":
+        options["pattern"] = section["pattern"]
+    return PARSER_CLASSES[parser_format](name, section.get("topic", "#"), parse_fields(section["fields"]), **options)
+
+
+class ParserRegistry:
+    # Parsers keyed by MQTT topic filter, from [Parser:<name>] sections:
+    #
+    #   [Parser:telemetry]
+    #   topic = devices/+/telemetry
+    #   format = csv
+    #   imei = first_line
+    #   fields = timestamp:str, counter:int, latitude:float, longitude:float
+    #
+    # format is csv, json, struct (with layout = <struct format>) or regex
+    # (with pattern = <named groups>); imei is first_line, topic:<level> or
+    # field. Every parser whose filter matches a topic is used.
+    def __init__(self, parsers=()):
+        self.parsers = []
+        self.trie = TopicTrie()
+        for parser in parsers:
+            self.register(parser)
+
+    @classmethod
+    def from_config(cls, config):
+        parsers = []
+        for section_name in config.sections():
+            if section_name.startswith("Parser:"):
+                name = section_name.split(":", 1)[1]
+                try:
+                    parsers.append(parser_from_section(name, config[section_name]))
+                except (KeyError, ValueError, struct.error, re.error) as e:
+                    print(f"Error: parser '{name}' ignored: {e}")
+        return cls(parsers)
+
+    def __iter__(self):
+        return iter(list(self.parsers))
+
+    def __len__(self):
+        return len(self.parsers)
+
+    def register(self, parser):
+        self.parsers.append(parser)
+        self.trie.insert(parser.topic, parser)
+
+    def matches(self, topic):
+        return self.trie.match(topic)
+
+
+def received_timestamp(recv_ts):
+    return datetime.fromtimestamp(recv_ts).strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,61 @@
+import re
+
+TEXT = "text"
+IMAGE = "image"
+BINARY = "binary"
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+
+def sniff_image(payload):
+    # Only looks at the first bytes, never copies the payload
+    head = bytes(payload[:12])
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    # "BM" alone is too common at the start of text, also require the zeroed reserved field
+    if head[:2] == b"BM" and head[6:10] == b"\0\0\0\0":
+        return "bmp"
+    return None
+
+
+def classify(payload):
+    # Returns (kind, text); text is only set for UTF-8 payloads
+    image_format = sniff_image(payload)
+    if image_format is not None:
+        return IMAGE, None
+    try:
+        return TEXT, str(payload, "utf-8")
+    except UnicodeDecodeError:
+        return BINARY, None
+
+
+def describe(value):
+    # Short display form for a message column that may hold a BLOB
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        image_format = sniff_image(value)
+        if image_format is not None:
+            return f"[{image_format} image, {len(value)} bytes]"
+        return f"[binary, {len(value)} bytes]"
+    return value
+
+
+GPS_FIX = re.compile(r"^([^,]*),([+-]\d+(?:\.\d*)?),([+-]\d+(?:\.\d*)?)$")
+
+
+def parse_fix(message):
+    # GPS replies look like "<fix>,+45.50000,-73.56000"; "<fix>,-,-" means no fix.
+    # Returns (fix, latitude, longitude) or None.
+    if not isinstance(message, str):
+        return None
+    match = GPS_FIX.match(message)
+    if match is None:
+        return None
+    return match.group(1), float(match.group(2)), float(match.group(3))
@@ -0,0 +1,253 @@
+import functools
+import queue
+import threading
+import time
+from datetime import datetime
+
+import payloads
+from metrics import registry as metrics
+from parsers import ParserRegistry, received_timestamp
+from topics import TopicTrie
+
+POLICIES = ("block", "drop")
+ROUTE_STAGES = ("persist", "render")
+
+_STOP = object()
+# Per-topic metrics keep this many topics, the rest are counted as "other"
+MAX_TOPICS = 500
+
+STAGE_SECONDS = metrics.histogram("mqtt_pipeline_stage_seconds", "Time to handle one item, per pipeline stage", ("stage",))
+STAGE_WAIT_SECONDS = metrics.histogram("mqtt_pipeline_queue_wait_seconds", "Time an item waited in a stage's queue", ("stage",))
+STAGE_ERRORS = metrics.counter("mqtt_pipeline_errors_total", "Items whose handler raised, per pipeline stage", ("stage",))
+DECODED = metrics.counter("mqtt_messages_decoded_total", "Messages decoded, per payload kind", ("kind",))
+PARSER_SECONDS = metrics.histogram("mqtt_parser_seconds", "Time for one typed parser to decode one message", ("parser",))
+PARSER_RECORDS = metrics.counter("mqtt_parser_records_total", "Records decoded by a typed parser", ("parser",))
+# The _count of these two is the number of messages per topic/broker
+TOPIC_LATENCY = metrics.histogram("mqtt_topic_persist_latency_seconds", "Receive to handed-to-writer time, per topic",
+                                   ("topic",), max_children=MAX_TOPICS)
+BROKER_LATENCY = metrics.histogram("mqtt_broker_persist_latency_seconds", "Receive to handed-to-writer time, per broker",
+                                    ("broker",))
+
+
+class Message:
+    __slots__ = ("seq", "broker", "topic", "payload", "recv_ts", "kind", "text")
+
+    def __init__(self, topic, payload, recv_ts, broker=None):
+        self.seq = 0
+        self.broker = broker
+        self.topic = topic
+        self.payload = payload
+        self.recv_ts = recv_ts
+        self.kind = None
+        self.text = None
+
+
+class Stage(threading.Thread):
+    # One worker thread draining a bounded queue. With the "drop" policy a full
+    # queue discards the new item instead of blocking the producer.
+    def __init__(self, name, handler, queue_size=10000, policy="block"):
+        super().__init__(name=name, daemon=True)
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.handler = handler
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.dropped = 0
+        self.seconds = STAGE_SECONDS.labels(name)
+        self.wait_seconds = STAGE_WAIT_SECONDS.labels(name)
+        self.errors_total = STAGE_ERRORS.labels(name)
+
+    def put(self, item):
+        # Queued with the time, so the wait in the queue can be measured
+        if self.policy == "drop":
+            try:
+                self.queue.put_nowait((time.monotonic(), item))
+            except queue.Full:
+                self.dropped += 1
+        else:
+            self.queue.put((time.monotonic(), item))
+
+    def stop(self, timeout=None):
+        self.queue.put(_STOP)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is _STOP:
+                break
+            queued, item = entry
+            started = time.monotonic()
+            self.wait_seconds.observe(started - queued)
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.errors_total.inc()
+                print(f"Error in {self.name}: {e}")
+            self.seconds.observe(time.monotonic() - started)
+            self.processed += 1
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "processed": self.processed,
+            "dropped": self.dropped,
+        }
+
+
+class IngestPipeline:
+    # receive (MQTT thread) -> parse -> persist
+    #                                -> render
+    # The MQTT callback only timestamps and enqueues, so decoding, database
+    # writes and UI work never hold up the network loop.
+    def __init__(self, writer, registry, queue_size=10000, policy="block", render_queue_size=1000, render_policy="drop",
+                 parsers=None):
+        self.writer = writer
+        self.registry = registry
+        self.renderer = None
+        self.fix_listener = None
+        # Per-topic handlers, run on the stage's thread after its own work
+        self.routes = {stage: TopicTrie() for stage in ROUTE_STAGES}
+        # Typed decoding on top of the raw data/commands rows, see parsers.py
+        self.parsers = parsers if parsers is not None else ParserRegistry()
+        for parser in self.parsers:
+            writer.add_table(parser.table, parser.create_statements(), parser.insert_statement())
+            self.add_route(parser.topic, functools.partial(self.insert_parsed_data, parser))
+        self.counter = 0
+        self.parse_stage = Stage("parse", self._parse, queue_size, policy)
+        self.persist_stage = Stage("persist", self._persist, queue_size, policy)
+        self.render_stage = Stage("render", self._render, render_queue_size, render_policy)
+        # Read from the stages when scraped, nothing extra per message
+        metrics.gauge("mqtt_pipeline_queue_depth", "Items waiting in a stage's queue", ("stage",),
+                      function=lambda: {stage.name: stage.queue.qsize() for stage in self.stages()})
+        metrics.counter("mqtt_pipeline_processed_total", "Items handled, per pipeline stage", ("stage",),
+                        function=lambda: {stage.name: stage.processed for stage in self.stages()})
+        metrics.counter("mqtt_pipeline_dropped_total", "Items dropped because a stage's queue was full", ("stage",),
+                        function=lambda: {stage.name: stage.dropped for stage in self.stages()})
+
+    def stages(self):
+        return (self.parse_stage, self.persist_stage, self.render_stage)
+
+    @classmethod
+    def from_config(cls, config, writer, registry):
+        section = config["Pipeline"] if "Pipeline" in config else {}
+        return cls(writer, registry,
+                   queue_size=int(section.get("queue_size", 10000)),
+                   policy=section.get("policy", "block"),
+                   render_queue_size=int(section.get("render_queue_size", 1000)),
+                   render_policy=section.get("render_policy", "drop"),
+                   parsers=ParserRegistry.from_config(config))
+
+    def set_renderer(self, renderer):
+        # Renders every message; use add_route(..., "render") for some topics only
+        if self.renderer is not None:
+            self.remove_route("#", self.renderer, "render")
+        self.renderer = renderer
+        if renderer is not None:
+            self.add_route("#", renderer, "render")
+
+    def add_route(self, topic_filter, handler, stage="persist"):
+        # handler(message) runs for every message matching topic_filter; a
+        # handler matched by several filters still runs once per message
+        self.routes[stage].insert(topic_filter, handler)
+
+    def remove_route(self, topic_filter, handler, stage="persist"):
+        return self.routes[stage].remove(topic_filter, handler)
+
+    def set_fix_listener(self, listener):
+        # listener(imei, timestamp, latitude, longitude), called on the persist
+        # thread for every GPS fix as it is stored
+        self.fix_listener = listener
+
+    def start(self):
+        self.parse_stage.start()
+        self.persist_stage.start()
+        self.render_stage.start()
+
+    def stop(self):
+        self.parse_stage.stop()
+        self.persist_stage.stop()
+        self.render_stage.stop()
+
+    def stats(self):
+        return {
+            "parse": self.parse_stage.stats(),
+            "persist": self.persist_stage.stats(),
+            "render": self.render_stage.stats(),
+        }
+
+    def enqueue(self, topic, payload, recv_ts=None, broker=None):
+        if recv_ts is None:
+            recv_ts = time.time()
+        self.parse_stage.put(Message(topic, payload, recv_ts, broker))
+
+    def on_message(self, client, userdata, message):
+        self.enqueue(message.topic, message.payload, broker=userdata)
+
+    def _parse(self, message):
+        self.counter += 1
+        message.seq = self.counter
+        # The payload stays as the bytes object paho handed us; only UTF-8
+        # text is decoded, images and other binary data are never re-encoded
+        message.kind, message.text = payloads.classify(message.payload)
+        DECODED.labels(message.kind).inc()
+        self.persist_stage.put(message)
+        if self.routes["render"]:
+            renderers = self.routes["render"].match(message.topic)
+            if renderers:
+                self.render_stage.put((message, renderers))
+
+    def _persist(self, message):
+        if message.kind == payloads.TEXT:
+            self.insert_telemetry_data(message.text, message.topic)
+        else:
+            self.insert_binary_data(message.payload, message.topic)
+        for handler in self.routes["persist"].match(message.topic):
+            handler(message)
+        latency = time.time() - message.recv_ts
+        TOPIC_LATENCY.labels(message.topic).observe(latency)
+        BROKER_LATENCY.labels(message.broker or "").observe(latency)
+
+    def _render(self, item):
+        message, renderers = item
+        for renderer in renderers:
+            renderer(message)
+
+    def insert_telemetry_data(self, payload, topic):
+        data_lines = payload.strip().split('\n')
+        imei = data_lines[0].strip()
+        formatted_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        if imei in self.registry:
+            for line in data_lines[1:]:
+                line = line.strip()
+                timestamp = line.split(',')[0]
+                self.writer.submit('data', (imei, timestamp, line, topic))
+
+        # Check if topic is a read topic for the registered devices
+        devices = self.registry.by_read_topic(topic)
+        fix = payloads.parse_fix(payload.strip()) if devices and self.fix_listener is not None else None
+        for device in devices:
+            self.writer.submit('commands', (device.imei, formatted_timestamp, payload.strip(), topic))
+            if fix is not None:
+                self.fix_listener(device.imei, formatted_timestamp, fix[1], fix[2])
+
+    def insert_parsed_data(self, parser, message):
+        # Only records of registered devices are kept, like the raw rows
+        started = time.perf_counter()
+        payload = message.payload if parser.binary or message.text is None else message.text
+        rows = parser.records(message.topic, payload, received_timestamp(message.recv_ts))
+        PARSER_SECONDS.labels(parser.name).observe(time.perf_counter() - started)
+        PARSER_RECORDS.labels(parser.name).inc(len(rows))
+        for row in rows:
+            if row[0] in self.registry:
+                self.writer.submit(parser.table, row)
+
+    def insert_binary_data(self, payload, topic):
+        # Binary payloads carry no IMEI line, so they can only be matched by read topic.
+        # They are stored as BLOBs in the message column.
+        formatted_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for device in self.registry.by_read_topic(topic):
+            self.writer.submit('commands', (device.imei, formatted_timestamp, payload, topic))
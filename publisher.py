@@ -0,0 +1,238 @@
+import random
+import string
+import threading
+import time
+
+from metrics import Histogram, registry
+
+# Variables a topic or payload template may use
+TEMPLATE_FIELDS = ("imei", "counter", "ts", "epoch", "lat", "lon", "gps")
+DEFAULT_TOPIC = "devices/{imei}/telemetry"
+DEFAULT_PAYLOAD = "{imei}\n{ts},{counter},{lat},{lon}"
+IMEI_BASE = 356000000000000
+# Upper bounds of the acknowledgement latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+ACK_SECONDS = registry.histogram("mqtt_publish_ack_seconds", "Simulator publish to PUBACK/PUBCOMP time, per broker",
+                                 ("broker",), buckets=LATENCY_BUCKETS)
+
+
+class Template:
+    # A str.format template checked once; render() only computes the
+    # variables the template uses
+    def __init__(self, text):
+        self.text = text
+        self.fields = set()
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if field is None:
+                continue
+            if field not in TEMPLATE_FIELDS:
+                raise ValueError(f"Unknown template variable '{{{field}}}', use one of "
+                                 f"{', '.join('{' + name + '}' for name in TEMPLATE_FIELDS)}")
+            self.fields.add(field)
+        self.needs_fix = bool(self.fields & {"lat", "lon", "gps"})
+
+    def render(self, values):
+        return self.text.format_map(values)
+
+
+class SimulatedDevice:
+    # One IMEI and a GPS position doing a random walk around the start point
+    __slots__ = ("imei", "latitude", "longitude")
+
+    def __init__(self, imei, latitude, longitude):
+        self.imei = imei
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def move(self, step=0.0002):
+        self.latitude = min(90.0, max(-90.0, self.latitude + random.uniform(-step, step)))
+        self.longitude = (self.longitude + random.uniform(-step, step) + 180.0) % 360.0 - 180.0
+
+
+class PublishEngine:
+    # Publishes templated messages for a number of simulated devices at a target
+    # rate on its own thread. Messages are sent in small bursts scheduled
+    # against the start time, so the rate holds without a sleep per message.
+    # At QoS 1/2 at most max_in_flight messages wait for their PUBACK/PUBCOMP;
+    # the time to that acknowledgement goes into the latency histogram.
+    def __init__(self, session, topic=DEFAULT_TOPIC, payload=DEFAULT_PAYLOAD, rate=100, qos=0, retain=False,
+                 devices=1, max_in_flight=100, count=0, start=(45.50000, -73.56000), imei_base=IMEI_BASE):
+        self.session = session
+        self.topic = Template(topic)
+        self.payload = Template(payload)
+        self.rate = max(0.1, float(rate))
+        self.qos = qos
+        self.retain = retain
+        self.max_in_flight = max(1, max_in_flight)
+        self.count = count  # 0 publishes until stop()
+        self.devices = [SimulatedDevice(str(imei_base + index), *start) for index in range(max(1, devices))]
+        self.fields = self.topic.fields | self.payload.fields
+        self.needs_fix = self.topic.needs_fix or self.payload.needs_fix
+        self._ts_second = None
+        self._ts_text = ""
+        self.sent = 0
+        self.acked = 0
+        self.in_flight = {}  # message id -> send time
+        self.acked_early = set()
+        self._sending = False  # a publish() is under way and its id not yet recorded
+        self.latency = Histogram(LATENCY_BUCKETS)  # this run only
+        self.ack_seconds = ACK_SECONDS.labels(session.name)
+        self.started = None
+        self.finished = None
+        self.thread = None
+        self.error = None
+        self._stop = threading.Event()
+        self._lock = threading.RLock()
+        self._room = threading.Condition(self._lock)
+        self._second = 0
+        self._second_count = 0
+        self._last_second_count = 0
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.session.on_published = self._acknowledged
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._room:
+            self._room.notify_all()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _acknowledged(self, message_id):
+        # Called on the session's network thread
+        with self._room:
+            sent = self.in_flight.pop(message_id, None)
+            if sent is None:
+                if self._sending:
+                    self.acked_early.add(message_id)  # acknowledged before _send recorded it
+                return
+            self.acked += 1
+            self._room.notify()
+        self._observe(time.monotonic() - sent)
+
+    def _observe(self, latency):
+        self.latency.observe(latency)
+        self.ack_seconds.observe(latency)
+
+    def values(self, device, counter, now):
+        values = {"imei": device.imei, "counter": counter, "epoch": f"{now:.3f}"}
+        if "ts" in self.fields:
+            second = int(now)
+            if second != self._ts_second:
+                self._ts_second = second
+                self._ts_text = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            values["ts"] = self._ts_text
+        if self.needs_fix:
+            device.move()
+            values["lat"] = f"{device.latitude:+.5f}"
+            values["lon"] = f"{device.longitude:+.5f}"
+            values["gps"] = f"A,{values['lat']},{values['lon']}"
+        return values
+
+    def _run(self):
+        try:
+            self._publish_loop()
+            with self._room:
+                # Give the last acknowledgements a chance to arrive
+                self._room.wait_for(lambda: not self.in_flight or self._stop.is_set(), timeout=10)
+        except Exception as e:
+            self.error = str(e)
+            print(f"Error: publisher stopped: {e}")
+        finally:
+            self.finished = time.monotonic()
+            if self.session.on_published == self._acknowledged:
+                self.session.on_published = None
+
+    def _publish_loop(self):
+        burst = max(1, int(self.rate / 200))  # about 200 wake-ups a second at high rates
+        while not self._stop.is_set():
+            if self.count and self.sent >= self.count:
+                return
+            if not self.session.connected:
+                self._stop.wait(0.1)
+                continue
+            now = time.monotonic()
+            due = int((now - self.started) * self.rate) - self.sent
+            if due > self.rate:
+                # More than a second behind (offline, or a full in-flight
+                # window): carry on from here instead of bursting to catch up
+                self.started = now - self.sent / self.rate
+                due = 1
+            if due <= 0:
+                self._stop.wait(min(0.005, 1 / self.rate))
+                continue
+            for _ in range(min(due, burst, self.count - self.sent if self.count else due)):
+                if not self._send():
+                    break
+
+    def _send(self):
+        # session.publish() is called without holding _room: paho's publish()
+        # takes paho's message lock, which paho also holds while it calls
+        # on_publish -> _acknowledged on its network thread
+        with self._room:
+            if self.qos:
+                # Wait for room in the in-flight window
+                while len(self.in_flight) >= self.max_in_flight and not self._stop.is_set():
+                    self._room.wait(0.1)
+                if self._stop.is_set():
+                    return False
+            device = self.devices[self.sent % len(self.devices)]
+            values = self.values(device, self.sent, time.time())
+            self._sending = True
+        sent = time.monotonic()
+        # Never through the outbox: a queued message would escape the
+        # in-flight window and the latency histogram
+        message_id = self.session.publish(self.topic.render(values), self.payload.render(values), self.qos, self.retain,
+                                          queue=False)
+        early = False
+        with self._room:
+            self._sending = False
+            if message_id is None:
+                # Not sent (the connection dropped): not counted, and the loop
+                # waits for the reconnect
+                self.acked_early.clear()
+                self._room.wait(0.1)
+                return False
+            if self.qos and message_id:
+                if message_id in self.acked_early:
+                    early = True  # the acknowledgement beat us to it
+                    self.acked += 1
+                else:
+                    self.in_flight[message_id] = sent
+            self.acked_early.clear()
+            self.sent += 1
+            second = int(sent)
+            if second != self._second:
+                self._last_second_count = self._second_count if second == self._second + 1 else 0
+                self._second = second
+                self._second_count = 0
+            self._second_count += 1
+        if early:
+            self._observe(time.monotonic() - sent)
+        return True
+
+    def stats(self):
+        with self._lock:
+            rate = self._last_second_count if int(time.monotonic()) <= self._second + 1 else 0
+            elapsed = (self.finished or time.monotonic()) - self.started if self.started else 0.0
+            return {
+                "running": self.running,
+                "sent": self.sent,
+                "acked": self.acked,
+                "in_flight": len(self.in_flight),
+                "rate": rate,
+                "average_rate": self.sent / elapsed if elapsed else 0.0,
+                "elapsed": elapsed,
+                "p50_ms": self.latency.percentile(0.50) * 1000,
+                "p95_ms": self.latency.percentile(0.95) * 1000,
+                "p99_ms": self.latency.percentile(0.99) * 1000,
+                "error": self.error,
+            }
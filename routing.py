@@ -0,0 +1,164 @@
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from startup import lazy_import
+
+ROUTE_CACHE_PATH = 'route_cache.db'
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine(a, b):
+    # Great-circle distance in metres between two (lat, lon) points
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+
+class Route:
+    # geometry: (lat, lon) points of the path; legs: distance in metres between
+    # consecutive waypoints, so len(legs) == len(waypoints) - 1
+    __slots__ = ("geometry", "legs", "backend")
+
+    def __init__(self, geometry, legs, backend):
+        self.geometry = geometry
+        self.legs = legs
+        self.backend = backend
+
+    @property
+    def distance(self):
+        return sum(self.legs)
+
+
+class StraightLineBackend:
+    # Offline fallback: joins the waypoints directly
+    name = "straight"
+
+    def route(self, coordinates):
+        return Route(list(coordinates), [haversine(a, b) for a, b in zip(coordinates, coordinates[1:])], self.name)
+
+
+class OsrmBackend:
+    # Any OSRM-compatible /route/v1 endpoint: the public demo server or a
+    # local osrm-routed
+    def __init__(self, url="https://router.project-osrm.org", profile="driving", timeout=10):
+        self.url = url.rstrip("/")
+        self.profile = profile
+        self.timeout = timeout
+        self.name = f"osrm:{self.url}/{self.profile}"
+
+    def route(self, coordinates):
+        coords = ";".join(f"{lon},{lat}" for lat, lon in coordinates)
+        response = lazy_import("requests").get(f"{self.url}/route/v1/{self.profile}/{coords}", timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"Request failed with status code: {response.status_code}")
+        result = response.json()
+        if result.get("code") != "Ok":
+            raise RuntimeError(f"Routing failed: {result.get('message', result.get('code'))}")
+        route = result['routes'][0]
+        geometry = lazy_import("polyline").decode(route['geometry'])
+        return Route(geometry, [leg['distance'] for leg in route['legs']], self.name)
+
+
+class RouteCache:
+    # Persistent cache of routed chunks, keyed by backend and the exact
+    # waypoint sequence. Safe to use from the fetch threads.
+    def __init__(self, path=ROUTE_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, route TEXT)')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(backend, coordinates):
+        waypoints = ";".join(f"{lat:.6f},{lon:.6f}" for lat, lon in coordinates)
+        return hashlib.sha1(f"{backend}|{waypoints}".encode()).hexdigest()
+
+    def get(self, backend, coordinates):
+        with self.lock:
+            row = self.conn.execute('SELECT route FROM routes WHERE key = ?', (self.key(backend, coordinates),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        geometry, legs = json.loads(row[0])
+        return Route([tuple(point) for point in geometry], legs, backend)
+
+    def put(self, coordinates, route):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO routes (key, route) VALUES (?, ?)',
+                              (self.key(route.backend, coordinates), json.dumps([route.geometry, route.legs])))
+
+    def close(self):
+        self.conn.close()
+
+
+class RouteService:
+    # Routes a track of any length: the waypoints are split into chunks that
+    # share their end points, each chunk comes from the cache or is fetched
+    # concurrently, and the pieces are joined back together. When the backend
+    # fails, the fallback (straight lines by default) fills in that chunk.
+    def __init__(self, backend=None, cache=None, chunk_size=100, workers=2, fallback=None):
+        self.backend = backend or OsrmBackend()
+        self.cache = cache
+        self.chunk_size = max(2, chunk_size)
+        self.fallback = fallback
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="route")
+
+    @classmethod
+    def from_config(cls, config):
+        section = config["Routing"] if "Routing" in config else {}
+        if section.get("backend", "osrm") == "straight":
+            backend = StraightLineBackend()
+        else:
+            backend = OsrmBackend(section.get("url", "https://router.project-osrm.org"),
+                                  section.get("profile", "driving"),
+                                  float(section.get("timeout", 10)))
+        cache_path = section.get("cache", ROUTE_CACHE_PATH)
+        fallback = StraightLineBackend() if section.get("fallback", "straight") == "straight" else None
+        return cls(backend, RouteCache(cache_path) if cache_path else None,
+                   int(section.get("chunk_size", 100)), int(section.get("workers", 2)), fallback)
+
+    def chunks(self, coordinates):
+        step = self.chunk_size - 1
+        return [coordinates[start:start + self.chunk_size] for start in range(0, max(1, len(coordinates) - 1), step)]
+
+    def route_chunk(self, coordinates):
+        if self.cache is not None:
+            route = self.cache.get(self.backend.name, coordinates)
+            if route is not None:
+                return route
+        try:
+            route = self.backend.route(coordinates)
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            print(f"Error: {e}")
+            return self.fallback.route(coordinates)  # not cached, the backend may be back next time
+        if self.cache is not None:
+            self.cache.put(coordinates, route)
+        return route
+
+    def route(self, coordinates):
+        coordinates = [tuple(point) for point in coordinates]
+        if len(coordinates) < 2:
+            return Route(coordinates, [], self.backend.name)
+        pieces = list(self.executor.map(self.route_chunk, self.chunks(coordinates)))
+        geometry = list(pieces[0].geometry)
+        legs = list(pieces[0].legs)
+        for piece in pieces[1:]:
+            geometry.extend(piece.geometry[1:])  # first point repeats the previous chunk's last
+            legs.extend(piece.legs)
+        backends = {piece.backend for piece in pieces}
+        return Route(geometry, legs, backends.pop() if len(backends) == 1 else "mixed")
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,143 @@
+import math
+
+from startup import lazy_import
+
+# numpy is imported the first time a track is simplified, so it stays off
+# the GUI's startup path; None when it is not installed and the pure Python
+# path below is used instead
+numpy = None
+_numpy_checked = False
+
+# Below this many points a segment is cheaper to scan in Python than to
+# hand to numpy
+SMALL_SEGMENT = 24
+
+# Zoom levels a simplified copy of a track is kept for. The map shows the
+# copy for the highest level not above its current zoom.
+ZOOM_LEVELS = (6, 9, 12, 15, 18)
+TOLERANCE_PX = 1.5
+METRES_PER_DEGREE = 111320.0
+
+
+def metres_per_pixel(zoom, latitude):
+    # Web Mercator ground resolution of 256 px tiles
+    return 156543.03392 * math.cos(math.radians(latitude)) / 2 ** zoom
+
+
+def tolerance_for_zoom(zoom, latitude, pixels=TOLERANCE_PX):
+    return pixels * metres_per_pixel(zoom, latitude)
+
+
+def _douglas_peucker_numpy(points, tolerance):
+    # points: (n, 2) array of (lat, lon). Distances are measured on a local
+    # equirectangular projection in metres, which is accurate enough at the
+    # scale of one track.
+    latitude = float(points[:, 0].mean())
+    x = points[:, 1] * (METRES_PER_DEGREE * math.cos(math.radians(latitude)))
+    y = points[:, 0] * METRES_PER_DEGREE
+    xs = x.tolist()
+    ys = y.tolist()
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        if last - first < SMALL_SEGMENT:
+            split = _farthest(xs, ys, first, last, tolerance)
+            if split is not None:
+                keep[split] = True
+                stack.append((first, split))
+                stack.append((split, last))
+            continue
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        px = x[first + 1:last] - x[first]
+        py = y[first + 1:last] - y[first]
+        length = dx * dx + dy * dy
+        if length == 0:
+            distances = numpy.hypot(px, py)
+        else:
+            # Distance to the segment, not the infinite line, so tracks that
+            # double back are not collapsed
+            t = numpy.clip((px * dx + py * dy) / length, 0.0, 1.0)
+            distances = numpy.hypot(px - t * dx, py - t * dy)
+        index = int(distances.argmax())
+        if distances[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return numpy.flatnonzero(keep)
+
+
+def _farthest(x, y, first, last, tolerance):
+    # Index of the point between first and last farthest from their segment,
+    # or None when every point is within tolerance
+    dx = x[last] - x[first]
+    dy = y[last] - y[first]
+    length = dx * dx + dy * dy
+    best, best_distance = None, tolerance
+    for index in range(first + 1, last):
+        px = x[index] - x[first]
+        py = y[index] - y[first]
+        t = min(1.0, max(0.0, (px * dx + py * dy) / length)) if length else 0.0
+        distance = math.hypot(px - t * dx, py - t * dy)
+        if distance > best_distance:
+            best, best_distance = index, distance
+    return best
+
+
+def _douglas_peucker_python(points, tolerance):
+    scale = METRES_PER_DEGREE * math.cos(math.radians(sum(lat for lat, lon in points) / len(points)))
+    x = [lon * scale for lat, lon in points]
+    y = [lat * METRES_PER_DEGREE for lat, lon in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        split = _farthest(x, y, first, last, tolerance)
+        if split is not None:
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return [index for index, kept in enumerate(keep) if kept]
+
+
+def _load_numpy():
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            numpy = lazy_import("numpy")
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def douglas_peucker(points, tolerance):
+    # Indices of the points to keep so that no dropped point is further than
+    # tolerance metres from the simplified line. First and last are always kept.
+    if len(points) < 3:
+        return list(range(len(points)))
+    if _load_numpy() is not None:
+        return _douglas_peucker_numpy(numpy.asarray(points, dtype=float), tolerance).tolist()
+    return _douglas_peucker_python(points, tolerance)
+
+
+def zoom_levels(points, zooms=ZOOM_LEVELS):
+    # {zoom: [[lat, lon], ...]} ready to be sent to the map as JSON. Each
+    # level simplifies the previous, coarser tolerances run on fewer points.
+    if not points:
+        return {}
+    latitude = points[0][0]
+    levels = {}
+    current = [list(point) for point in points]
+    for zoom in sorted(zooms, reverse=True):
+        current = [current[index] for index in douglas_peucker(current, tolerance_for_zoom(zoom, latitude))]
+        levels[zoom] = current
+    return levels
@@ -0,0 +1,47 @@
+import importlib
+import os
+import sys
+import time
+
+
+class StartupTimer:
+    # Records how long each dependency takes to import and when startup
+    # milestones are reached. Printed with --startup-timing or
+    # MQTT_CLIENT_STARTUP_TIMING=1.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.imports = []
+        self.marks = []
+        self.enabled = "--startup-timing" in sys.argv or bool(os.environ.get("MQTT_CLIENT_STARTUP_TIMING"))
+        self.reported = False
+
+    def import_module(self, name, lazy=False):
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        elapsed = time.perf_counter() - started
+        self.imports.append((name, elapsed, lazy))
+        if lazy and self.enabled and self.reported:
+            print(f"[startup] lazy import {name}: {elapsed * 1000:.1f} ms", file=sys.stderr)
+        return module
+
+    def mark(self, label):
+        self.marks.append((label, time.perf_counter() - self.start))
+
+    def report(self):
+        self.reported = True
+        if not self.enabled:
+            return
+        for name, elapsed, lazy in self.imports:
+            print(f"[startup] import {name}{' (lazy)' if lazy else ''}: {elapsed * 1000:.1f} ms", file=sys.stderr)
+        for label, elapsed in self.marks:
+            print(f"[startup] {label}: {elapsed * 1000:.1f} ms", file=sys.stderr)
+
+
+startup_timer = StartupTimer()
+
+
+def lazy_import(name):
+    return startup_timer.import_module(name, lazy=True)
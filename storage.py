@@ -0,0 +1,761 @@
+import glob
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import payloads
+from metrics import registry
+
+DB_PATH = 'newDatabase26.db'
+
+INSERT_STATEMENTS = {
+    'data': 'INSERT INTO data (imei, timestamp, message, topic) VALUES (?, ?, ?, ?)',
+    'commands': 'INSERT INTO commands (imei, timestamp, message, topic) VALUES (?, ?, ?, ?)',
+}
+
+# Partition file names sort in time order and compare directly against the
+# stored "%Y-%m-%d %H:%M:%S" timestamps
+PARTITION_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+PARTITION_SCHEMA = 'part'
+
+# Tables of a partition file. AUTOINCREMENT so sqlite_sequence can be seeded
+# with the last id of the previous partition, which keeps ids unique and
+# increasing across files and lets keyset paging walk them in order.
+PARTITION_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS {schema}.{table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic TEXT,
+        message TEXT,
+        timestamp TEXT,
+        imei TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_{table}_imei ON {table}(imei)',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_{table}_topic ON {table}(topic)',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_{table}_imei_timestamp ON {table}(imei, timestamp)',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_{table}_topic_timestamp ON {table}(topic, timestamp)',
+]
+
+
+def backfill_gps_fixes(conn):
+    # Extracts the fixes already stored in commands, in the main file and any
+    # partitions, so gps_fixes starts out complete
+    rows = []
+    sources = [('main', None)] + [(None, file) for name, file in partition_files(conn.execute(
+        "SELECT file FROM pragma_database_list WHERE name = 'main'").fetchone()[0] or DB_PATH)]
+    for schema, file in sources:
+        source = conn if schema else sqlite3.connect(file)
+        try:
+            for imei, timestamp, message in source.execute(
+                    "SELECT imei, timestamp, message FROM commands WHERE typeof(message) = 'text' ORDER BY id"):
+                fix = payloads.parse_fix(message)
+                if fix is not None:
+                    rows.append((imei, timestamp) + fix)
+        except sqlite3.OperationalError:
+            pass  # partition without a commands table yet
+        finally:
+            if source is not conn:
+                source.close()
+    conn.executemany(GPS_INSERT, rows)
+
+
+def index_partitions(conn):
+    # Brings partition files created before the last PARTITION_TABLES change
+    # up to date; new ones get every index when they are attached
+    path = conn.execute("SELECT file FROM pragma_database_list WHERE name = 'main'").fetchone()[0] or DB_PATH
+    for name, file in partition_files(path):
+        partition = sqlite3.connect(file)
+        try:
+            with partition:
+                for table in INSERT_STATEMENTS:
+                    if partition.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                         (table,)).fetchone():
+                        for statement in PARTITION_TABLES[1:]:
+                            partition.execute(statement.format(schema='main', table=table))
+        finally:
+            partition.close()
+
+
+GPS_INSERT = 'INSERT INTO main.gps_fixes (imei, timestamp, fix, latitude, longitude) VALUES (?, ?, ?, ?, ?)'
+
+# Schema migrations, applied in order by migrate(). PRAGMA user_version holds
+# the last version applied, so each one runs exactly once per database file.
+# Never edit a released migration; append a new one instead. A step is either
+# an SQL statement or a callable taking the connection.
+MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS data (
+            id INTEGER PRIMARY KEY,
+            topic TEXT,
+            message TEXT,
+            timestamp TEXT,
+            imei TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY,
+            topic TEXT,
+            message TEXT,
+            timestamp TEXT,
+            imei TEXT
+        )
+        ''',
+        # Device list of the Devices tab; unlike data and commands it
+        # keeps the row's creation time, not a message timestamp
+        '''
+        CREATE TABLE IF NOT EXISTS devices (
+            id INTEGER PRIMARY KEY,
+            imei TEXT,
+            read_topic TEXT,
+            comments TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_topic ON data(topic)',
+        'CREATE INDEX IF NOT EXISTS idx_imei ON data(imei)',
+    ]),
+    # Time-range lookups per device, and the commands-table lookups used by
+    # the map tab and the Database tab topic fallback
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_data_imei_timestamp ON data(imei, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_commands_imei_timestamp ON commands(imei, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_commands_topic ON commands(topic)',
+    ]),
+    # Rollups kept by the writer so dashboards don't read raw rows. Hours are
+    # the receive hour, "%Y-%m-%d %H:00".
+    (3, [
+        '''
+        CREATE TABLE IF NOT EXISTS hourly_counts (
+            imei TEXT,
+            hour TEXT,
+            source TEXT,
+            messages INTEGER,
+            PRIMARY KEY (imei, hour, source)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS last_fix (
+            imei TEXT PRIMARY KEY,
+            timestamp TEXT,
+            latitude REAL,
+            longitude REAL
+        )
+        ''',
+    ]),
+    # Typed GPS track, filled by the writer at ingest so the map never parses
+    # command history. Read per device in id order, incrementally.
+    (4, [
+        '''
+        CREATE TABLE IF NOT EXISTS gps_fixes (
+            id INTEGER PRIMARY KEY,
+            imei TEXT,
+            timestamp TEXT,
+            fix TEXT,
+            latitude REAL,
+            longitude REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_gps_fixes_imei ON gps_fixes(imei)',
+        backfill_gps_fixes,
+    ]),
+    # Ranged topic pages walk (topic, timestamp) instead of sorting every
+    # match, and commands gets the (imei, rowid) index data already has for
+    # id-ordered IMEI pages
+    (5, [
+        'CREATE INDEX IF NOT EXISTS idx_data_topic_timestamp ON data(topic, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_commands_topic_timestamp ON commands(topic, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_commands_imei ON commands(imei)',
+        index_partitions,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    # Returns the versions applied. Each migration commits together with its
+    # user_version bump, so an interrupted upgrade resumes where it stopped.
+    applied = []
+    current = schema_version(conn)
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        with conn:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+        applied.append(version)
+    return applied
+
+
+def initialize_database(path=DB_PATH):
+    conn = sqlite3.connect(path)
+    try:
+        applied = migrate(conn)
+    finally:
+        conn.close()
+    if applied:
+        print(f"Database {path}: applied schema migrations {applied}")
+    return applied
+
+
+def partition_dir(path=DB_PATH):
+    return os.path.splitext(path)[0] + '_partitions'
+
+
+def partition_files(path=DB_PATH):
+    # (name, file) of every partition of the database, oldest first
+    files = glob.glob(os.path.join(partition_dir(path), '*.db'))
+    return sorted((os.path.splitext(os.path.basename(file))[0], file) for file in files)
+
+
+def data_sources(path=DB_PATH, start=None, end=None):
+    # Files to read, in id order: the main database (history from before
+    # partitioning) and then the partitions. With a time range, partitions
+    # entirely outside it are skipped; one neighbour is kept on each side
+    # because partitions follow the receive date, not the device clock.
+    partitions = partition_files(path)
+    first, last = 0, len(partitions)
+    if start is not None:
+        while first + 1 < last and partitions[first + 1][0] <= start[:len(partitions[first + 1][0])]:
+            first += 1
+        first = max(0, first - 1)
+    if end is not None:
+        while last > first and partitions[last - 1][0] > end[:len(partitions[last - 1][0])]:
+            last -= 1
+        last = min(len(partitions), last + 1)
+    return [path] + [file for name, file in partitions[first:last]]
+
+
+def max_id(conn, schema='main'):
+    return max(conn.execute(f'SELECT coalesce(max(id), 0) FROM {schema}.{table}').fetchone()[0]
+               for table in INSERT_STATEMENTS)
+
+
+class PartitionStore:
+    # Routes writes to one SQLite file per day or month, attached to the
+    # writer's connection as "part", and enforces retention by deleting whole
+    # partition files. Readers find the files with data_sources().
+    def __init__(self, path=DB_PATH, granularity='month', retention=0):
+        if granularity not in PARTITION_FORMATS:
+            raise ValueError(f"Unknown partition granularity '{granularity}'")
+        self.path = path
+        self.directory = partition_dir(path)
+        self.format = PARTITION_FORMATS[granularity]
+        self.retention = retention
+        self.current = None
+
+    @classmethod
+    def from_config(cls, config, path=DB_PATH):
+        # [Storage] partition = none | day | month, retention = partitions to keep (0 keeps all)
+        section = config["Storage"] if "Storage" in config else {}
+        granularity = section.get("partition", "none")
+        if granularity == "none":
+            return None
+        return cls(path, granularity, int(section.get("retention", 0)))
+
+    def name_for(self, when=None):
+        return (when or datetime.now()).strftime(self.format)
+
+    def file_for(self, name):
+        return os.path.join(self.directory, f'{name}.db')
+
+    def attach(self, conn, when=None):
+        # Attaches the partition for `when`, creating it if needed. Returns
+        # True when the attached partition changed.
+        name = self.name_for(when)
+        if name == self.current:
+            return False
+        last_id = max_id(conn)
+        if self.current is not None:
+            last_id = max(last_id, max_id(conn, PARTITION_SCHEMA))
+            conn.execute(f'DETACH DATABASE {PARTITION_SCHEMA}')
+        else:
+            for previous, file in partition_files(self.path):
+                if previous < name:
+                    with sqlite3.connect(file) as previous_conn:
+                        last_id = max(last_id, max_id(previous_conn))
+        os.makedirs(self.directory, exist_ok=True)
+        conn.execute(f'ATTACH DATABASE ? AS {PARTITION_SCHEMA}', (self.file_for(name),))
+        conn.execute(f'PRAGMA {PARTITION_SCHEMA}.journal_mode=WAL')
+        with conn:
+            for table in INSERT_STATEMENTS:
+                for statement in PARTITION_TABLES:
+                    conn.execute(statement.format(schema=PARTITION_SCHEMA, table=table))
+                conn.execute(f'DELETE FROM {PARTITION_SCHEMA}.sqlite_sequence WHERE name = ? AND seq < ?', (table, last_id))
+                conn.execute(f'INSERT INTO {PARTITION_SCHEMA}.sqlite_sequence (name, seq) '
+                             f'SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM {PARTITION_SCHEMA}.sqlite_sequence WHERE name = ?)',
+                             (table, last_id, table))
+        self.current = name
+        self.enforce_retention(conn)
+        return True
+
+    def enforce_retention(self, conn=None):
+        # Returns the names of the partitions dropped. Given the writer's
+        # connection it also deletes the GPS fixes older than the oldest
+        # partition kept: gps_fixes lives in the main file, which no
+        # partition drop touches.
+        if not self.retention:
+            return []
+        partitions = partition_files(self.path)
+        dropped = []
+        for name, file in partitions[:max(0, len(partitions) - self.retention)]:
+            if name == self.current:
+                continue
+            try:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(file + suffix):
+                        os.remove(file + suffix)
+                dropped.append(name)
+            except OSError as e:
+                # Still open elsewhere (Windows); retried on the next rollover
+                print(f"Error: {e}")
+        if dropped:
+            print(f"Dropped partitions {dropped}")
+        kept = [name for name, file in partitions if name not in dropped]
+        if conn is not None and len(kept) >= self.retention:
+            # Partition names compare directly against stored timestamps
+            with conn:
+                deleted = conn.execute('DELETE FROM main.gps_fixes WHERE timestamp < ?', (kept[0],)).rowcount
+            if deleted:
+                print(f"Deleted {deleted} GPS fixes from before {kept[0]}")
+        return dropped
+
+
+def update_rollups(conn, pending, hour=None):
+    # Folds one batch into hourly_counts, gps_fixes and last_fix, in the
+    # writer's transaction
+    hour = hour or datetime.now().strftime('%Y-%m-%d %H:00')
+    counts = {}
+    gps_rows = []
+    fixes = {}
+    for table, rows in pending.items():
+        for imei, timestamp, message, topic in rows:
+            counts[(imei, table)] = counts.get((imei, table), 0) + 1
+            fix = payloads.parse_fix(message) if table == 'commands' else None
+            if fix is not None:
+                gps_rows.append((imei, timestamp) + fix)
+                fixes[imei] = (timestamp,) + fix[1:]
+    conn.executemany(GPS_INSERT, gps_rows)
+    conn.executemany(
+        'INSERT INTO main.hourly_counts (imei, hour, source, messages) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (imei, hour, source) DO UPDATE SET messages = messages + excluded.messages',
+        [(imei, hour, table, count) for (imei, table), count in counts.items()])
+    conn.executemany(
+        'INSERT INTO main.last_fix (imei, timestamp, latitude, longitude) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (imei) DO UPDATE SET timestamp = excluded.timestamp, '
+        'latitude = excluded.latitude, longitude = excluded.longitude',
+        [(imei,) + fix for imei, fix in fixes.items()])
+
+
+def gps_fixes_query(imei, after_id=0):
+    return ('SELECT id, timestamp, fix, latitude, longitude FROM gps_fixes '
+            'WHERE imei = ? AND id > ? ORDER BY id'), [imei, after_id]
+
+
+def load_gps_fixes(imei, after_id=0, path=DB_PATH):
+    # Fixes of one device stored after after_id, oldest first
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(*gps_fixes_query(imei, after_id)).fetchall()
+    finally:
+        conn.close()
+
+
+def load_last_fixes(path=DB_PATH):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT imei, timestamp, latitude, longitude FROM last_fix').fetchall()
+    finally:
+        conn.close()
+
+
+def load_hourly_counts(imei, start=None, end=None, path=DB_PATH):
+    sql = 'SELECT hour, source, messages FROM hourly_counts WHERE imei = ?'
+    params = [imei]
+    if start is not None:
+        sql += ' AND hour >= ?'
+        params.append(start)
+    if end is not None:
+        sql += ' AND hour <= ?'
+        params.append(end)
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql + ' ORDER BY hour', params).fetchall()
+    finally:
+        conn.close()
+
+
+def explain(conn, sql, params=()):
+    # Detail column of EXPLAIN QUERY PLAN, one string per plan step
+    return [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+
+def full_scans(plan, tables=('data', 'commands')):
+    # Plan steps that read a whole telemetry table instead of searching an index
+    return [step for step in plan
+            if any(step.startswith(f'SCAN {table}') and 'USING' not in step for table in tables)]
+
+
+def temp_sorts(plan):
+    # Plan steps that sort every matching row before the first one is returned
+    return [step for step in plan if step.startswith('USE TEMP B-TREE')]
+
+
+def load_devices(path=DB_PATH):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT imei, read_topic, comments FROM devices')
+    devices = cursor.fetchall()
+    conn.close()
+    return devices
+
+
+FLUSH_SECONDS = registry.histogram("sqlite_flush_seconds", "Time to write and commit one batch of rows")
+FLUSH_ROWS = registry.histogram("sqlite_flush_rows", "Rows per committed batch",
+                                buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+FLUSH_ERRORS = registry.counter("sqlite_flush_errors_total", "Batches that failed to commit")
+ROWS_DROPPED = registry.counter("sqlite_rows_dropped_total", "Rows given up on after failed writes, per table", ("table",))
+ROWS_WRITTEN = registry.counter("sqlite_rows_written_total", "Rows committed, per table", ("table",))
+
+
+class TelemetryWriter(threading.Thread):
+    # Owns the only write connection to the database. Rows are queued by the
+    # message handlers and written with executemany, one transaction per batch.
+    # A batch that fails to commit is kept and retried every flush_interval,
+    # while the queue fills up and pushes back on ingest. After flush_retries
+    # failures each table is written on its own and only the rows of the
+    # tables that still fail are dropped.
+    def __init__(self, path=DB_PATH, batch_size=500, flush_interval=0.5, queue_size=10000, partitions=None,
+                 flush_retries=5):
+        super().__init__(name="TelemetryWriter", daemon=True)
+        self.path = path
+        self.partitions = partitions
+        self.statements = dict(INSERT_STATEMENTS)
+        self.extra_statements = {}
+        self.new_tables = []
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_retries = flush_retries
+        self.failures = 0  # consecutive failed attempts at the pending batch
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.rows_written = 0
+        self.batches_written = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        registry.gauge("sqlite_writer_queue_depth", "Rows waiting for the telemetry writer",
+                       function=self.queue.qsize)
+
+    @classmethod
+    def from_config(cls, config, path=DB_PATH):
+        section = config["Database"] if "Database" in config else {}
+        return cls(path=path,
+                   batch_size=int(section.get("batch_size", 500)),
+                   flush_interval=float(section.get("flush_interval", 0.5)),
+                   queue_size=int(section.get("queue_size", 10000)),
+                   partitions=PartitionStore.from_config(config, path),
+                   flush_retries=int(section.get("flush_retries", 5)))
+
+    def add_table(self, table, create_statements, insert_statement):
+        # Registers an extra table, such as a parser's typed table, so rows
+        # can be submitted for it. It is created on the next flush and always
+        # lives in the main file.
+        self.new_tables.append((table, create_statements, insert_statement))
+
+    def submit(self, table, row):
+        # Blocks when the queue is full so a slow disk pushes back on ingest
+        # instead of growing memory without bound.
+        self.queue.put((table, row))
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.join(timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self.batches_written
+            return {
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "rows_written": self.rows_written,
+                "batches_written": batches,
+                "last_flush_ms": self.last_flush_ms,
+                "max_flush_ms": self.max_flush_ms,
+                "avg_flush_ms": self.total_flush_ms / batches if batches else 0.0,
+            }
+
+    def run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        pending = {}
+        pending_count = 0
+        deadline = time.monotonic() + self.flush_interval
+        try:
+            while True:
+                timeout = max(0.0, deadline - time.monotonic())
+                if self.failures:
+                    time.sleep(timeout)  # retry the kept batch before taking new rows
+                else:
+                    try:
+                        table, row = self.queue.get(timeout=timeout)
+                        pending.setdefault(table, []).append(row)
+                        pending_count += 1
+                    except queue.Empty:
+                        pass
+
+                if (pending_count >= self.batch_size and not self.failures) or time.monotonic() >= deadline:
+                    if pending_count and self._flush(conn, pending, pending_count):
+                        pending = {}
+                        pending_count = 0
+                    deadline = time.monotonic() + self.flush_interval
+                    if self._stop_event.is_set() and self.queue.empty() and not pending_count:
+                        break
+        finally:
+            while not self.queue.empty():
+                table, row = self.queue.get_nowait()
+                pending.setdefault(table, []).append(row)
+                pending_count += 1
+            if pending_count and not self._flush(conn, pending, pending_count):
+                self._write_tables(conn, pending)
+            conn.close()
+
+    def _create_tables(self, conn):
+        while self.new_tables:
+            table, create_statements, insert_statement = self.new_tables.pop(0)
+            try:
+                with conn:
+                    for statement in create_statements:
+                        conn.execute(statement)
+            except sqlite3.Error as e:
+                print(f"Error: table {table} not created, its rows are dropped: {e}")
+                continue
+            self.extra_statements[table] = insert_statement
+            self.statements[table] = insert_statement
+
+    def _flush(self, conn, pending, count):
+        # Returns False when the batch failed and should be kept for a retry
+        start = time.perf_counter()
+        try:
+            self._create_tables(conn)
+            for table in [table for table in pending if table not in self.statements]:
+                rows = pending.pop(table)
+                count -= len(rows)
+                ROWS_DROPPED.labels(table).inc(len(rows))
+            if self.partitions is not None and self.partitions.attach(conn):
+                self.statements = {table: statement.replace('INTO ', f'INTO {PARTITION_SCHEMA}.', 1)
+                                   for table, statement in INSERT_STATEMENTS.items()}
+                self.statements.update(self.extra_statements)
+            with conn:
+                for table, rows in pending.items():
+                    conn.executemany(self.statements[table], rows)
+                update_rollups(conn, {table: pending[table] for table in INSERT_STATEMENTS if table in pending})
+        except Exception as e:
+            FLUSH_ERRORS.inc()
+            self.failures += 1
+            print(f"Error: writing {count} rows failed (attempt {self.failures}): {e!r}")
+            if self.failures <= self.flush_retries:
+                return False
+            self._write_tables(conn, pending)
+            return True
+        self.failures = 0
+        self._written(pending, count, start)
+        return True
+
+    def _write_tables(self, conn, pending):
+        # Last resort for a batch that keeps failing: one transaction per
+        # table and one statement per row, so only the rows that fail on
+        # their own are dropped
+        self.failures = 0
+        for table, rows in pending.items():
+            start = time.perf_counter()
+            written = []
+            try:
+                with conn:
+                    for row in rows:
+                        try:
+                            conn.execute(self.statements[table], row)
+                        except (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError):
+                            continue
+                        written.append(row)
+                    if table in INSERT_STATEMENTS:
+                        update_rollups(conn, {table: written})
+            except Exception as e:
+                written = []
+                print(f"Error: rows for {table} could not be written: {e!r}")
+            if len(written) < len(rows):
+                ROWS_DROPPED.labels(table).inc(len(rows) - len(written))
+                print(f"Error: {len(rows) - len(written)} rows for {table} dropped")
+            if written:
+                self._written({table: written}, len(written), start)
+
+    def _written(self, pending, count, start):
+        FLUSH_SECONDS.observe(time.perf_counter() - start)
+        FLUSH_ROWS.observe(count)
+        for table, rows in pending.items():
+            ROWS_WRITTEN.labels(table).inc(len(rows))
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._stats_lock:
+            self.rows_written += count
+            self.batches_written += 1
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            self.total_flush_ms += elapsed
+
+
+class PagedQuery:
+    # Keyset pagination over data/commands for one IMEI or topic:
+    # WHERE <column> = ? AND id > <last id> ORDER BY id LIMIT <chunk>, served
+    # by the (column, rowid) index so every chunk costs the same. With a time
+    # range the rows come in timestamp order instead, keyed on
+    # (timestamp, id) so the (imei, timestamp) index serves both the filter
+    # and the order. Partition files are read one after the other, see
+    # data_sources(). The connection is opened by whichever thread runs the
+    # query, and interrupt() may be called from any thread to cancel it.
+    TABLES = ('data', 'commands')
+    COLUMNS = ('imei', 'topic')
+    # Index whose sqlite_stat1 row gives the average rows per key
+    ESTIMATE_INDEXES = {
+        ('data', 'imei'): 'idx_imei',
+        ('data', 'topic'): 'idx_topic',
+        ('commands', 'imei'): 'idx_commands_imei_timestamp',
+        ('commands', 'topic'): 'idx_commands_topic',
+    }
+
+    def __init__(self, table, column, value, chunk_size=500, path=DB_PATH, start=None, end=None):
+        if table not in self.TABLES or column not in self.COLUMNS:
+            raise ValueError(f"Cannot page over {table}.{column}")
+        self.table = table
+        self.column = column
+        self.value = value
+        self.chunk_size = chunk_size
+        self.path = path
+        self.start = start
+        self.end = end
+        self.last_id = 0
+        self.last_timestamp = None
+        self.exhausted = False
+        self.sources = None
+        self.conn = None
+        self.count_conn = None
+
+    @property
+    def ranged(self):
+        return self.start is not None or self.end is not None
+
+    def copy(self, table=None, chunk_size=None):
+        return PagedQuery(table or self.table, self.column, self.value, chunk_size or self.chunk_size,
+                          self.path, self.start, self.end)
+
+    def open(self):
+        self.sources = data_sources(self.path, self.start, self.end)
+        self.conn = sqlite3.connect(self.sources.pop(0))
+
+    def next_source(self):
+        # Partitions may overlap in device time, so a ranged walk restarts per file
+        self.close()
+        self.conn = sqlite3.connect(self.sources.pop(0))
+        if self.ranged:
+            self.last_id = 0
+            self.last_timestamp = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def interrupt(self):
+        for conn in (self.conn, self.count_conn):
+            if conn is not None:
+                try:
+                    conn.interrupt()
+                except sqlite3.ProgrammingError:
+                    pass  # closed by the querying thread meanwhile
+
+    def where(self):
+        clauses = [f'{self.column} = ?']
+        params = [self.value]
+        if self.start is not None:
+            clauses.append('timestamp >= ?')
+            params.append(self.start)
+        if self.end is not None:
+            clauses.append('timestamp <= ?')
+            params.append(self.end)
+        return ' AND '.join(clauses), params
+
+    def chunk_sql(self):
+        where, params = self.where()
+        if self.ranged:
+            if self.last_timestamp is not None:
+                where += ' AND (timestamp, id) > (?, ?)'
+                params += [self.last_timestamp, self.last_id]
+            order = 'timestamp, id'
+        else:
+            where += ' AND id > ?'
+            params.append(self.last_id)
+            order = 'id'
+        sql = (f'SELECT id, imei, timestamp, message, topic FROM {self.table} '
+               f'WHERE {where} ORDER BY {order} LIMIT ?')
+        return sql, params + [self.chunk_size]
+
+    def next_chunk(self):
+        chunk = []
+        while True:
+            sql, params = self.chunk_sql()
+            params[-1] = self.chunk_size - len(chunk)
+            rows = self.conn.execute(sql, params).fetchall()
+            if rows:
+                self.last_id = rows[-1][0]
+                self.last_timestamp = rows[-1][2]
+                chunk.extend(row[1:] for row in rows)
+            if len(chunk) >= self.chunk_size:
+                return chunk
+            if not self.sources:
+                self.exhausted = True
+                return chunk
+            self.next_source()
+
+    def estimate(self):
+        # Average rows per key from ANALYZE statistics, if the database has them
+        try:
+            row = self.conn.execute(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = ? AND idx = ?",
+                (self.table, self.ESTIMATE_INDEXES[(self.table, self.column)])).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None or self.ranged or len(data_sources(self.path)) > 1:
+            return None
+        parts = row[0].split()
+        return int(parts[1]) if len(parts) > 1 else None
+
+    def count_sql(self):
+        where, params = self.where()
+        return f'SELECT count(*) FROM {self.table} WHERE {where}', params
+
+    def count(self):
+        # On connections of its own, which interrupt() cancels as well
+        total = 0
+        for source in data_sources(self.path, self.start, self.end):
+            self.count_conn = sqlite3.connect(source)
+            try:
+                total += self.count_conn.execute(*self.count_sql()).fetchone()[0]
+            finally:
+                self.count_conn.close()
+                self.count_conn = None
+        return total
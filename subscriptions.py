@@ -0,0 +1,120 @@
+import threading
+
+SUBACK_FAILURE = 0x80
+# Topics per SUBSCRIBE/UNSUBSCRIBE packet; brokers limit the packet size
+BATCH_SIZE = 100
+
+# Subscription states shown in the Subscribe tab
+UNSUBSCRIBED = "No"
+PENDING = "Pending"
+REJECTED = "Rejected"
+
+
+def parse_topic_entry(value):
+    # [Topics] values are "topic" (QoS 0) or "topic;qos=N"
+    topic, _, options = value.partition(";")
+    qos = 0
+    for option in options.split(";"):
+        key, _, setting = option.partition("=")
+        if key.strip() == "qos" and setting.strip() in ("0", "1", "2"):
+            qos = int(setting)
+    return topic.strip(), qos
+
+
+def format_topic_entry(topic, qos):
+    return f"{topic};qos={qos}" if qos else topic
+
+
+def configured_topics(config):
+    # [(topic, qos)] from the [Topics] section
+    if "Topics" not in config:
+        return []
+    return [parse_topic_entry(value) for value in config["Topics"].values()]
+
+
+def batches(items, size=BATCH_SIZE):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+class SubscriptionManager:
+    # Subscription state of one broker session. The wanted topics and their
+    # QoS survive disconnects and are sent again, in batches, on connect.
+    # Every SUBSCRIBE/UNSUBSCRIBE is remembered by packet id until its
+    # SUBACK/UNSUBACK arrives, so each topic is known to be pending, granted
+    # (with the QoS the broker granted) or rejected.
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.wanted = {}  # topic -> requested qos
+        self.granted = {}  # topic -> granted qos or SUBACK_FAILURE
+        self.pending = {}  # packet id -> ("subscribe", [(topic, qos)]) or ("unsubscribe", [topic])
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.wanted)
+
+    def __contains__(self, topic):
+        return topic in self.wanted
+
+    def items(self):
+        with self.lock:
+            return list(self.wanted.items())
+
+    def add(self, pairs):
+        # Batches of (topic, qos) to send as SUBSCRIBE packets
+        pairs = [(topic, qos) for topic, qos in pairs]
+        with self.lock:
+            for topic, qos in pairs:
+                self.wanted[topic] = qos
+                self.granted.pop(topic, None)
+        return batches(pairs, self.batch_size)
+
+    def remove(self, topics):
+        # Batches of topics to send as UNSUBSCRIBE packets
+        topics = list(topics)
+        with self.lock:
+            for topic in topics:
+                self.wanted.pop(topic, None)
+                self.granted.pop(topic, None)
+        return batches(topics, self.batch_size)
+
+    def restore(self):
+        # After a (re)connect nothing is granted until the broker says so
+        with self.lock:
+            self.granted.clear()
+            self.pending.clear()
+            return batches(list(self.wanted.items()), self.batch_size)
+
+    def sent(self, packet_id, kind, batch):
+        with self.lock:
+            self.pending[packet_id] = (kind, batch)
+
+    def acknowledged(self, packet_id, return_codes=()):
+        # SUBACK (with one return code per topic) or UNSUBACK. Returns the
+        # topics whose state changed.
+        with self.lock:
+            kind, batch = self.pending.pop(packet_id, (None, []))
+            if kind != "subscribe":
+                return [topic for topic in batch]
+            changed = []
+            for (topic, qos), code in zip(batch, return_codes):
+                if topic in self.wanted:
+                    self.granted[topic] = code
+                    changed.append(topic)
+            return changed
+
+    def state(self, topic):
+        with self.lock:
+            if topic not in self.wanted:
+                return UNSUBSCRIBED
+            code = self.granted.get(topic)
+        if code is None:
+            return PENDING
+        if code == SUBACK_FAILURE:
+            return REJECTED
+        return f"QoS {code}"
+
+    def counts(self):
+        with self.lock:
+            granted = sum(1 for code in self.granted.values() if code != SUBACK_FAILURE)
+            return {"wanted": len(self.wanted), "granted": granted,
+                    "rejected": len(self.granted) - granted, "pending": len(self.pending)}
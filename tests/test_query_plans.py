@@ -0,0 +1,11 @@
+import os
+
+from benchmarks.check_query_plans import build_database, check
+from storage import data_sources
+
+
+def test_no_query_scans_or_sorts_every_row(tmp_path):
+    path = os.path.join(tmp_path, "plans.db")
+    build_database(path)
+    assert len(data_sources(path)) == 2  # the main file and one partition
+    assert check(path) == []
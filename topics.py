@@ -0,0 +1,102 @@
+import threading
+
+
+def topic_matches(topic_filter, topic):
+    # MQTT filter matching: "+" is one level, a trailing "#" any number of levels
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie:
+    # Values registered under MQTT topic filters, one trie level per topic
+    # level. match() walks the exact, "+" and "#" branches of each level, so
+    # its cost follows the depth of the topic, not the number of filters.
+    # Mutations and lookups may come from different threads.
+    def __init__(self):
+        self._root = _Node()
+        self._lock = threading.RLock()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def insert(self, topic_filter, value):
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _Node()
+                node = child
+            node.values.append(value)
+            self._count += 1
+
+    def remove(self, topic_filter, value):
+        # Returns False when value was not registered under topic_filter
+        with self._lock:
+            path = [self._root]
+            levels = topic_filter.split("/")
+            for level in levels:
+                child = path[-1].children.get(level)
+                if child is None:
+                    return False
+                path.append(child)
+            try:
+                path[-1].values.remove(value)
+            except ValueError:
+                return False
+            self._count -= 1
+            # Prune the branch back to the last node still in use
+            for depth in range(len(levels), 0, -1):
+                node = path[depth]
+                if node.values or node.children:
+                    break
+                del path[depth - 1].children[levels[depth - 1]]
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._root = _Node()
+            self._count = 0
+
+    def match(self, topic):
+        # Values of every filter matching topic, each value once, in no
+        # particular order. Wildcards in the first level skip "$" topics.
+        levels = topic.split("/")
+        found = {}
+        with self._lock:
+            stack = [(self._root, 0)]
+            while stack:
+                node, depth = stack.pop()
+                wildcards = not (depth == 0 and levels[0].startswith("$"))
+                if wildcards:
+                    rest = node.children.get("#")
+                    if rest is not None:
+                        found.update(dict.fromkeys(rest.values))
+                if depth == len(levels):
+                    found.update(dict.fromkeys(node.values))
+                    continue
+                child = node.children.get(levels[depth])
+                if child is not None:
+                    stack.append((child, depth + 1))
+                if wildcards:
+                    child = node.children.get("+")
+                    if child is not None:
+                        stack.append((child, depth + 1))
+        return list(found)
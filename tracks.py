@@ -0,0 +1,109 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from storage import DB_PATH, load_gps_fixes
+
+
+class GpsTrack:
+    # In-memory copy of one device's gps_fixes. update() only reads rows
+    # stored since the last call, so refreshing a long track costs as much as
+    # the new points. Coordinates live in array('d') buffers, which numpy can
+    # wrap without copying.
+    def __init__(self, imei, path=DB_PATH):
+        self.imei = imei
+        self.path = path
+        self.last_id = 0
+        self.timestamps = []
+        self.fixes = []
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def update(self):
+        # Returns the number of points appended
+        rows = load_gps_fixes(self.imei, self.last_id, self.path)
+        with self.lock:
+            for row_id, timestamp, fix, latitude, longitude in rows:
+                self.timestamps.append(timestamp)
+                self.fixes.append(fix)
+                self.latitudes.append(latitude)
+                self.longitudes.append(longitude)
+            if rows:
+                self.last_id = rows[-1][0]
+        return len(rows)
+
+    def span(self, start=None, end=None):
+        # Index range of the points between start and end. Fixes are stored
+        # with the receive time, so the timestamps are already sorted.
+        with self.lock:
+            first = 0 if start is None else bisect_left(self.timestamps, start)
+            last = len(self.timestamps) if end is None else bisect_right(self.timestamps, end)
+        return first, max(first, last)
+
+    def points(self, start=None, end=None, first=None):
+        # (lat, lon) pairs in the range, optionally only from index first on
+        low, high = self.span(start, end)
+        if first is not None:
+            low = max(low, first)
+        with self.lock:
+            return list(zip(self.latitudes[low:high], self.longitudes[low:high]))
+
+
+class TrackCache:
+    # One GpsTrack per device, kept for the lifetime of the GUI
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def get(self, imei):
+        with self.lock:
+            track = self.tracks.get(imei)
+            if track is None:
+                track = self.tracks[imei] = GpsTrack(imei, self.path)
+            return track
+
+    def discard(self, imei):
+        with self.lock:
+            self.tracks.pop(imei, None)
+
+
+class LiveTrails:
+    # Last trail_length fixes of every device, fed from the ingest pipeline.
+    # add() runs on the pipeline thread; the map drains the fixes that
+    # arrived since its last frame with drain(), so any number of fixes and
+    # devices costs one update per frame.
+    def __init__(self, trail_length=500):
+        self.trail_length = trail_length
+        self.trails = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, imei, timestamp, latitude, longitude):
+        point = (latitude, longitude)
+        with self.lock:
+            trail = self.trails.get(imei)
+            if trail is None:
+                trail = self.trails[imei] = deque(maxlen=self.trail_length)
+            trail.append(point)
+            pending = self.pending.get(imei)
+            if pending is None:
+                pending = self.pending[imei] = deque(maxlen=self.trail_length)
+            pending.append(point)
+
+    def drain(self):
+        # {imei: [(lat, lon), ...]} added since the previous drain
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return {imei: list(points) for imei, points in pending.items()}
+
+    def snapshot(self):
+        # Whole trails, for a view that starts following
+        with self.lock:
+            self.pending = {}
+            return {imei: list(trail) for imei, trail in self.trails.items()}